@@ -1,259 +1,44 @@
 import os
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image
 import threading
+import queue
 from tkinterdnd2 import TkinterDnD, DND_FILES
-import tempfile
-import shutil
-
-
-# 画像をクロップする関数
-def crop_image(img, crop_type, aspect_ratio=None):
-    # 画像の幅と高さを取得
-    width, height = img.size
-    # クロップタイプに応じて処理を分岐
-    if crop_type == "square":
-        # 正方形にクロップ
-        size = min(width, height)  # 幅と高さの小さい方を取得
-        left = (width - size) // 2  # 左端の座標
-        top = (height - size) // 2  # 上端の座標
-        right = left + size  # 右端の座標
-        bottom = top + size  # 下端の座標
-    elif crop_type == "custom":
-        # カスタム比率でクロップ
-        if aspect_ratio is None:
-            # 比率が指定されていない場合はそのまま返す
-            return img
-        target_ratio = aspect_ratio[0] / aspect_ratio[1]  # 目標比率を計算
-        if width / height > target_ratio:
-            # 幅の方が比率的に大きい場合
-            new_width = int(height * target_ratio)  # 新しい幅を計算
-            left = (width - new_width) // 2  # 左端の座標
-            right = left + new_width  # 右端の座標
-            top, bottom = 0, height  # 上端と下端はそのまま
-        else:
-            # 高さの方が比率的に大きい場合
-            new_height = int(width / target_ratio)  # 新しい高さを計算
-            top = (height - new_height) // 2  # 上端の座標
-            bottom = top + new_height  # 下端の座標
-            left, right = 0, width  # 左端と右端はそのまま
-    elif crop_type == "16:9":
-        # 16:9 比率でクロップ
-        target_ratio = 16 / 9  # 16:9 の比率
-        if width / height > target_ratio:
-            # 幅の方が比率的に大きい場合
-            new_width = int(height * target_ratio)  # 新しい幅を計算
-            left = (width - new_width) // 2  # 左端の座標
-            right = left + new_width  # 右端の座標
-            top, bottom = 0, height  # 上端と下端はそのまま
-        else:
-            # 高さの方が比率的に大きい場合
-            new_height = int(width / target_ratio)  # 新しい高さを計算
-            top = (height - new_height) // 2  # 上端の座標
-            bottom = top + new_height  # 下端の座標
-            left, right = 0, width  # 左端と右端はそのまま
-    elif crop_type == "4:3":
-        # 4:3 比率でクロップ
-        target_ratio = 4 / 3  # 4:3 の比率
-        if width / height > target_ratio:
-            # 幅の方が比率的に大きい場合
-            new_width = int(height * target_ratio)  # 新しい幅を計算
-            left = (width - new_width) // 2  # 左端の座標
-            right = left + new_width  # 右端の座標
-            top, bottom = 0, height  # 上端と下端はそのまま
-        else:
-            # 高さの方が比率的に大きい場合
-            new_height = int(width / target_ratio)  # 新しい高さを計算
-            top = (height - new_height) // 2  # 上端の座標
-            bottom = top + new_height  # 下端の座標
-            left, right = 0, width  # 左端と右端はそのまま
-    else:
-        # クロップタイプが不正な場合はそのまま返す
-        return img
-
-    # 指定された範囲で画像をクロップ
-    return img.crop((left, top, right, bottom))
-
-
-# 画像を処理する関数
-def process_image(
-    input_path,
-    output_folder,
-    target_size,
-    operation,
-    size_type,
-    crop_type,
-    aspect_ratio=None,
-    quality=85,
-    progress_callback=None,
-):
-    # 画像を開く
-    with Image.open(input_path) as img:
-        # 元の画像のサイズを取得
-        original_size = os.path.getsize(input_path) / (1024 * 1024)  # MB単位に変換
-        original_width, original_height = img.size  # 幅と高さ
-
-        # ファイル名と拡張子を取得
-        base_name = os.path.basename(input_path)  # ファイル名
-        name, ext = os.path.splitext(base_name)  # ファイル名と拡張子
-
-        # GIFファイルはスキップ
-        if ext.lower() == ".gif":
-            if progress_callback:
-                progress_callback(1.0)  # プログレスバーを100%にする
-            return None, 1.0, "GIFファイルはスキップされました"
-
-        # クロップ処理を適用
-        img = crop_image(img, crop_type, aspect_ratio)  # 画像をクロップ
-        cropped_width, cropped_height = img.size  # クロップ後の幅と高さ
-
-        # クロップが適用された場合、ファイル名に"_cropped_クロップタイプ"を追加
-        if crop_type != "none":
-            if crop_type == "custom" and aspect_ratio is not None:
-                # カスタム比率の場合、入力値をファイル名に反映
-                aspect_width = (
-                    int(aspect_ratio[0])
-                    if aspect_ratio[0].is_integer()
-                    else aspect_ratio[0]
-                )
-                aspect_height = (
-                    int(aspect_ratio[1])
-                    if aspect_ratio[1].is_integer()
-                    else aspect_ratio[1]
-                )
-                crop_type_safe = f"{aspect_width}×{aspect_height}"
-            else:
-                # クロップタイプが16:9などの場合、ファイル名にバグが発生しないように変換
-                crop_type_safe = crop_type.replace(":", "×")
-            name += f"_{crop_type_safe}"
-
-        # サイズ変更なしの場合
-        if size_type == "none":
-            # クロップ後の画像を保存
-            output_path = os.path.join(output_folder, f"{name}{ext}")
-            img.save(output_path, quality=quality, optimize=True)
-            if progress_callback:
-                progress_callback(1.0)  # プログレスバーを100%にする
-            return output_path, 1.0, None  # 出力パス、サイズ比率、メッセージ
-
-        # サイズ変更ありの場合
-        if size_type == "mb":
-            # 目標サイズをMB単位で取得
-            target_size_mb = float(target_size)
-            # 自動調整モードの場合
-            if operation == "auto":
-                # 元のサイズが目標サイズより大きければ圧縮、小さければ拡大
-                operation = "compress" if original_size > target_size_mb else "upscale"
-            # サイズ比率を計算
-            size_ratio = (target_size_mb / original_size) ** 0.5
-        else:  # size_type == "width" or "height"
-            # 目標サイズをピクセル単位で取得
-            target_size = int(target_size)
-            # 幅で指定した場合
-            if size_type == "width":
-                target_dimension = cropped_width  # 目標寸法は幅
-            else:  # size_type == "height"
-                target_dimension = cropped_height  # 目標寸法は高さ
-
-            # 自動調整モードの場合
-            if operation == "auto":
-                # 目標寸法が元の寸法より大きければ拡大、小さければ圧縮
-                operation = "compress" if target_dimension > target_size else "upscale"
-            # サイズ比率を計算
-            size_ratio = target_size / target_dimension
-
-        # 一時ファイルを作成
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as temp_file:
-            temp_path = temp_file.name  # 一時ファイルのパス
-
-        try:
-            # イテレーション回数
-            iteration = 0
-            max_iterations = 20  # 最大イテレーション回数
-            # 目標サイズに到達するまでループ
-            while iteration < max_iterations:
-                # 新しい幅と高さを計算
-                new_width = int(cropped_width * size_ratio)
-                new_height = int(cropped_height * size_ratio)
-
-                # 画像をリサイズ
-                resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-
-                # リサイズ後のサイズ比率を計算
-                current_ratio = int(
-                    (new_width * new_height) / (cropped_width * cropped_height) * 100
-                )
-
-                # 画像を一時ファイルに保存
-                if ext.lower() in [".jpg", ".jpeg"]:
-                    resized_img.save(temp_path, quality=quality, optimize=True)
-                else:
-                    resized_img.save(temp_path, optimize=True)
-
-                # リサイズ後のファイルサイズを取得
-                new_size = os.path.getsize(temp_path) / (1024 * 1024)
-
-                # プログレスバーを更新
-                if progress_callback:
-                    progress_callback((iteration + 1) / max_iterations)
-
-                # 目標サイズに到達したかどうか判定
-                condition = False
-                if size_type == "mb":
-                    # MBで指定した場合
-                    condition = (
-                        operation == "compress" and new_size <= target_size_mb
-                    ) or (operation == "upscale" and new_size >= target_size_mb)
-                elif size_type == "width":
-                    # 幅で指定した場合
-                    condition = (
-                        operation == "compress" and new_width <= target_size
-                    ) or (operation == "upscale" and new_width >= target_size)
-                else:  # size_type == "height"
-                    # 高さで指定した場合
-                    condition = (
-                        operation == "compress" and new_height <= target_size
-                    ) or (operation == "upscale" and new_height >= target_size)
-
-                # 目標サイズに到達した場合
-                if condition:
-                    # 処理結果を記録
-                    operation_name = "compressed" if operation == "comp" else "upscale"
-                    output_path = os.path.join(
-                        output_folder,
-                        f"{name}_{current_ratio}%{ext}",
-                    )
-                    shutil.copy2(temp_path, output_path)
-                    if progress_callback:
-                        progress_callback(1.0)  # プログレスバーを100%にする
-                    return (
-                        output_path,
-                        size_ratio,
-                        None,
-                    )  # 出力パス、サイズ比率、メッセージ
-
-                # 目標サイズに到達していない場合、サイズ比率と品質を調整
-                if operation == "compress":
-                    # 圧縮の場合、サイズ比率を小さくし、品質を下げる
-                    size_ratio *= 0.9
-                    quality = max(quality - 5, 10)  # 品質は10以下にならないようにする
-                else:  # upscale
-                    # 拡大の場合、サイズ比率を大きくし、品質を上げる
-                    size_ratio *= 1.1
-                    quality = min(quality + 5, 95)  # 品質は95以上にならないようにする
-
-                # イテレーション回数を増やす
-                iteration += 1
-
-            # 最大イテレーション回数に達しても目標サイズに到達できなかった場合
-            if progress_callback:
-                progress_callback(1.0)  # プログレスバーを100%にする
-            return None, 0, "目標サイズに到達できませんでした"
-        finally:
-            # 一時ファイルを削除
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+import multiprocessing
+from PIL import ImageTk
+from imagesizer_cache import ResultCache
+from imagesizer_intake import iter_image_files, path_key
+from imagesizer_journal import (
+    BatchJournal,
+    default_journal_path,
+    remove_stale_temp_files,
+)
+from imagesizer_metrics import ProcessingCancelled
+from imagesizer_pipeline import process_pipeline
+from imagesizer_preview import PREVIEW_SIZE, ProxyCache, make_preview
+
+# 画像処理部分は imagesizer_core にある（crop_image と process_image は互換性のため再公開）
+from imagesizer_core import (
+    DEFAULT_TOLERANCE,
+    DEFAULT_WORKERS,
+    crop_image,
+    default_job_memory_budget_mb,
+    process_image,
+)
+
+# 画面を更新する間隔（ミリ秒）。進捗はこの間隔（約30fps）でまとめて反映する
+UPDATE_INTERVAL_MS = 33
+# 1回の更新で処理するイベント数の上限（超えた分は次回に回す）
+MAX_EVENTS_PER_UPDATE = 5000
+# ログに残す行数の上限（超えた分は古い行から削除する）
+MAX_LOG_LINES = 5000
+# フォルダの探索結果をまとめて画面に送る件数
+INTAKE_CHUNK_SIZE = 1000
+# 1回の更新でリストに追加するファイル数の上限
+MAX_FILES_PER_UPDATE = 20000
+# 設定やファイルの選択が変わってからプレビューを更新するまでの時間（ミリ秒）
+# （この間に次の変更があれば待ち直し、キー入力やスクロールのたびには作らない）
+PREVIEW_DELAY_MS = 150
 
 
 class ImageProcessorApp:
@@ -262,10 +47,30 @@ class ImageProcessorApp:
         # 初期化処理
         self.master = master  # 親ウィンドウを保持
         master.title("ImageSizer")  # ウィンドウタイトルを設定
-        master.geometry("600x800+100+100")  # ウィンドウサイズと位置を設定
+        master.geometry("600x1000+100+100")  # ウィンドウサイズと位置を設定
+
+        # 処理スレッドから画面への更新はキューを介して行う（Tkはスレッドセーフではない）
+        self.events = queue.Queue()
+        self.pause_event = threading.Event()  # セットされている間は一時停止
+        # セットされると処理を中止（ワーカープロセスでも確認するため multiprocessing のもの）
+        self.cancel_event = multiprocessing.Event()
+        self.running = False  # 処理中かどうか
+        self.file_keys = set()  # リストにあるファイルのキー（重複の判定用）
+        # 処理の状態の記録（終了やクラッシュで中断した処理を次回の起動時に再開する）
+        self.journal = BatchJournal(default_journal_path())
+        # プレビュー（別スレッドで最新の要求だけを作成し、結果はキューで受け取る）
+        self.preview_cache = ProxyCache()  # デコードしたプロキシとクロップの見積もり
+        self.preview_request = None  # (世代, パス, 設定)
+        self.preview_generation = 0  # 古い要求の結果を表示しないための番号
+        self.preview_wakeup = threading.Event()
+        self.preview_after = None  # 待機中の更新（after のID）
+        self.preview_photo = None  # 表示中の画像（参照を保持しないと消える）
+        threading.Thread(target=self.preview_thread, daemon=True).start()
 
         self.create_widgets()  # ウィジェットを作成
         self.setup_drop_target()  # ドロップターゲットを設定
+        self.master.after(UPDATE_INTERVAL_MS, self.poll_events)  # 画面の定期更新を開始
+        self.master.after(0, self.offer_resume)  # 中断した処理があれば再開を確認
 
     def create_widgets(self):
         # ウィジェット作成処理
@@ -275,10 +80,18 @@ class ImageProcessorApp:
         file_frame.pack(fill=tk.X, padx=10, pady=5)  # フレームを配置
         # ラベルとリストボックス、ボタンを作成
         ttk.Label(
-            file_frame, text="画像をドラッグアンドドロップしてください（複数選択可）:"
+            file_frame,
+            text="画像またはフォルダをドラッグアンドドロップしてください（複数選択可）:",
         ).pack(pady=5)
-        self.file_listbox = tk.Listbox(file_frame, width=70, height=5)
+        # 他の入力欄で文字を選択しても、選択中のファイル（プレビューの対象）を保つ
+        self.file_listbox = tk.Listbox(
+            file_frame, width=70, height=5, exportselection=False
+        )
         self.file_listbox.pack(pady=5)
+        self.file_listbox.bind("<<ListboxSelect>>", self.schedule_preview)
+        # リストのファイル数を表示するラベルを作成
+        self.file_count_label = ttk.Label(file_frame, text="0 件")
+        self.file_count_label.pack()
         ttk.Button(file_frame, text="ファイルを選択", command=self.browse_files).pack(
             pady=5
         )
@@ -324,6 +137,13 @@ class ImageProcessorApp:
             value="custom",
             command=self.on_crop_change,
         ).pack(anchor=tk.W)
+        ttk.Radiobutton(
+            crop_frame,
+            text="スマート（被写体に合わせる）",
+            variable=self.crop_var,
+            value="smart",
+            command=self.on_crop_change,
+        ).pack(anchor=tk.W)
 
         # カスタム比率入力用のフレームを作成
         self.aspect_ratio_frame = ttk.Frame(crop_frame)
@@ -335,6 +155,9 @@ class ImageProcessorApp:
         ttk.Label(self.aspect_ratio_frame, text=":").pack(side=tk.LEFT)
         self.aspect_height = ttk.Entry(self.aspect_ratio_frame, width=5)
         self.aspect_height.pack(side=tk.LEFT)
+        # 入力が変わったらプレビューを更新する
+        self.aspect_width.bind("<KeyRelease>", self.schedule_preview)
+        self.aspect_height.bind("<KeyRelease>", self.schedule_preview)
         # カスタム比率入力フレームを非表示にする
         self.aspect_ratio_frame.pack_forget()
 
@@ -382,6 +205,16 @@ class ImageProcessorApp:
         self.size_entry = ttk.Entry(self.size_input_frame, width=10)
         self.size_entry.insert(0, "2")
         self.size_entry.pack(side=tk.LEFT, padx=5)
+        self.size_entry.bind("<KeyRelease>", self.schedule_preview)
+
+        # 許容誤差入力用のフレームを作成（MBで指定の場合のみ表示）
+        self.tolerance_frame = ttk.Frame(size_frame)
+        self.tolerance_frame.pack(pady=5)
+        # 許容誤差入力用のラベルとエントリーを作成
+        ttk.Label(self.tolerance_frame, text="許容誤差 (%):").pack(side=tk.LEFT)
+        self.tolerance_entry = ttk.Entry(self.tolerance_frame, width=10)
+        self.tolerance_entry.insert(0, f"{DEFAULT_TOLERANCE * 100:g}")
+        self.tolerance_entry.pack(side=tk.LEFT, padx=5)
 
         # 拡大・縮小モードの選択部分
         operation_frame = ttk.LabelFrame(
@@ -396,26 +229,118 @@ class ImageProcessorApp:
             text="自動調整（目標サイズより小さければ拡大、大きければ圧縮）",
             variable=self.operation_var,
             value="auto",
+            command=self.schedule_preview,
         ).pack(anchor=tk.W)
         ttk.Radiobutton(
-            operation_frame, text="圧縮", variable=self.operation_var, value="compress"
+            operation_frame,
+            text="圧縮",
+            variable=self.operation_var,
+            value="compress",
+            command=self.schedule_preview,
         ).pack(anchor=tk.W)
         ttk.Radiobutton(
-            operation_frame, text="拡大", variable=self.operation_var, value="upscale"
+            operation_frame,
+            text="拡大",
+            variable=self.operation_var,
+            value="upscale",
+            command=self.schedule_preview,
         ).pack(anchor=tk.W)
 
+        # プレビュー部分（選択中のファイル、選択がなければ先頭のファイル）
+        preview_frame = ttk.LabelFrame(self.master, text="プレビュー", padding=(10, 5))
+        # プレビュー用のフレームを作成
+        preview_frame.pack(fill=tk.X, padx=10, pady=5)  # フレームを配置
+        # クロップ範囲を重ねて表示するキャンバスと、幅、高さ、サイズを表示するラベルを作成
+        self.preview_canvas = tk.Canvas(
+            preview_frame,
+            width=PREVIEW_SIZE[0],
+            height=PREVIEW_SIZE[1],
+            highlightthickness=0,
+        )
+        self.preview_canvas.pack(side=tk.LEFT)
+        self.preview_label = ttk.Label(preview_frame, justify=tk.LEFT)
+        self.preview_label.pack(side=tk.LEFT, padx=10, anchor=tk.N)
+
+        # 処理設定部分
+        batch_frame = ttk.LabelFrame(self.master, text="処理設定", padding=(10, 5))
+        # 処理設定用のフレームを作成
+        batch_frame.pack(fill=tk.X, padx=10, pady=5)  # フレームを配置
+        # 並列数入力用のラベルとスピンボックスを作成
+        ttk.Label(batch_frame, text="並列数:").pack(side=tk.LEFT)
+        self.workers_var = tk.IntVar(value=DEFAULT_WORKERS)
+        ttk.Spinbox(
+            batch_frame,
+            from_=1,
+            to=DEFAULT_WORKERS * 4,
+            textvariable=self.workers_var,
+            width=5,
+        ).pack(side=tk.LEFT, padx=5)
+        # キャッシュ使用のチェックボックスを作成
+        self.cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            batch_frame,
+            text="キャッシュを使用（処理済みの画像を再処理しない）",
+            variable=self.cache_var,
+        ).pack(side=tk.LEFT, padx=10)
+
         # プログレスバーとログ出力
         self.progress = ttk.Progressbar(
             self.master, orient="horizontal", length=400, mode="determinate"
         )
         # プログレスバーを作成
         self.progress.pack(pady=10)  # プログレスバーを配置
+        # 一時停止とキャンセルのボタンを作成（処理中のみ有効）
+        control_frame = ttk.Frame(self.master)
+        control_frame.pack()
+        self.pause_button = ttk.Button(
+            control_frame, text="一時停止", command=self.toggle_pause, state=tk.DISABLED
+        )
+        self.pause_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(
+            control_frame, text="キャンセル", command=self.cancel, state=tk.DISABLED
+        )
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
         # ログ出力用のテキストエリアを作成
-        self.output_text = tk.Text(self.master, height=15, width=70)
+        self.output_text = tk.Text(self.master, height=8, width=70)
         self.output_text.pack(pady=10)
         # ログ出力用のテキストエリアに緑色のタグを設定
         self.output_text.tag_configure("green", foreground="green")
 
+    def offer_resume(self):
+        # 前回中断した処理があれば、再開するかどうかを確認する処理
+        jobs = self.journal.unfinished()
+        if not jobs:
+            return
+        if not messagebox.askyesno(
+            "処理の再開",
+            f"前回の処理が完了していません（未処理: {len(jobs)} 件）。再開しますか？",
+        ):
+            self.journal.discard()
+            return
+        # 前回の設定を画面に戻し、未処理のファイルをリストに追加して処理を開始する
+        self.restore_settings(self.journal.options)
+        remove_stale_temp_files(job["output_folder"] for job in jobs)
+        self.add_files([job["input_path"] for job in jobs], start=True)
+
+    def restore_settings(self, options):
+        # ジャーナルに記録された処理内容を画面の設定に戻す処理
+        self.crop_var.set(options["crop_type"])
+        self.on_crop_change()
+        if options.get("aspect_ratio"):
+            for entry, value in zip(
+                (self.aspect_width, self.aspect_height), options["aspect_ratio"]
+            ):
+                entry.delete(0, tk.END)
+                entry.insert(0, f"{value:g}")
+        self.size_type_var.set(options["size_type"])
+        self.on_size_type_change()
+        if options.get("target_size") is not None:
+            self.size_entry.delete(0, tk.END)
+            self.size_entry.insert(0, f"{options['target_size']:g}")
+        self.tolerance_entry.delete(0, tk.END)
+        self.tolerance_entry.insert(0, f"{options['tolerance'] * 100:g}")
+        self.operation_var.set(options["operation"])
+
     def setup_drop_target(self):
         # ドロップターゲット設定処理
         self.master.drop_target_register(DND_FILES)  # ファイルドロップを登録
@@ -424,48 +349,65 @@ class ImageProcessorApp:
     def drop(self, event):
         # ドロップイベント処理
         files = self.master.tk.splitlist(event.data)  # ドロップされたファイルを取得
-        self.add_files(files)  # ファイルをリストに追加
-        self.process_images()  # 画像処理を開始
+        # ファイルをリストに追加し、追加が終わったら画像処理を開始
+        self.add_files(files, start=True)
 
-    def add_files(self, files):
-        # ファイル追加処理
-        for file in files:
-            if file not in self.file_listbox.get(0, tk.END):
-                # リストに存在しないファイルのみ追加
-                self.file_listbox.insert(tk.END, file)
+    def add_files(self, files, start=False):
+        # ファイル追加処理（フォルダの探索は別スレッドで行い、少しずつリストに追加する）
+        def scan_thread():
+            chunk = []
+            try:
+                for path in iter_image_files(files):
+                    chunk.append(path)
+                    if len(chunk) >= INTAKE_CHUNK_SIZE:
+                        self.events.put(("files", chunk))
+                        chunk = []
+            finally:
+                self.events.put(("files", chunk))
+                # 探索が終わったことを通知（start が True なら処理を開始する）
+                self.events.put(("scan_done", start))
+
+        threading.Thread(target=scan_thread, daemon=True).start()
 
     def browse_files(self):
         # ファイル選択ダイアログ表示処理
         files = filedialog.askopenfilenames(
-            filetypes=[("Image files", "*.png;*.jpg;*.jpeg;*.bmp;*.tiff")]
+            filetypes=[("Image files", "*.png;*.jpg;*.jpeg;*.bmp;*.tiff;*.gif;*.webp")]
         )
         # 選択されたファイルを追加
         self.add_files(files)
 
     def on_crop_change(self):
         # クロップ設定変更処理
-        if self.crop_var.get() == "custom":
-            # カスタム比率の場合、入力フレームを表示
+        if self.crop_var.get() in ("custom", "smart"):
+            # カスタム比率とスマートクロップの場合、入力フレームを表示
+            # （スマートクロップは空欄なら正方形）
             self.aspect_ratio_frame.pack()
         else:
             # カスタム比率以外の場合、入力フレームを非表示
             self.aspect_ratio_frame.pack_forget()
+        self.schedule_preview()
 
     def on_size_type_change(self):
         # サイズ変更設定変更処理
         size_type = self.size_type_var.get()
         if size_type == "none":
-            # 変更なしの場合、サイズ入力フレームを非表示
+            # 変更なしの場合、サイズ入力フレームと許容誤差入力フレームを非表示
             self.size_input_frame.pack_forget()
+            self.tolerance_frame.pack_forget()
         else:
             # 変更ありの場合、サイズ入力フレームを表示
-            self.size_input_frame.pack()
+            self.size_input_frame.pack(pady=5)
             if size_type == "mb":
-                # MBで指定の場合、ラベルとエントリーを初期化
+                # MBで指定の場合、ラベルとエントリーを初期化し、許容誤差入力フレームを表示
                 self.size_label.config(text="目標サイズ (MB):")
                 self.size_entry.delete(0, tk.END)
                 self.size_entry.insert(0, "2")
-            elif size_type == "width":
+                self.tolerance_frame.pack(pady=5)
+            else:
+                # ピクセルで指定の場合、許容誤差入力フレームを非表示
+                self.tolerance_frame.pack_forget()
+            if size_type == "width":
                 # 横ピクセルで指定の場合、ラベルとエントリーを初期化
                 self.size_label.config(text="目標サイズ (横px):")
                 self.size_entry.delete(0, tk.END)
@@ -475,9 +417,218 @@ class ImageProcessorApp:
                 self.size_label.config(text="目標サイズ (縦px):")
                 self.size_entry.delete(0, tk.END)
                 self.size_entry.insert(0, "1080")
+        self.schedule_preview()
+
+    def preview_settings(self):
+        # プレビューに使う設定を画面から取得する処理
+        # （入力途中の値はエラーにせず、目標サイズや縦横比がないものとして扱う）
+        size_type = self.size_type_var.get()
+        target_size = None
+        if size_type != "none":
+            try:
+                target_size = float(self.size_entry.get())
+            except ValueError:
+                pass
+            if target_size is not None and target_size <= 0:
+                target_size = None
+        crop_type = self.crop_var.get()
+        aspect_ratio = None
+        if crop_type in ("custom", "smart"):
+            try:
+                aspect_ratio = (
+                    float(self.aspect_width.get()),
+                    float(self.aspect_height.get()),
+                )
+            except ValueError:
+                pass
+            if aspect_ratio is not None and min(aspect_ratio) <= 0:
+                aspect_ratio = None
+        return dict(
+            crop_type=crop_type,
+            aspect_ratio=aspect_ratio,
+            size_type=size_type,
+            target_size=target_size,
+            operation=self.operation_var.get(),
+        )
+
+    def schedule_preview(self, event=None):
+        # プレビューの更新を予約する処理（続けて変更された場合は最後の変更から待ち直す）
+        if self.preview_after is not None:
+            self.master.after_cancel(self.preview_after)
+        self.preview_after = self.master.after(PREVIEW_DELAY_MS, self.request_preview)
+
+    def request_preview(self):
+        # プレビューの作成をプレビュー用のスレッドに依頼する処理
+        self.preview_after = None
+        self.preview_generation += 1  # 作成中の古い要求の結果は表示しない
+        selection = self.file_listbox.curselection()
+        index = selection[0] if selection else 0
+        if index >= self.file_listbox.size():
+            # ファイルがない場合はプレビューを消す
+            self.preview_canvas.delete("all")
+            self.preview_photo = None
+            self.preview_label.config(text="")
+            return
+        self.preview_request = (
+            self.preview_generation,
+            self.file_listbox.get(index),
+            self.preview_settings(),
+        )
+        self.preview_wakeup.set()
+
+    def preview_thread(self):
+        # プレビューを作成するスレッド（作成中に届いた要求は、最新のものだけを処理する）
+        while True:
+            self.preview_wakeup.wait()
+            self.preview_wakeup.clear()
+            generation, path, settings = self.preview_request
+            try:
+                result = make_preview(path, settings, self.preview_cache)
+            except Exception as e:
+                result = e
+            self.events.put(("preview", (generation, path, result)))
+
+    def show_preview(self, path, preview):
+        # 作成したプレビューを表示する処理
+        self.preview_canvas.delete("all")
+        self.preview_photo = None
+        name = os.path.basename(path)
+        if isinstance(preview, Exception):
+            self.preview_label.config(
+                text=f"{name}\nプレビューを作成できません:\n{preview}"
+            )
+            return
+        # 画像をキャンバスの中央に置き、クロップ範囲を枠で示す
+        image = preview["image"]
+        x = (PREVIEW_SIZE[0] - image.width) // 2
+        y = (PREVIEW_SIZE[1] - image.height) // 2
+        self.preview_photo = ImageTk.PhotoImage(image)
+        self.preview_canvas.create_image(x, y, image=self.preview_photo, anchor=tk.NW)
+        if preview["crop_box"] is not None:
+            scale = preview["display_scale"]
+            left, top, right, bottom = preview["crop_box"]
+            self.preview_canvas.create_rectangle(
+                x + left * scale,
+                y + top * scale,
+                x + right * scale,
+                y + bottom * scale,
+                outline="red",
+                width=2,
+            )
+        # 元と出力（見積もり）の幅、高さ、ファイルサイズを表示
+        input_width, input_height = preview["input_size"]
+        lines = [
+            name,
+            f"元: {input_width}x{input_height}px",
+            f"    {preview['input_bytes'] / (1024 * 1024):.2f} MB",
+        ]
+        if preview["output_size"] is None:
+            lines.append("出力（推定）: -")
+        else:
+            output_width, output_height = preview["output_size"]
+            lines.append(f"出力（推定）: {output_width}x{output_height}px")
+            if preview["output_bytes"] is not None:
+                lines.append(f"    約 {preview['output_bytes'] / (1024 * 1024):.2f} MB")
+        self.preview_label.config(text="\n".join(lines))
+
+    def toggle_pause(self):
+        # 一時停止と再開の切り替え処理
+        if self.pause_event.is_set():
+            self.pause_event.clear()
+            self.pause_button.config(text="一時停止")
+        else:
+            self.pause_event.set()
+            self.pause_button.config(text="再開")
+
+    def cancel(self):
+        # キャンセル処理（処理中のファイルもエンコードの1回以内に中止する）
+        self.cancel_event.set()
+        self.pause_event.clear()  # 一時停止中でも中止できるようにする
+        self.cancel_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.DISABLED)
+
+    def poll_events(self):
+        # 処理スレッドからのイベントをまとめて画面に反映する処理
+        log_lines = []  # (テキスト, タグ) のリスト
+        progress = None  # 最新の進捗のみ反映する
+        done_count = 0  # リストから削除するファイル数
+        new_files = []  # リストに追加するファイル
+        start_requested = False  # 探索の完了後に処理を開始するかどうか
+        finished = False
+        preview = None  # 最新のプレビューのみ反映する
+        for _ in range(MAX_EVENTS_PER_UPDATE):
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "files":
+                # リストに存在しないファイルのみ追加
+                for path in value:
+                    key = path_key(path)
+                    if key not in self.file_keys:
+                        self.file_keys.add(key)
+                        new_files.append(path)
+                if len(new_files) >= MAX_FILES_PER_UPDATE:
+                    break  # 残りは次回の更新で追加する
+            elif kind == "scan_done":
+                start_requested = start_requested or value
+            elif kind == "log":
+                log_lines.append(value)
+            elif kind == "progress":
+                progress = value
+            elif kind == "file_done":
+                done_count += 1
+            elif kind == "finished":
+                finished = True
+            elif kind == "preview":
+                preview = value
+
+        if log_lines:
+            # 同じタグが続く行はまとめて挿入する
+            chunk, chunk_tag = [], None
+            for text, tag in log_lines + [(None, None)]:
+                if chunk and (text is None or tag != chunk_tag):
+                    self.output_text.insert(tk.END, "".join(chunk), chunk_tag or ())
+                    chunk = []
+                chunk.append(text)
+                chunk_tag = tag
+            # 古い行を削除してログが大きくなりすぎないようにする
+            line_count = int(self.output_text.index("end-1c").split(".")[0])
+            if line_count > MAX_LOG_LINES:
+                self.output_text.delete("1.0", f"{line_count - MAX_LOG_LINES + 1}.0")
+            self.output_text.see(tk.END)
+        if progress is not None:
+            self.progress["value"] = progress
+        if new_files:
+            self.file_listbox.insert(tk.END, *new_files)
+        if done_count:
+            # 処理が終わったファイルをリストから削除
+            for path in self.file_listbox.get(0, done_count - 1):
+                self.file_keys.discard(path_key(path))
+            self.file_listbox.delete(0, done_count - 1)
+        if new_files or done_count:
+            self.file_count_label.config(text=f"{self.file_listbox.size()} 件")
+            if not self.running:
+                # プレビューの対象が変わった可能性がある（処理中は処理を優先して更新しない）
+                self.schedule_preview()
+        if preview is not None and preview[0] == self.preview_generation:
+            self.show_preview(*preview[1:])
+        if finished:
+            self.running = False
+            self.pause_event.clear()
+            self.pause_button.config(text="一時停止", state=tk.DISABLED)
+            self.cancel_button.config(state=tk.DISABLED)
+            self.schedule_preview()
+        if start_requested:
+            self.process_images()
+
+        self.master.after(UPDATE_INTERVAL_MS, self.poll_events)
 
     def process_images(self):
         # 画像処理処理
+        if self.running:
+            # 処理中の場合は新しい処理を開始しない（追加したファイルはリストに残る）
+            return
         files = list(self.file_listbox.get(0, tk.END))
         # リストボックスからファイルを取得
         if not files:
@@ -499,14 +650,38 @@ class ImageProcessorApp:
             # サイズ変更設定が変更なしの場合、目標サイズをNoneにする
             target_size = None
 
+        tolerance = DEFAULT_TOLERANCE
+        # MBで指定の場合、許容誤差を取得
+        if size_type == "mb":
+            try:
+                tolerance = float(self.tolerance_entry.get()) / 100
+            except ValueError:
+                # 許容誤差が数値でない場合、エラーを表示
+                messagebox.showerror("エラー", "許容誤差には数値を入力してください。")
+                return
+
+        # 並列数を取得
+        try:
+            workers = max(int(self.workers_var.get()), 1)
+        except (ValueError, tk.TclError):
+            # 並列数が整数でない場合、エラーを表示
+            messagebox.showerror("エラー", "並列数には整数を入力してください。")
+            return
+
+        # キャッシュを使う場合はキャッシュを作成
+        cache = ResultCache() if self.cache_var.get() else None
+
         operation = self.operation_var.get()
         # 拡大・縮小モードを取得
         crop_type = self.crop_var.get()
         # クロップ設定を取得
 
         aspect_ratio = None
-        # カスタム比率を取得
-        if crop_type == "custom":
+        # カスタム比率を取得（スマートクロップは空欄なら正方形）
+        smart_square = crop_type == "smart" and not (
+            self.aspect_width.get().strip() or self.aspect_height.get().strip()
+        )
+        if crop_type in ("custom", "smart") and not smart_square:
             try:
                 aspect_width = float(self.aspect_width.get())
                 aspect_height = float(self.aspect_height.get())
@@ -522,78 +697,130 @@ class ImageProcessorApp:
         self.progress["maximum"] = len(files) * 100
         # プログレスバーの初期値を設定
         self.progress["value"] = 0
-
-        # プログレスバー更新用の関数
-        def update_progress(file_progress):
-            self.progress["value"] += file_progress
-            self.master.update_idletasks()
+        # 一時停止とキャンセルの状態を初期化し、ボタンを有効にする
+        self.running = True
+        self.pause_event.clear()
+        self.cancel_event.clear()
+        self.pause_button.config(text="一時停止", state=tk.NORMAL)
+        self.cancel_button.config(state=tk.NORMAL)
+
+        # ログを画面に送る関数（処理スレッドから呼ばれる）
+        def log(text, tag=None):
+            self.events.put(("log", (text + "\n", tag)))
+
+        # 一時停止中は待つ関数（キャンセルされた場合はすぐに戻る）
+        def wait_if_paused():
+            while self.pause_event.is_set() and not self.cancel_event.is_set():
+                self.cancel_event.wait(0.1)
+
+        # ファイル内の進捗を画面に送る関数（並列数が1の場合のみ呼ばれる）
+        def update_progress(index, file_progress):
+            self.events.put(("progress", (index + file_progress) * 100))
+            wait_if_paused()
 
         # 画像処理を行うスレッド関数
         def process_images_thread():
-            for i, file in enumerate(files):
+            try:
+                run_batch()
+            except Exception as e:
+                log(f"エラー: {str(e)}")
+            finally:
+                self.events.put(("finished", None))
+
+        # 画像処理を行う関数（処理スレッドで実行される）
+        def run_batch():
+            # ファイルごとの処理内容を作成（出力先は元のファイルと同じフォルダ）
+            options = dict(
+                target_size=target_size,
+                operation=operation,
+                size_type=size_type,
+                crop_type=crop_type,
+                aspect_ratio=aspect_ratio,
+                tolerance=tolerance,
+                cache=cache,
+            )
+            jobs = [
+                dict(options, input_path=file, output_folder=os.path.dirname(file))
+                for file in files
+            ]
+            # 処理を始める前に、すべてのファイルを未処理としてジャーナルに記録する
+            self.journal.start(options, jobs)
+            # 画像処理を並列に実行し、入力順に結果を受け取る
+            # （次のファイルの読み込みと前のファイルの書き込みは処理と並行して行う）
+            # 一時停止中は結果を受け取らないため、新しいジョブの投入も止まる
+            # 大きな画像を並列に処理してメモリが不足しないよう、物理メモリの半分を予算にする
+            results = process_pipeline(
+                jobs,
+                max_workers=workers,
+                progress_callback=update_progress,
+                job_memory_budget_mb=default_job_memory_budget_mb(),
+                cancel_event=self.cancel_event,
+                start_callback=self.journal.mark_running,
+            )
+            done = 0
+            for i, job, result, stats, error in results:
+                file = job["input_path"]
+                self.journal.record_result(job, result, error)
+                if isinstance(error, ProcessingCancelled):
+                    # 処理中に中止したファイルは未処理のままリストに残す
+                    break
                 try:
-                    # ファイルの出力フォルダを取得
-                    output_folder = os.path.dirname(file)
-                    # 画像処理を実行
-                    output_path, size_ratio, message = process_image(
-                        file,
-                        output_folder,
-                        target_size,
-                        operation,
-                        size_type,
-                        crop_type,
-                        aspect_ratio,
-                        progress_callback=lambda p: update_progress(
-                            p * 100 / len(files)
-                        ),
-                    )
+                    if error is not None:
+                        raise error
+                    output_path, size_ratio, message = result
                     # 処理結果に応じてログ出力
                     if message:
-                        self.output_text.insert(tk.END, f"{file}: {message}\n", "green")
+                        log(f"{file}: {message}", "green")
                     elif output_path:
                         # 処理成功の場合、ファイルサイズと解像度をログ出力
-                        final_size = os.path.getsize(output_path) / (1024 * 1024)
-                        original_size = os.path.getsize(file) / (1024 * 1024)
-                        with Image.open(file) as img:
-                            original_width, original_height = img.size
-                        with Image.open(output_path) as img:
-                            final_width, final_height = img.size
-                        self.output_text.insert(tk.END, f"処理完了: {file}\n")
-                        self.output_text.insert(tk.END, f"  出力: {output_path}\n")
-                        self.output_text.insert(
-                            tk.END,
-                            f"  元のサイズ: {original_size:.2f} MB, {original_width}x{original_height}px\n",
+                        # （処理結果に含まれる値を使い、ファイルを開き直さない）
+                        final_size = result.output_bytes / (1024 * 1024)
+                        original_size = result.input_bytes / (1024 * 1024)
+                        original_width, original_height = result.input_size
+                        final_width, final_height = result.output_size
+                        log(f"処理完了: {file}")
+                        log(f"  出力: {output_path}")
+                        log(
+                            f"  元のサイズ: {original_size:.2f} MB, {original_width}x{original_height}px"
                         )
-                        self.output_text.insert(
-                            tk.END,
-                            f"  最終サイズ: {final_size:.2f} MB, {final_width}x{final_height}px\n",
-                        )
-                        self.output_text.insert(
-                            tk.END, f"  サイズ比率: {size_ratio:.2%}\n"
+                        log(
+                            f"  最終サイズ: {final_size:.2f} MB, {final_width}x{final_height}px"
                         )
+                        log(f"  サイズ比率: {size_ratio:.2%}")
+                        log(f"  エンコード回数: {result.iterations}")
                     else:
                         # 処理失敗の場合、ログ出力
-                        self.output_text.insert(tk.END, f"処理失敗: {file}\n")
-                    self.output_text.see(tk.END)
+                        log(f"処理失敗: {file}")
                 except Exception as e:
                     # エラーが発生した場合、ログ出力
-                    self.output_text.insert(tk.END, f"エラー ({file}): {str(e)}\n")
-
-                # プログレスバーの値を更新
-                self.progress["value"] = (i + 1) * 100
-
-                # 処理が終わったファイルをリストから削除
-                self.master.after(0, lambda: self.file_listbox.delete(0))
-
-            # プログレスバーを100%にする
-            self.progress["value"] = self.progress["maximum"]
-            self.master.update_idletasks()
+                    log(f"エラー ({file}): {str(e)}")
+
+                # プログレスバーの値を更新し、処理が終わったファイルをリストから削除
+                done += 1
+                self.events.put(("progress", (i + 1) * 100))
+                self.events.put(("file_done", None))
+
+                # 一時停止中は待ち、キャンセルされた場合は残りのファイルを処理しない
+                wait_if_paused()
+                if self.cancel_event.is_set():
+                    break
+            if self.cancel_event.is_set():
+                # 処理中のジョブは中止され、未処理のファイルはジャーナルに残る
+                results.close()
+                log(
+                    f"キャンセルしました（未処理: {len(files) - done} 件）。"
+                    "次回の起動時に再開できます"
+                )
+                return
+            # すべて処理が終わったらジャーナルを削除する
+            self.journal.discard()
 
         # 画像処理スレッドを開始
         threading.Thread(target=process_images_thread, daemon=True).start()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 実行ファイル化した場合のワーカープロセス対策
     root = TkinterDnD.Tk()
     app = ImageProcessorApp(root)
     root.mainloop()
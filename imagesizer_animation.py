@@ -0,0 +1,428 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from imagesizer_core import (
+    DEFAULT_WORKERS,
+    MAX_ITERATIONS,
+    MAX_UPSCALE_RATIO,
+    MIN_QUALITY,
+    SizeSearch,
+    create_candidate_buffer,
+    pixel_target_size,
+)
+
+# アニメーション画像（GIF、アニメーションWebP）の処理
+# フレームは1枚ずつ順に読み込み、FRAME_CHUNK 枚ごとにスレッドで並列にクロップ、リサイズ、
+# 減色して、そのままエンコーダーに渡す。フル解像度のフレームを同時に持つのは FRAME_CHUNK
+# 枚までで、すべてのフレームを保持するのは、Pillowのエンコーダーが保存のために持つ出力の
+# フレームと、MB指定の探索で使う読み込み済みのフレーム（memory_limit_mb に収まる大きさに
+# 縮小したもの）のみ
+# 並列に処理するのはGILを解放するリサイズが主で、減色は高速な FASTOCTREE で行う
+
+# アニメーションとして処理する保存フォーマット
+ANIMATED_FORMATS = ("GIF", "WEBP")
+# 一度に並列に処理するフレーム数
+FRAME_CHUNK = 32
+# MB指定で目標に届かない場合に順に試す設定
+# GIFは (色数, 間引き)、WebPは (品質の下げ幅, 間引き)。間引きが2なら2フレームに1枚を残す
+GIF_SETTINGS = ((256, 1), (128, 1), (64, 2), (32, 3))
+WEBP_SETTINGS = ((0, 1), (25, 1), (50, 2), (50, 3))
+# サイズ比率がこれより小さくなる場合は、次の設定（色数や品質を下げ、フレームを間引く）を試す
+MIN_ANIMATION_SCALE = 0.5
+# 半透明のピクセルを透明とみなすアルファ値の境目（GIFは透明色を1色しか持てないため）
+ALPHA_THRESHOLD = 128
+
+
+# アニメーションとして処理する画像かどうかを判定する関数
+# （1フレームのGIFは通常の画像と同じく処理する）
+# （n_frames はGIFではすべてのフレームをデコードして数えるため、is_animated を使う）
+def is_animation(img):
+    return img.format in ANIMATED_FORMATS and getattr(img, "is_animated", False)
+
+
+# フレームを順に読み込み、(RGBAの画像, 表示時間, 破棄方法) を返すジェネレータ
+# 各フレームは前のフレームと合成済みの画面全体の画像になる
+def iter_frames(source):
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        for index in range(getattr(img, "n_frames", 1)):
+            img.seek(index)
+            yield (
+                img.convert("RGBA"),
+                img.info.get("duration", 0),
+                getattr(img, "disposal_method", None),  # GIFのみ
+            )
+
+
+# フレームを step 枚ごとに間引くジェネレータ
+# 間引いたフレームの表示時間は、直前に残したフレームに加える
+def drop_frames(frames, step):
+    kept = None
+    for index, (frame, duration, disposal) in enumerate(frames):
+        if index % step == 0:
+            if kept is not None:
+                yield tuple(kept)
+            kept = [frame, duration, disposal]
+        else:
+            kept[1] += duration
+    if kept is not None:
+        yield tuple(kept)
+
+
+# フレームをGIF用に指定の色数に減色する関数（透明な部分には専用の色を割り当てる）
+# 既定のメディアンカットはGILを保持したまま時間がかかるため、FASTOCTREE を使う
+# （同じ色数でメディアンカットより誤差が小さく、ファイルも小さくなる）
+def quantize_frame(frame, colors):
+    alpha = frame.getchannel("A")
+    rgb = frame.convert("RGB")
+    if alpha.getextrema()[0] >= ALPHA_THRESHOLD:
+        return rgb.quantize(colors, method=Image.Quantize.FASTOCTREE)
+    quantized = rgb.quantize(colors - 1, method=Image.Quantize.FASTOCTREE)
+    palette = quantized.getpalette()
+    palette += [0, 0, 0] * (colors - len(palette) // 3)
+    quantized.putpalette(palette[: colors * 3])
+    mask = alpha.point(lambda a: 255 if a < ALPHA_THRESHOLD else 0)
+    quantized.paste(colors - 1, mask=mask)
+    quantized.info["transparency"] = colors - 1
+    return quantized
+
+
+# 1フレームをクロップ、リサイズし、GIFの場合は減色する関数（スレッドで並列に呼ばれる）
+def render_frame(frame, crop_box, size, colors=None):
+    if crop_box is not None:
+        frame = frame.crop(crop_box)
+    if frame.size != size:
+        frame = frame.resize(size, Image.LANCZOS)
+    if colors:
+        frame = quantize_frame(frame, colors)
+    return frame
+
+
+# (フレーム, 表示時間, 破棄方法) を FRAME_CHUNK 枚ごとにスレッドで並列に render_frame で
+# 処理し、順に返すジェネレータ
+def render_frames(frames, crop_box, size, colors=None, max_threads=DEFAULT_WORKERS):
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        chunk = []
+
+        # たまったフレームを並列に処理する関数
+        def flush():
+            rendered = executor.map(
+                lambda item: render_frame(item[0], crop_box, size, colors), chunk
+            )
+            return [(frame,) + item[1:] for frame, item in zip(rendered, chunk)]
+
+        for item in frames:
+            chunk.append(item)
+            if len(chunk) >= FRAME_CHUNK:
+                yield from flush()
+                chunk = []
+        yield from flush()
+
+
+# すべてのフレームを読み込み、クロップして指定の大きさにしたリストを返す関数
+# MB指定の探索で、候補ごとにフレームをデコードし直さないために使う
+def load_frames(source, crop_box, size, max_threads=DEFAULT_WORKERS):
+    return list(render_frames(iter_frames(source), crop_box, size, None, max_threads))
+
+
+# 読み込み済みのフレームを保持する大きさ（幅と高さ）を返す関数
+# クロップ後の大きさを上限に、全フレームのRGBAが memory_limit_mb に収まるよう縮小する
+def cached_frame_size(width, height, frame_count, memory_limit_mb):
+    if memory_limit_mb is None:
+        return width, height
+    limit = memory_limit_mb * 1024 * 1024 / (width * height * 4 * frame_count)
+    scale = min(limit**0.5, 1.0)
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+
+# アニメーションを指定の設定で作ってバッファにエンコードする関数
+# source がリストの場合は、load_frames で読み込み済みのフレームを使う（crop_box はNone）
+# (バイト数, フレームの処理時間, エンコード時間) を返す
+def encode_animation(
+    source,
+    buffer,
+    image_format,
+    crop_box,
+    size,
+    colors=None,
+    quality=None,
+    step=1,
+    loop=None,
+    max_threads=DEFAULT_WORKERS,
+):
+    frames = source if isinstance(source, list) else iter_frames(source)
+    rendered = render_frames(
+        drop_frames(frames, step), crop_box, size, colors, max_threads
+    )
+    # 表示時間と破棄方法は、フレームをエンコーダーに渡すたびに追加する
+    # （Pillowはフレームを受け取ってからリストを参照する）
+    durations, disposals = [], []
+    render_seconds = 0.0
+
+    # 処理したフレームを1枚ずつエンコーダーに渡すジェネレータ
+    def output_frames():
+        nonlocal render_seconds
+        while True:
+            start = time.perf_counter()
+            item = next(rendered, None)
+            render_seconds += time.perf_counter() - start
+            if item is None:
+                break
+            frame, duration, disposal = item
+            durations.append(duration)
+            disposals.append(disposal)
+            yield frame
+        if "disposal" in options and len(set(disposals)) == 1:
+            # Pillowは同じ内容のフレームを1枚にまとめた場合（1フレームの場合を含む）に
+            # 破棄方法のリストを受け付けないため、すべて同じなら値に置き換える
+            # （すべてのフレームを渡し終えてから参照される）
+            first.encoderinfo["disposal"] = disposals[0]
+
+    start = time.perf_counter()
+    frame_iter = output_frames()
+    first = next(frame_iter)
+    # 表示時間、ループ回数、（GIFの場合は）破棄方法を元の画像から引き継ぐ
+    options = dict(save_all=True, append_images=frame_iter, duration=durations)
+    if loop is not None:
+        options["loop"] = loop
+    if image_format == "GIF":
+        if disposals[0] is not None:  # 元の画像がGIFの場合
+            options["disposal"] = disposals
+    else:
+        options["quality"] = quality
+    buffer.seek(0)
+    buffer.truncate()
+    first.save(buffer, format=image_format, **options)
+    encode_seconds = time.perf_counter() - start - render_seconds
+    return buffer.tell(), render_seconds, encode_seconds
+
+
+# アニメーション画像を処理する関数（process_image から呼ばれる）
+# 戻り値は process_image の本体と同じ (出力パス, サイズ比率, メッセージ)
+# max_mb は幅か高さの指定の出力のファイルサイズの上限（通常の画像と同じ）
+def process_animation(
+    source,
+    input_size,
+    crop_box,
+    output_folder,
+    name,
+    ext,
+    image_format,
+    original_size,
+    target_size,
+    operation,
+    size_type,
+    quality,
+    tolerance,
+    memory_limit_mb,
+    progress_callback,
+    metrics,
+    save_output,
+    max_mb=None,
+    max_threads=DEFAULT_WORKERS,
+):
+    if crop_box is None:
+        crop_box = (0, 0) + input_size
+    left, top, right, bottom = crop_box
+    cropped_width, cropped_height = right - left, bottom - top
+    if crop_box == (0, 0) + input_size:
+        crop_box = None
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        loop = img.info.get("loop")
+    # 探索で使う読み込み済みのフレームと、保持する大きさ（最初に必要になったときに決める）
+    cache = []
+    cache_size = None
+
+    # 指定の大きさの候補を読み込み済みのフレームから作るかどうかを返す関数
+    def uses_cache(size):
+        nonlocal cache_size
+        if cache_size is None:
+            # フレーム数はGIFではすべてのフレームをデコードして数えるため、ここで数える
+            with Image.open(
+                io.BytesIO(source) if isinstance(source, bytes) else source
+            ) as img:
+                frame_count = img.n_frames
+            cache_size = cached_frame_size(
+                cropped_width, cropped_height, frame_count, memory_limit_mb
+            )
+        return size[0] <= cache_size[0] and size[1] <= cache_size[1]
+
+    # 指定の設定でエンコードして記録し、バイト数を返す関数
+    # cached が真の場合、保持する大きさ以下の候補は読み込み済みのフレームから作る
+    def encode(buffer, scale, size, colors=None, quality=None, step=1, cached=False):
+        frames, frames_crop_box = source, crop_box
+        if cached and uses_cache(size):
+            if not cache:
+                cache.extend(load_frames(source, crop_box, cache_size, max_threads))
+            frames, frames_crop_box = cache, None
+        new_bytes, render_seconds, encode_seconds = encode_animation(
+            frames,
+            buffer,
+            image_format,
+            frames_crop_box,
+            size,
+            colors,
+            quality,
+            step,
+            loop,
+            max_threads,
+        )
+        metrics.iteration(
+            scale,
+            quality,
+            size,
+            render_seconds,
+            encode_seconds,
+            new_bytes,
+            colors=colors,
+            frame_step=step,
+        )
+        return new_bytes
+
+    # 出力パスを作る関数（通常の画像と同じ形式）
+    def output_path_for(size):
+        if size_type == "none":
+            return os.path.join(output_folder, f"{name}{ext}")
+        ratio = int(size[0] * size[1] / (cropped_width * cropped_height) * 100)
+        return os.path.join(output_folder, f"{name}_{ratio}%{ext}")
+
+    # 設定ごとにサイズ比率を探索し、目標を満たした候補を保存する関数
+    # 目標に届くサイズ比率が小さすぎる場合は、色数や品質を下げ、フレームを間引いて探索し直す
+    # max_scale と fixed_size は SizeSearch と同じ（サイズ比率の上限と、幅と高さを固定する場合の
+    # 大きさ）、first は最初に試す設定の番号。保存した場合は (出力パス, サイズ比率, None)、
+    # 目標に届かない場合はNoneを返す
+    def search_settings(
+        target_size_mb,
+        operation,
+        scale,
+        max_scale=MAX_UPSCALE_RATIO,
+        fixed_size=None,
+        first=0,
+    ):
+        settings = GIF_SETTINGS if image_format == "GIF" else WEBP_SETTINGS
+        settings = settings[first:]
+        if operation == "upscale":
+            settings = settings[:1]  # 拡大する場合は色数や品質を下げない
+        accepted = None  # 採用した (サイズ比率, 品質, 幅と高さ, 色数, 間引き)
+        with create_candidate_buffer(
+            memory_limit_mb
+        ) as buffer, create_candidate_buffer(
+            memory_limit_mb
+        ) as best_buffer, create_candidate_buffer(
+            memory_limit_mb
+        ) as accepted_buffer:
+            for round_index, (setting, step) in enumerate(settings):
+                colors = setting if image_format == "GIF" else None
+                round_quality = (
+                    max(quality - setting, MIN_QUALITY)
+                    if image_format == "WEBP"
+                    else None
+                )
+                search = SizeSearch(
+                    target_size_mb * 1024 * 1024,
+                    operation,
+                    (cropped_width, cropped_height),
+                    scale,
+                    quality,
+                    tolerance=tolerance,
+                    lossy=False,
+                    max_scale=max_scale,
+                    fixed_size=fixed_size,
+                )
+                while True:
+                    candidate = search.next_candidate()
+                    if candidate is None:
+                        break
+                    scale = candidate[0]
+                    size = search.dimensions(scale)
+                    new_bytes = encode(
+                        buffer, scale, size, colors, round_quality, step, cached=True
+                    )
+                    if progress_callback:
+                        progress_callback(
+                            (round_index + search.encodes / MAX_ITERATIONS)
+                            / len(settings)
+                        )
+                    if search.observe(scale, quality, new_bytes):
+                        buffer, best_buffer = best_buffer, buffer
+                if search.best is not None:
+                    # この設定で条件を満たした候補のうち、サイズ比率が最も大きいものを採用する
+                    scale = search.best[0]
+                    if accepted is None or scale > accepted[0]:
+                        size = search.dimensions(scale)
+                        accepted = (scale, round_quality, size, colors, step)
+                        best_buffer, accepted_buffer = accepted_buffer, best_buffer
+                    # サイズ比率が十分に大きいか上限に達した場合は、次の設定を試さない
+                    if scale >= min(MIN_ANIMATION_SCALE, max_scale):
+                        break
+
+            if accepted is None:
+                return None
+            scale, round_quality, size, colors, step = accepted
+            if uses_cache(size) and cache_size != (cropped_width, cropped_height):
+                # 縮小して保持したフレームから作った候補は2回リサイズしているため、
+                # 元のフレームから作り直す（目標を満たさなくなった場合は探索した候補を使う）
+                new_bytes = encode(buffer, scale, size, colors, round_quality, step)
+                if search.is_feasible(new_bytes):
+                    buffer, accepted_buffer = accepted_buffer, buffer
+            output_path = output_path_for(size)
+            save_output(accepted_buffer, output_path, scale, round_quality, size)
+            return output_path, scale, None
+
+    # GIFは256色、WebPは指定の品質で作る
+    full_colors = 256 if image_format == "GIF" else None
+    full_quality = quality if image_format == "WEBP" else None
+
+    if size_type != "mb":
+        # サイズ変更なし、または幅か高さの指定の場合は1回で作る（max_mb を超えた場合を除く）
+        if size_type == "none":
+            scale = 1.0
+            size = (cropped_width, cropped_height)
+        else:
+            size, scale = pixel_target_size(
+                cropped_width, cropped_height, size_type, target_size
+            )
+        with create_candidate_buffer(memory_limit_mb) as buffer:
+            new_bytes = encode(buffer, scale, size, full_colors, full_quality)
+            if (
+                max_mb is None
+                or size_type == "none"
+                or new_bytes <= max_mb * 1024 * 1024
+            ):
+                output_path = output_path_for(size)
+                save_output(buffer, output_path, scale, full_quality, size)
+                if progress_callback:
+                    progress_callback(1.0)  # プログレスバーを100%にする
+                return output_path, scale, None
+
+        # 上限を超えた場合は、まず幅と高さを保ったまま色数や品質を下げ、フレームを間引く
+        # （最初の設定は作ったばかりのため省く）。それでも超える場合は、指定の大きさを
+        # 上限として縮小しながら探索する
+        output = search_settings(
+            max_mb, "compress", scale, scale, fixed_size=size, first=1
+        )
+        if output is None:
+            output = search_settings(
+                max_mb,
+                "compress",
+                scale * (max_mb * 1024 * 1024 / new_bytes) ** 0.5,
+                max_scale=scale,
+            )
+    else:
+        # MB指定の場合は、クロップ後の元のファイルサイズから最初のサイズ比率を決める
+        target_size_mb = float(target_size)
+        if operation == "auto":
+            operation = "compress" if original_size > target_size_mb else "upscale"
+        cropped_size = original_size * (
+            (cropped_width * cropped_height) / (input_size[0] * input_size[1])
+        )
+        output = search_settings(
+            target_size_mb, operation, (target_size_mb / cropped_size) ** 0.5
+        )
+
+    if progress_callback:
+        progress_callback(1.0)  # プログレスバーを100%にする
+    if output is None:
+        return None, 0, "目標サイズに到達できませんでした"
+    return output
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFilter
+import PIL
+from imagesizer_core import process_image
+
+try:
+    import resource  # ピークRSSの計測に使う（Windowsにはない）
+except ImportError:
+    resource = None
+
+# crop_image / process_image のベンチマーク
+# 合成した画像で主なモードを実行し、スループット、レイテンシ、エンコード回数、ピークRSSを
+# JSONで出力する。--compare で以前の結果と比較できる
+
+# ベンチマーク用の画像の種類: 名前 -> (作成する関数名, 幅, 高さ, 枚数, 拡張子)
+DATASETS = {
+    "photo-jpeg": ("photo", 4000, 3000, 3, ".jpg"),
+    "flat-png": ("flat", 1920, 1080, 3, ".png"),
+    "huge-tiff": ("photo", 8000, 6000, 1, ".tiff"),
+    "small-jpeg": ("photo", 320, 240, 200, ".jpg"),
+}
+
+# 実行するモード: 名前 -> process_image の引数
+# target_factor を指定した場合、目標サイズは元のファイルサイズ（MB）の倍率になる
+SCENARIOS = {
+    "mb": dict(size_type="mb", target_factor=0.3, operation="auto", crop_type="none"),
+    "crop-square": dict(
+        size_type="mb", target_factor=0.3, operation="auto", crop_type="square"
+    ),
+    "crop-16:9": dict(
+        size_type="mb", target_factor=0.3, operation="auto", crop_type="16:9"
+    ),
+    "crop-4:3": dict(
+        size_type="mb", target_factor=0.3, operation="auto", crop_type="4:3"
+    ),
+    "crop-custom": dict(
+        size_type="mb",
+        target_factor=0.3,
+        operation="auto",
+        crop_type="custom",
+        aspect_ratio=(3.0, 2.0),
+    ),
+    "crop-smart": dict(
+        size_type="mb", target_factor=0.3, operation="auto", crop_type="smart"
+    ),
+    "width": dict(
+        size_type="width", target_size=1280, operation="auto", crop_type="none"
+    ),
+    "height": dict(
+        size_type="height", target_size=720, operation="auto", crop_type="none"
+    ),
+    "compress": dict(
+        size_type="mb", target_factor=0.5, operation="compress", crop_type="none"
+    ),
+    "upscale": dict(
+        size_type="mb", target_factor=2.0, operation="upscale", crop_type="none"
+    ),
+}
+
+
+# 写真のような画像（ぼかしたノイズとグラデーション）を作成する関数
+def make_photo(width, height, rng):
+    # 低解像度のノイズを拡大して、大きな模様を作る
+    small = (max(width // 16, 1), max(height // 16, 1))
+    channels = [
+        Image.frombytes("L", small, rng.randbytes(small[0] * small[1])).resize(
+            (width, height), Image.BICUBIC
+        )
+        for _ in range(3)
+    ]
+    img = Image.merge("RGB", channels).filter(ImageFilter.GaussianBlur(2))
+    # 細かいノイズを重ねて、センサーノイズのような質感を出す
+    grain = Image.frombytes("L", (width, height), rng.randbytes(width * height))
+    return Image.blend(img, Image.merge("RGB", [grain] * 3), 0.15)
+
+
+# 平坦な画像（スクリーンショットや図のような画像）を作成する関数
+def make_flat(width, height, rng):
+    img = Image.new("RGB", (width, height), (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x0, y0, x1, y1), fill=color)
+    return img
+
+
+# ベンチマーク用の画像を作成する関数
+def generate_dataset(name, directory, scale=1.0, seed=0):
+    kind, width, height, count, ext = DATASETS[name]
+    width, height = max(int(width * scale), 16), max(int(height * scale), 16)
+    # 同じ seed なら毎回同じ画像になるようにする
+    rng = random.Random(f"{seed}-{name}")
+    make = make_photo if kind == "photo" else make_flat
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for i in range(count):
+        path = os.path.join(directory, f"{name}-{i:04d}{ext}")
+        img = make(width, height, rng)
+        if ext == ".jpg":
+            img.save(path, quality=92)
+        else:
+            img.save(path)
+        files.append(path)
+    return files
+
+
+# 百分位数を計算する関数
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * p / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+# ピークRSS（MB）を取得する関数
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト、Linuxはキロバイト単位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# 1つのケース（画像の種類とモードの組）を実行する関数（別プロセスで実行される）
+def run_case(files, scenario, output_dir, repeat=1):
+    latencies = []
+    encodes = []
+    prediction_errors = []  # サイズの予測の誤差の絶対値
+    timings = {}  # 工程名 -> 合計時間（秒）
+    megapixels = 0.0
+    output_bytes = 0
+    failures = 0
+    os.makedirs(output_dir, exist_ok=True)
+    for _ in range(repeat):
+        for path in files:
+            job = dict(scenario)
+            factor = job.pop("target_factor", None)
+            if factor is not None:
+                job["target_size"] = os.path.getsize(path) / (1024 * 1024) * factor
+            start = time.perf_counter()
+            result = process_image(path, output_dir, **job)
+            latencies.append(time.perf_counter() - start)
+            width, height = result.input_size
+            megapixels += width * height / 1e6
+            encodes.append(result.iterations)
+            if result.prediction_error is not None:
+                prediction_errors.append(abs(result.prediction_error))
+            for name, seconds in result.timings.items():
+                timings[name] = timings.get(name, 0.0) + seconds
+            if result.output_path:
+                output_bytes += result.output_bytes
+                os.remove(result.output_path)
+            else:
+                failures += 1
+    elapsed = sum(latencies)
+    return dict(
+        images=len(latencies),
+        failures=failures,
+        elapsed_seconds=round(elapsed, 4),
+        images_per_second=round(len(latencies) / elapsed, 3) if elapsed else None,
+        megapixels_per_second=round(megapixels / elapsed, 3) if elapsed else None,
+        latency_ms=dict(
+            p50=round(percentile(latencies, 50) * 1000, 2),
+            p90=round(percentile(latencies, 90) * 1000, 2),
+            p99=round(percentile(latencies, 99) * 1000, 2),
+            max=round(max(latencies) * 1000, 2),
+        ),
+        encodes=dict(
+            mean=round(sum(encodes) / len(encodes), 2),
+            max=max(encodes),
+            total=sum(encodes),
+        ),
+        prediction_error=(
+            dict(
+                mean_abs=round(sum(prediction_errors) / len(prediction_errors), 4),
+                max_abs=round(max(prediction_errors), 4),
+                predicted=len(prediction_errors),
+            )
+            if prediction_errors
+            else None
+        ),
+        stage_seconds={name: round(s, 4) for name, s in sorted(timings.items())},
+        output_bytes=output_bytes,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+# 以前の結果と比較し、悪化したケースの一覧を返す関数
+def compare_results(baseline, current, threshold=0.1):
+    regressions = []
+    base_cases = {(c["dataset"], c["scenario"]): c for c in baseline["cases"]}
+    for case in current["cases"]:
+        base = base_cases.get((case["dataset"], case["scenario"]))
+        if base is None or not base["images_per_second"]:
+            continue
+        change = case["images_per_second"] / base["images_per_second"] - 1
+        line = (
+            f"{case['dataset']:>12} {case['scenario']:>12}: "
+            f"{base['images_per_second']:.3f} -> {case['images_per_second']:.3f} img/s "
+            f"({change:+.1%}), encodes {base['encodes']['mean']} -> "
+            f"{case['encodes']['mean']}"
+        )
+        print(line, file=sys.stderr)
+        if change < -threshold:
+            regressions.append(line)
+    return regressions
+
+
+# コマンドライン引数の解析器を作成する関数
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="imagesizer-bench",
+        description="ImageSizer のベンチマークを実行し、結果をJSONで出力します。",
+    )
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        choices=sorted(DATASETS),
+        default=sorted(DATASETS),
+        help="使用する画像の種類",
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="実行するモード",
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="画像の幅と高さの倍率")
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="画像を小さくして短時間で実行する（--scale 0.25 と同じ）",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="各ケースの繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0, help="画像を作成する乱数の種")
+    parser.add_argument(
+        "--work-dir", help="画像を作成するフォルダ（省略時は一時フォルダ）"
+    )
+    parser.add_argument(
+        "-o", "--output", help="結果を書き出すJSONファイル（省略時は標準出力）"
+    )
+    parser.add_argument("--compare", help="比較する以前の結果のJSONファイル")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="--compare で悪化とみなすスループットの低下率 (%%)",
+    )
+    return parser
+
+
+# ベンチマークのメイン関数
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    scale = 0.25 if args.quick else args.scale
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="imagesizer-bench-")
+    result = dict(
+        environment=dict(
+            python=platform.python_version(),
+            pillow=PIL.__version__,
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+        ),
+        settings=dict(scale=scale, repeat=args.repeat, seed=args.seed),
+        cases=[],
+    )
+    try:
+        for dataset in args.datasets:
+            print(f"画像を作成中: {dataset}", file=sys.stderr)
+            files = generate_dataset(
+                dataset, os.path.join(work_dir, dataset), scale, args.seed
+            )
+            for name in args.scenarios:
+                # ピークRSSをケースごとに計測するため、毎回新しいプロセスで実行する
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    case = executor.submit(
+                        run_case,
+                        files,
+                        SCENARIOS[name],
+                        os.path.join(work_dir, "out"),
+                        args.repeat,
+                    ).result()
+                case = dict(dataset=dataset, scenario=name, **case)
+                result["cases"].append(case)
+                print(
+                    f"{dataset:>12} {name:>12}: {case['images_per_second']} img/s, "
+                    f"{case['megapixels_per_second']} MP/s, "
+                    f"p50 {case['latency_ms']['p50']} ms, "
+                    f"encodes {case['encodes']['mean']}",
+                    file=sys.stderr,
+                )
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        # 以前の結果と比較し、悪化したケースがあれば終了コード1を返す
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_results(baseline, result, args.threshold / 100):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+# 処理結果のキャッシュ（元画像の内容のハッシュと処理パラメータをキーにする）
+
+# キャッシュの容量の既定値（MB）
+DEFAULT_CACHE_SIZE_MB = 1024
+# キャッシュの形式のバージョン（処理内容が変わった場合に上げて古い結果を使わないようにする）
+CACHE_VERSION = 1
+# 出力先に書き込み途中の一時ファイルの名前の先頭と末尾
+# （異常終了で残った場合に、再開時に見分けて削除できるようにする）
+TEMP_PREFIX = ".imagesizer-"
+TEMP_SUFFIX = ".tmp"
+
+
+# キャッシュフォルダの既定値を取得する関数
+def default_cache_dir():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "ImageSizer", "cache")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "imagesizer")
+
+
+# 新しく作るファイルのパーミッションを返す関数
+# （tempfile.mkstemp は所有者のみ読み書きできる0600で作るため、通常のファイルと同じく
+# umask を適用した値に変更して使う。umask は読み取るにも一度変更する必要があり、
+# 他のスレッドと競合しないよう、読み込み時に一度だけ取得する）
+def new_file_mode():
+    return _FILE_MODE
+
+
+def _read_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+_FILE_MODE = _read_file_mode()
+
+
+# データの内容のハッシュを計算する関数
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    # 出力画像をキャッシュフォルダに保存し、索引をSQLiteで管理するクラス
+    # 出力画像はサイズの上限を超えると古い順に削除するが、
+    # (サイズ比率, 品質) の記録は残し、次回は1回のエンコードで済むようにする
+    def __init__(
+        self, cache_dir=None, max_size_mb=DEFAULT_CACHE_SIZE_MB, link_outputs=False
+    ):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        # 出力先にハードリンクするかどうか（Falseの場合はコピーする）
+        self.link_outputs = link_outputs
+        self._connection = None
+
+    def __getstate__(self):
+        # ワーカープロセスに渡す場合は接続を除く（各プロセスで開き直す）
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        return state
+
+    @property
+    def blob_dir(self):
+        # 出力画像を保存するフォルダ
+        return os.path.join(self.cache_dir, "blobs")
+
+    def _connect(self):
+        # 索引のデータベースを開く（複数のプロセスから同時に使えるようにする）
+        if self._connection is None:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            connection = sqlite3.connect(
+                os.path.join(self.cache_dir, "index.sqlite3"), timeout=30
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    blob TEXT,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    output_tail TEXT NOT NULL,
+                    scale REAL NOT NULL,
+                    quality INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_source ON entries (source)"
+            )
+            connection.commit()
+            self._connection = connection
+            # 容量の上限が前回より小さくなっている場合に備えて削除しておく
+            self.evict()
+        return self._connection
+
+    def make_key(self, source_digest, params):
+        # 元画像のハッシュと処理パラメータからキーを作成
+        payload = json.dumps(
+            {"version": CACHE_VERSION, "source": source_digest, "params": params},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        # キーに対応する記録を辞書で返す（なければNone）
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT blob, bytes, output_tail, scale, quality FROM entries WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        blob, size, output_tail, scale, quality = row
+        if blob is not None and not os.path.exists(os.path.join(self.blob_dir, blob)):
+            # 出力画像が外部から削除されていた場合は記録だけを残す
+            blob, size = None, 0
+        with connection:
+            connection.execute(
+                "UPDATE entries SET blob = ?, bytes = ?, last_used = ? WHERE key = ?",
+                (blob, size, time.time(), key),
+            )
+        return {
+            "blob": blob and os.path.join(self.blob_dir, blob),
+            "bytes": size,
+            "output_tail": output_tail,
+            "scale": scale,
+            "quality": quality,
+        }
+
+    def store(self, key, source_digest, buffer, output_tail, scale, quality):
+        # 出力画像をキャッシュに保存し、上限を超えた分を削除する
+        connection = self._connect()
+        blob = key + os.path.splitext(output_tail)[1]
+        blob_path = os.path.join(self.blob_dir, blob)
+        fd, temp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+        try:
+            # ハードリンクした出力が他のユーザーからも読めるようにする
+            os.chmod(temp_path, new_file_mode())
+            with os.fdopen(fd, "wb") as temp_file:
+                buffer.seek(0)
+                shutil.copyfileobj(buffer, temp_file)
+                size = temp_file.tell()
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    source_digest,
+                    blob,
+                    size,
+                    output_tail,
+                    scale,
+                    quality,
+                    time.time(),
+                ),
+            )
+        self.evict()
+
+    def evict(self):
+        # 出力画像の合計サイズが上限を超えている場合、最後に使われたのが古い順に削除する
+        connection = self._connect()
+        with connection:
+            (total,) = connection.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM entries WHERE blob IS NOT NULL"
+            ).fetchone()
+            if total <= self.max_bytes:
+                return
+            rows = connection.execute(
+                "SELECT key, blob, bytes FROM entries WHERE blob IS NOT NULL "
+                "ORDER BY last_used"
+            ).fetchall()
+            for key, blob, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._remove_blob(blob)
+                connection.execute(
+                    "UPDATE entries SET blob = NULL, bytes = 0 WHERE key = ?", (key,)
+                )
+                total -= size
+
+    def invalidate(self, source_digest=None):
+        # 指定した元画像の記録を削除する（省略時はすべて削除する）
+        connection = self._connect()
+        with connection:
+            if source_digest is None:
+                rows = connection.execute("SELECT blob FROM entries").fetchall()
+                connection.execute("DELETE FROM entries")
+            else:
+                rows = connection.execute(
+                    "SELECT blob FROM entries WHERE source = ?", (source_digest,)
+                ).fetchall()
+                connection.execute(
+                    "DELETE FROM entries WHERE source = ?", (source_digest,)
+                )
+        for (blob,) in rows:
+            self._remove_blob(blob)
+        return len(rows)
+
+    def copy_to(self, entry, output_path):
+        # キャッシュの出力画像を出力先にコピーまたはハードリンクする（アトミックに置き換える）
+        output_dir = os.path.dirname(output_path) or "."
+        fd, temp_path = tempfile.mkstemp(
+            dir=output_dir, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX
+        )
+        os.close(fd)
+        try:
+            os.remove(temp_path)
+            linked = False
+            if self.link_outputs:
+                try:
+                    os.link(entry["blob"], temp_path)
+                    linked = True
+                except OSError:
+                    pass  # 別のドライブなどでハードリンクできない場合はコピーする
+            if not linked:
+                shutil.copyfile(entry["blob"], temp_path)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _remove_blob(self, blob):
+        # 出力画像のファイルを削除する
+        if blob is None:
+            return
+        try:
+            os.remove(os.path.join(self.blob_dir, blob))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,742 @@
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from imagesizer_cache import (
+    DEFAULT_CACHE_SIZE_MB,
+    ResultCache,
+    content_digest,
+)
+from imagesizer_core import (
+    DEFAULT_MEMORY_LIMIT_MB,
+    DEFAULT_TOLERANCE,
+    DEFAULT_WORKERS,
+    CROP_TYPES,
+    SIZE_TYPES,
+    default_job_memory_budget_mb,
+    parse_variant,
+    process_batch,
+)
+from imagesizer_distributed import (
+    DEFAULT_HEARTBEAT_TIMEOUT,
+    Coordinator,
+    DistributedWorker,
+    WorkerRejected,
+    start_local_workers,
+)
+from imagesizer_intake import path_key, scan_directory
+from imagesizer_journal import (
+    FINISHED_STATES,
+    PENDING,
+    BatchJournal,
+    remove_stale_temp_files,
+)
+from imagesizer_metrics import JsonLinesLogger, ProcessingCancelled
+from imagesizer_pipeline import (
+    DEFAULT_PREFETCH,
+    DEFAULT_PREFETCH_MEMORY_MB,
+    process_pipeline,
+)
+from imagesizer_smartcrop import smart_crop_available
+from imagesizer_watch import (
+    DEFAULT_POLL_INTERVAL,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_SETTLE_SECONDS,
+    HotFolderWatcher,
+)
+
+# ImageSizer のコマンドライン版（tkinter と tkinterdnd2 を読み込まない）
+
+
+# 入力に指定されたファイル、フォルダ、ワイルドカードを画像ファイルのリストに展開する関数
+def expand_inputs(inputs, recursive=False):
+    files = []
+    seen = set()  # 重複を除くためのセット
+    for pattern in inputs:
+        # ワイルドカードを展開（一致しない場合はそのまま扱う）
+        matches = sorted(glob.glob(pattern, recursive=recursive)) or [pattern]
+        for path in matches:
+            if os.path.isdir(path):
+                # フォルダの場合は中の画像ファイルを追加
+                # （壊れたファイルもエラーとして報告するため、先頭のバイト列は確認しない）
+                candidates = scan_directory(path, recursive, check_signature=False)
+            else:
+                candidates = [path]
+            for candidate in candidates:
+                key = path_key(candidate)
+                if key not in seen:
+                    seen.add(key)
+                    files.append(candidate)
+    return files
+
+
+# "16:9" 形式の縦横比を解析する関数
+def parse_aspect_ratio(text):
+    try:
+        width, height = (float(v) for v in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("縦横比は 幅:高さ の形式で指定してください")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("縦横比には正の数を指定してください")
+    return width, height
+
+
+# バリアントの指定を解析する関数（argparse 用）
+def parse_variant_arg(text):
+    try:
+        return parse_variant(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+# コマンドライン引数の解析器を作成する関数
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="imagesizer",
+        description="画像のクロップとサイズ調整を一括で行います。",
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="画像ファイル、フォルダ、またはワイルドカード"
+    )
+    parser.add_argument(
+        "-r", "--recursive", action="store_true", help="フォルダを再帰的に探索する"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="出力フォルダ（省略時は元のファイルと同じフォルダ）",
+    )
+    parser.add_argument(
+        "--crop",
+        choices=CROP_TYPES,
+        default="none",
+        help="クロップ設定（smart は被写体を含む位置を画像の内容から選ぶ）",
+    )
+    parser.add_argument(
+        "--aspect",
+        type=parse_aspect_ratio,
+        help="カスタム比率（例: 3:2）。指定すると --crop custom になる"
+        "（--crop smart の場合はスマートクロップの比率。省略時は正方形）",
+    )
+    parser.add_argument(
+        "--size-type",
+        choices=SIZE_TYPES,
+        default="mb",
+        help="目標サイズの指定方法",
+    )
+    parser.add_argument(
+        "--target", type=float, default=2, help="目標サイズ（MBまたはピクセル）"
+    )
+    parser.add_argument(
+        "--max-mb",
+        type=float,
+        help="幅か高さの指定（--variant を含む）の出力のファイルサイズの上限 (MB)。"
+        "超える場合は幅と高さを保ったまま品質を下げ、それでも超える場合は縮小する",
+    )
+    parser.add_argument(
+        "--variant",
+        dest="variants",
+        action="append",
+        type=parse_variant_arg,
+        metavar="CROP:SIZE",
+        help="1回のデコードで作る出力（例: none:width=1920, square:width=640, "
+        "16:9:mb=1.5, custom=3:2:none, smart=3:2:width=1080）。複数指定すると --crop、--size-type、"
+        "--target の代わりに使う",
+    )
+    parser.add_argument(
+        "--operation",
+        choices=["auto", "compress", "upscale"],
+        default="auto",
+        help="拡大・縮小モード",
+    )
+    parser.add_argument("--quality", type=int, default=85, help="JPEGの品質")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE * 100,
+        help="MB指定時の許容誤差 (%%)",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=DEFAULT_WORKERS, help="並列数"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=DEFAULT_PREFETCH,
+        help="先読みするファイル数。読み込みと書き込みを処理と並行して行う"
+        "（0で無効）",
+    )
+    parser.add_argument(
+        "--prefetch-memory-mb",
+        type=float,
+        default=DEFAULT_PREFETCH_MEMORY_MB,
+        help="先読みした画像と書き込み待ちの画像に使うメモリの上限 (MB)",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=float,
+        help="同時に処理する画像のデコードなどに使うメモリの予算 (MB)。"
+        "ヘッダーから推定したメモリの合計が予算に収まる分だけ並列に処理し、"
+        "単独でも収まらない画像は縮小済みの中間画像を使って処理する"
+        "（省略時は物理メモリの半分、0で無効）",
+    )
+    parser.add_argument(
+        "--memory-limit-mb",
+        type=float,
+        default=DEFAULT_MEMORY_LIMIT_MB,
+        help="候補画像をメモリ上に保持する上限 (MB)",
+    )
+    parser.add_argument(
+        "--no-fast-decode",
+        dest="fast_decode",
+        action="store_false",
+        help="JPEGのドラフトモードと reduce() による縮小済み中間画像を使わない",
+    )
+    parser.add_argument(
+        "--fast-search",
+        action="store_true",
+        help="MB指定の探索中は高速な設定でエンコードし、最終出力の設定での"
+        "エンコードを減らす（大きなPNGで効果がある）",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="処理結果のキャッシュを使い、処理済みの画像を再処理しない",
+    )
+    parser.add_argument("--cache-dir", help="キャッシュフォルダ")
+    parser.add_argument(
+        "--cache-size-mb",
+        type=float,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help="キャッシュの容量 (MB)。超えた分は最後に使われたのが古い順に削除する",
+    )
+    parser.add_argument(
+        "--link-cached",
+        action="store_true",
+        help="キャッシュの出力画像をコピーせずにハードリンクする",
+    )
+    parser.add_argument(
+        "--invalidate-cache",
+        action="store_true",
+        help="入力画像のキャッシュを削除する（入力を省略した場合はすべて削除する）",
+    )
+    parser.add_argument(
+        "--journal",
+        help="ファイルごとの処理の状態を記録するファイル。同じ処理内容で実行し直すと、"
+        "完了していないファイルだけを処理する",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="JOURNAL",
+        help="ジャーナルに記録された処理内容で、完了していないファイルだけを処理する"
+        "（入力と処理内容の指定は不要）",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="入力フォルダを監視し、追加された画像を順次処理する（--output-dir が必要）",
+    )
+    parser.add_argument(
+        "--watch-state",
+        help="監視モードで処理済みのファイルを記録するファイル"
+        "（省略時は出力フォルダの .imagesizer_watch.jsonl）",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="監視フォルダを走査する間隔（秒）",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=DEFAULT_SETTLE_SECONDS,
+        help="サイズと更新日時が変わらなければ書き込み完了とみなすまでの時間（秒）",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="監視モードの処理待ちキューの長さ",
+    )
+    parser.add_argument(
+        "--coordinator",
+        metavar="ADDRESS",
+        help="ジョブを配るコーディネーターとして ADDRESS（ホスト:ポート か unix:パス）で"
+        "待ち受け、--worker で接続したワーカーに処理させる",
+    )
+    parser.add_argument(
+        "--worker",
+        metavar="ADDRESS",
+        help="ADDRESS のコーディネーターに接続するワーカーとして動作する"
+        "（入力と処理内容の指定は不要。並列数は -j、キャッシュは --cache で指定）",
+    )
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help="コーディネーターと同じマシンで起動するワーカー数（それぞれ -j の並列数）。"
+        "--coordinator を省略した場合は一時的なUnixソケットで待ち受ける",
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("IMAGESIZER_TOKEN"),
+        help="コーディネーターとワーカーで共有するトークン"
+        "（省略時は環境変数 IMAGESIZER_TOKEN）",
+    )
+    parser.add_argument(
+        "--heartbeat-timeout",
+        type=float,
+        default=DEFAULT_HEARTBEAT_TIMEOUT,
+        help="ハートビートがこの時間（秒）届かないワーカーのジョブを配り直す",
+    )
+    parser.add_argument(
+        "--summary",
+        help="処理結果をJSON Lines形式で書き出すファイル（- で標準出力）",
+    )
+    parser.add_argument(
+        "--events",
+        help="工程ごとの時間と探索の各回の結果をJSON Lines形式で追記するファイル",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        metavar="PATTERN",
+        help="ファイル名がパターン（例: *.tiff）に一致する画像を cProfile と "
+        "tracemalloc で計測する（複数指定可）",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default="profiles",
+        help="--profile の結果を書き出すフォルダ",
+    )
+    return parser
+
+
+# 出力ごとの処理結果（ImageResult）を辞書にまとめる関数
+def result_fields(result):
+    return dict(
+        output=result.output_path,
+        size_ratio=result.size_ratio,
+        message=result.message,
+        input_bytes=result.input_bytes,
+        input_size=result.input_size,
+        output_bytes=result.output_bytes,
+        output_size=result.output_size,
+    )
+
+
+# ファイルごとの処理結果を辞書にまとめる関数
+def make_record(job, result, stats, error):
+    record = {"type": "file", "input": job["input_path"], "status": "done"}
+    if isinstance(error, ProcessingCancelled):
+        record["status"] = "cancelled"
+    elif error is not None:
+        record.update(status="error", error=f"{type(error).__name__}: {error}")
+    elif isinstance(result, list):
+        # バリアントの場合は出力ごとの結果をまとめる
+        record["outputs"] = [result_fields(r) for r in result]
+        if any(r.output_path is None for r in result):
+            record["status"] = "failed"
+    else:
+        record.update(result_fields(result))
+        if result.output_path is None:
+            record["status"] = "failed"
+    record.update(stats)
+    return record
+
+
+# 処理結果の書き出し先を開く関数
+def open_summary(path):
+    if path == "-":
+        return sys.stdout
+    if path:
+        return open(path, "w", encoding="utf-8")
+    return None
+
+
+# 処理結果を1行のJSONとして書き出す関数
+def write_record(summary, record):
+    if summary:
+        summary.write(json.dumps(record, ensure_ascii=False) + "\n")
+        summary.flush()
+
+
+# ジャーナルを使う場合に処理するジョブを返す関数
+# ジャーナルの処理内容が同じ場合は完了したファイルを除き（前回になかったファイルは
+# 追加する）、異なる場合やジャーナルがない場合は新しく記録を始める
+def journaled_jobs(journal, options, jobs):
+    if not journal.matches(options):
+        journal.start(options, jobs)
+        return jobs
+    remaining = []
+    for job in jobs:
+        record = journal.jobs.get(job["input_path"])
+        if record is None:
+            journal.mark(job["input_path"], PENDING, output_folder=job["output_folder"])
+        elif record["status"] in FINISHED_STATES:
+            continue
+        remaining.append(job)
+    # 前回書き込み途中で終了した一時ファイルを削除する
+    remove_stale_temp_files(job["output_folder"] for job in remaining)
+    print(
+        f"ジャーナルから再開します: 未処理 {len(remaining)} 件（全 {len(jobs)} 件）",
+        file=sys.stderr,
+    )
+    return remaining
+
+
+# Ctrl+C で処理をキャンセルするハンドラーを設定する関数（元のハンドラーを返す）
+# 1回目はキャンセルのイベントをセットし、2回目は KeyboardInterrupt で強制終了する
+def install_cancel_handler(cancel_event):
+    def on_interrupt(signum, frame):
+        if cancel_event.is_set():
+            raise KeyboardInterrupt
+        cancel_event.set()
+        print(
+            "キャンセルしています（もう一度 Ctrl+C で強制終了します）",
+            file=sys.stderr,
+        )
+
+    return signal.signal(signal.SIGINT, on_interrupt)
+
+
+# ワーカーとして動作する関数（コーディネーターが終了するか、Ctrl+C で終了する）
+def run_worker(args, cache):
+    memory_budget_mb = args.memory_budget_mb
+    if memory_budget_mb is None:
+        memory_budget_mb = default_job_memory_budget_mb()
+    worker = DistributedWorker(
+        args.worker,
+        args.workers,
+        token=args.token,
+        cache=cache,
+        job_memory_budget_mb=memory_budget_mb or None,
+    )
+
+    # サービスとして停止された場合（SIGTERM）も、Ctrl+C と同じく処理中のジョブを中止し、
+    # プロセスプールを終了してから終了する（ジョブはコーディネーターが配り直す）
+    def on_terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, on_terminate)
+    print(f"ワーカーを開始しました: {worker.name} -> {args.worker}", file=sys.stderr)
+    try:
+        worker.run()
+    except WorkerRejected as e:
+        print(f"エラー: コーディネーターに拒否されました: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    print("ワーカーを終了しました", file=sys.stderr)
+    return 0
+
+
+# 分散処理のワーカーごとの集計を表示する関数
+def print_worker_metrics(worker_metrics):
+    for name, metrics in sorted(worker_metrics.items()):
+        print(
+            f"  {name}: {metrics['jobs']} 件, エラー {metrics['errors']} 件, "
+            f"配り直し {metrics['lost']} 件, 取り上げ {metrics['stolen']} 件, "
+            f"処理時間 {metrics['busy_seconds']:.1f} 秒",
+            file=sys.stderr,
+        )
+
+
+# 監視モードを実行する関数（Ctrl+C で停止する）
+def run_watch(args, watch_dirs, options, events):
+    summary = open_summary(args.summary)
+
+    # 処理結果を表示して書き出す関数（ワーカーの完了時に呼ばれる）
+    def on_result(path, result, stats, error):
+        record = make_record({"input_path": path}, result, stats, error)
+        print(f"{record['status']}: {path}", file=sys.stderr)
+        write_record(summary, record)
+
+    watcher = HotFolderWatcher(
+        watch_dirs,
+        args.output_dir,
+        options,
+        state_path=args.watch_state,
+        recursive=args.recursive,
+        poll_interval=args.poll_interval,
+        settle_seconds=args.settle_seconds,
+        queue_size=args.queue_size,
+        max_workers=args.workers,
+        on_result=on_result,
+        event_callback=events,
+    )
+    print(f"監視を開始しました: {', '.join(watch_dirs)}", file=sys.stderr)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        print("監視を停止しました", file=sys.stderr)
+    finally:
+        if summary and summary is not sys.stdout:
+            summary.close()
+        if events:
+            events.close()
+    return 0
+
+
+# コマンドライン版のメイン関数
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    crop_type = args.crop
+    if args.aspect and crop_type != "smart":
+        crop_type = "custom"
+    if crop_type == "custom" and args.aspect is None:
+        print("エラー: --crop custom には --aspect が必要です", file=sys.stderr)
+        return 2
+    if args.max_mb is not None and args.max_mb <= 0:
+        print("エラー: --max-mb には正の数を指定してください", file=sys.stderr)
+        return 2
+    crop_types = [v["crop_type"] for v in args.variants or ()] or [crop_type]
+    if "smart" in crop_types and not smart_crop_available():
+        print("エラー: スマートクロップには NumPy が必要です", file=sys.stderr)
+        return 2
+
+    files = expand_inputs(args.inputs, recursive=args.recursive)
+
+    cache = None
+    if args.cache or args.invalidate_cache:
+        cache = ResultCache(args.cache_dir, args.cache_size_mb, args.link_cached)
+    if args.invalidate_cache:
+        # キャッシュを削除して終了
+        if args.inputs:
+            removed = 0
+            for file in files:
+                with open(file, "rb") as f:
+                    removed += cache.invalidate(content_digest(f.read()))
+        else:
+            removed = cache.invalidate()
+        print(f"キャッシュを削除しました: {removed} 件", file=sys.stderr)
+        return 0
+    if args.worker:
+        return run_worker(args, cache)
+
+    # 全ファイル共通の処理内容
+    if args.variants:
+        # バリアントの指定がある場合は1回のデコードで複数の出力を作る
+        options = dict(variants=args.variants)
+    else:
+        options = dict(
+            target_size=args.target if args.size_type != "none" else None,
+            size_type=args.size_type,
+            crop_type=crop_type,
+            aspect_ratio=args.aspect,
+        )
+    options.update(
+        operation=args.operation,
+        quality=args.quality,
+        memory_limit_mb=args.memory_limit_mb,
+        tolerance=args.tolerance / 100,
+        fast_decode=args.fast_decode,
+        fast_search=args.fast_search,
+        cache=cache,
+    )
+    if args.max_mb is not None:
+        options.update(max_mb=args.max_mb)
+
+    if args.watch:
+        # 監視モードの場合は入力をフォルダとして監視する
+        if not args.output_dir:
+            print("エラー: --watch には --output-dir が必要です", file=sys.stderr)
+            return 2
+        watch_dirs = [path for path in args.inputs if os.path.isdir(path)]
+        if len(watch_dirs) != len(args.inputs):
+            print(
+                "エラー: --watch の入力にはフォルダを指定してください", file=sys.stderr
+            )
+            return 2
+        if any(
+            os.path.abspath(path) == os.path.abspath(args.output_dir)
+            for path in watch_dirs
+        ):
+            # 出力が新しい入力として処理され続けるため
+            print(
+                "エラー: --output-dir には監視フォルダ以外のフォルダを指定してください",
+                file=sys.stderr,
+            )
+            return 2
+        events = JsonLinesLogger(args.events) if args.events else None
+        return run_watch(args, watch_dirs, options, events)
+
+    journal = None
+    if args.resume:
+        # ジャーナルに記録された処理内容で、完了していないファイルを処理する
+        journal = BatchJournal(args.resume)
+        if journal.options is None:
+            print(f"エラー: ジャーナルを読み込めません: {args.resume}", file=sys.stderr)
+            return 2
+        jobs = [
+            dict(journal.options, cache=cache, **job) for job in journal.unfinished()
+        ]
+        remove_stale_temp_files(job["output_folder"] for job in jobs)
+        print(
+            f"ジャーナルから再開します: 未処理 {len(jobs)} 件"
+            f"（全 {len(journal.jobs)} 件）",
+            file=sys.stderr,
+        )
+    else:
+        if not files:
+            print("エラー: 処理する画像ファイルが見つかりません", file=sys.stderr)
+            return 2
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+
+        # ファイルごとの処理内容を作成
+        jobs = [
+            dict(
+                options,
+                input_path=file,
+                output_folder=args.output_dir or os.path.dirname(file) or ".",
+            )
+            for file in files
+        ]
+        if args.journal:
+            journal = BatchJournal(args.journal)
+            jobs = journaled_jobs(journal, options, jobs)
+
+    coordinator = None
+    local_workers = []
+    socket_dir = None
+    # コーディネーターとしてワーカーに処理させるかどうか
+    distributed = bool(args.coordinator) or args.local_workers > 0
+    if distributed:
+        if args.profile:
+            print("エラー: --profile は分散処理と同時に指定できません", file=sys.stderr)
+            return 2
+        address = args.coordinator
+        if not address:
+            socket_dir = tempfile.mkdtemp(prefix="imagesizer-")
+            address = "unix:" + os.path.join(socket_dir, "coordinator.sock")
+
+    summary = open_summary(args.summary)
+    events = JsonLinesLogger(args.events) if args.events else None
+    counts = {"done": 0, "failed": 0, "error": 0, "cancelled": 0}
+    # Ctrl+C で処理中のファイルもエンコードの1回以内に中止する
+    cancel_event = multiprocessing.Event()
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        previous_handler = install_cancel_handler(cancel_event)
+    start = time.perf_counter()
+    try:
+        if distributed:
+            # ワーカーにジョブを配り、完了した順に書き出す
+            coordinator = Coordinator(
+                address,
+                token=args.token,
+                heartbeat_timeout=args.heartbeat_timeout,
+                event_callback=events,
+            )
+            coordinator.start()
+            print(f"ワーカーの接続を待っています: {address}", file=sys.stderr)
+            if args.local_workers > 0:
+                # 同じマシンのワーカーはメモリの予算を等分する
+                worker_budget_mb = args.memory_budget_mb
+                if worker_budget_mb is None:
+                    worker_budget_mb = default_job_memory_budget_mb()
+                if worker_budget_mb:
+                    worker_budget_mb /= args.local_workers
+                local_workers = start_local_workers(
+                    address,
+                    args.local_workers,
+                    args.workers,
+                    token=args.token,
+                    job_memory_budget_mb=worker_budget_mb or None,
+                )
+        # 並列に処理し、完了したものから入力順に書き出す
+        # （先読みする場合は読み込みと書き込みを別スレッドで処理と並行して行う）
+        memory_budget_mb = args.memory_budget_mb
+        if memory_budget_mb is None:
+            memory_budget_mb = default_job_memory_budget_mb()
+        batch_options = dict(
+            max_workers=args.workers,
+            job_memory_budget_mb=memory_budget_mb or None,
+            event_callback=events,
+            profile_patterns=args.profile,
+            profile_dir=args.profile_dir,
+            cancel_event=cancel_event,
+            start_callback=journal.mark_running if journal else None,
+        )
+        if coordinator is not None:
+            results = coordinator.process(
+                jobs,
+                cancel_event=cancel_event,
+                start_callback=batch_options["start_callback"],
+            )
+        elif args.prefetch > 0:
+            results = process_pipeline(
+                jobs,
+                prefetch=args.prefetch,
+                memory_budget_mb=args.prefetch_memory_mb,
+                **batch_options,
+            )
+        else:
+            results = process_batch(jobs, **batch_options)
+        for i, job, result, stats, error in results:
+            record = make_record(job, result, stats, error)
+            counts[record["status"]] += 1
+            if journal:
+                journal.record_result(job, result, error)
+            print(
+                f"[{i + 1}/{len(jobs)}] {record['status']}: {job['input_path']}",
+                file=sys.stderr,
+            )
+            write_record(summary, record)
+        if cancel_event.is_set():
+            # 投入しなかったファイルもキャンセルとして数える
+            finished = counts["done"] + counts["failed"] + counts["error"]
+            counts["cancelled"] = len(jobs) - finished
+            print(
+                f"キャンセルしました（未処理: {counts['cancelled']} 件）",
+                file=sys.stderr,
+            )
+            if journal:
+                print(
+                    f"--resume {journal.path} で再開できます",
+                    file=sys.stderr,
+                )
+        # 全体の集計を書き出す
+        totals = dict(
+            type="summary",
+            files=len(jobs),
+            elapsed_seconds=round(time.perf_counter() - start, 3),
+            **counts,
+        )
+        if coordinator is not None:
+            totals["workers"] = coordinator.worker_metrics
+            print_worker_metrics(coordinator.worker_metrics)
+        write_record(summary, totals)
+    finally:
+        if coordinator is not None:
+            coordinator.close()  # ワーカーに終了を伝える
+        for process in local_workers:
+            process.join()
+        if socket_dir is not None:
+            os.rmdir(socket_dir)
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+        if summary and summary is not sys.stdout:
+            summary.close()
+        if events:
+            events.close()
+
+    # キャンセルした場合は130（Ctrl+C で終了した場合の慣例）、
+    # 失敗したファイルがある場合は終了コード1を返す
+    if counts["cancelled"]:
+        return 130
+    return 1 if counts["failed"] or counts["error"] else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 実行ファイル化した場合のワーカープロセス対策
+    sys.exit(main())
@@ -0,0 +1,1959 @@
+import io
+import os
+import time
+import zlib
+import fnmatch
+import tempfile
+import shutil
+import math
+import signal
+import contextlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from imagesizer_cache import TEMP_PREFIX, TEMP_SUFFIX, content_digest, new_file_mode
+from imagesizer_metrics import FileMetrics, ProcessingCancelled, run_profiled
+from imagesizer_smartcrop import find_crop_box, proxy_size, smart_crop_available
+
+# ImageSizer の画像処理部分（GUIに依存しないため、ライブラリやCLIから利用できる）
+
+# 候補画像をメモリ上に保持する上限（MB）。これを超えるとディスクに退避する
+DEFAULT_MEMORY_LIMIT_MB = 64
+# MB指定時の目標サイズに対する許容誤差（割合）
+DEFAULT_TOLERANCE = 0.05
+# 目標サイズ探索の最大エンコード回数
+MAX_ITERATIONS = 20
+# 品質の下限と上限
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+# 拡大時のサイズ比率の上限
+MAX_UPSCALE_RATIO = 10.0
+# 並列処理のワーカー数の既定値
+DEFAULT_WORKERS = os.cpu_count() or 1
+# 中間画像の大きさの下限（出力の何倍以上を保つか）
+MIN_INTERMEDIATE_RATIO = 2
+# 中間画像を作るときの余裕（探索で出力が大きくなっても作り直さずに済むように）
+INTERMEDIATE_HEADROOM = 1.5
+# 処理対象の画像の拡張子
+SUPPORTED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".gif", ".webp")
+# 品質を指定できる（探索で品質も調整する）拡張子
+LOSSY_EXTENSIONS = (".jpg", ".jpeg", ".webp")
+# サイズの予測に使う縮小画像（プロキシ）のピクセル数（この2倍未満の画像では予測しない）
+PROXY_PIXELS = 256 * 1024
+# サイズ比率だけでは目標に届かない場合に、品質の予測で試す品質の変化量
+PROXY_QUALITY_STEP = 15
+# 探索中に高速な設定でエンコードする保存フォーマット（それ以外は設定による差がない）
+FAST_SEARCH_FORMATS = ("JPEG", "PNG")
+# 探索中のPNGの圧縮レベル（最終出力は optimize=True で最大の圧縮をかける）
+FAST_PNG_COMPRESS_LEVEL = 1
+# 最終出力のバイト数 / 高速な設定でのバイト数 の初期値（フォーマットごと）
+# 実際の比率は画像によって大きく異なるため、処理したファイルの実測値で更新する
+DEFAULT_CORRECTION = {"JPEG": 0.96, "PNG": 0.9}
+# 補正係数の実測値を反映する割合（指数移動平均）
+CORRECTION_SMOOTHING = 0.3
+# ジョブのピークメモリの推定で見込む、デコードした画像の枚数
+# （デコード結果、クロップ結果、リサイズした候補）
+JOB_MEMORY_COPIES = 3
+# 同時に実行するジョブのメモリの予算の既定値（物理メモリに対する割合）
+DEFAULT_JOB_MEMORY_FRACTION = 0.5
+# スマートクロップの評価用の縮小画像を大きなデコード済みの画像から作る場合に、先に
+# 間引く大きさ（評価用の大きさに対する倍率）。すべてのピクセルを読まずに済む
+SMART_SAMPLE_RATIO = 4
+# 帯状に読み込みながら縮小する場合に、一度に読み込む帯の大きさの目安（MB）
+STRIP_BAND_MB = 32
+# 帯状に読み込みながら縮小できる画像のモード（reduce() が使えるもの）
+STRIP_MODES = ("L", "LA", "RGB", "RGBA", "CMYK")
+# クロップ設定とサイズの指定方法の種類
+CROP_TYPES = ("none", "square", "16:9", "4:3", "custom", "smart")
+SIZE_TYPES = ("none", "mb", "width", "height")
+
+
+# クロップ範囲を計算する関数（画像をデコードせずに幅と高さだけで計算する）
+def get_crop_box(width, height, crop_type, aspect_ratio=None):
+    # クロップタイプに応じて処理を分岐
+    if crop_type == "square":
+        # 正方形にクロップ
+        size = min(width, height)  # 幅と高さの小さい方を取得
+        left = (width - size) // 2  # 左端の座標
+        top = (height - size) // 2  # 上端の座標
+        right = left + size  # 右端の座標
+        bottom = top + size  # 下端の座標
+    elif crop_type == "custom":
+        # カスタム比率でクロップ
+        if aspect_ratio is None:
+            # 比率が指定されていない場合はクロップしない
+            return None
+        target_ratio = aspect_ratio[0] / aspect_ratio[1]  # 目標比率を計算
+        if width / height > target_ratio:
+            # 幅の方が比率的に大きい場合
+            new_width = int(height * target_ratio)  # 新しい幅を計算
+            left = (width - new_width) // 2  # 左端の座標
+            right = left + new_width  # 右端の座標
+            top, bottom = 0, height  # 上端と下端はそのまま
+        else:
+            # 高さの方が比率的に大きい場合
+            new_height = int(width / target_ratio)  # 新しい高さを計算
+            top = (height - new_height) // 2  # 上端の座標
+            bottom = top + new_height  # 下端の座標
+            left, right = 0, width  # 左端と右端はそのまま
+    elif crop_type == "smart":
+        # スマートクロップ（比率が指定されていない場合は正方形）
+        # ここでは中央の範囲を返し、位置は process_image で画像の内容から選び直す
+        return get_crop_box(width, height, "custom", aspect_ratio or (1, 1))
+    elif crop_type == "16:9":
+        # 16:9 比率でクロップ
+        target_ratio = 16 / 9  # 16:9 の比率
+        if width / height > target_ratio:
+            # 幅の方が比率的に大きい場合
+            new_width = int(height * target_ratio)  # 新しい幅を計算
+            left = (width - new_width) // 2  # 左端の座標
+            right = left + new_width  # 右端の座標
+            top, bottom = 0, height  # 上端と下端はそのまま
+        else:
+            # 高さの方が比率的に大きい場合
+            new_height = int(width / target_ratio)  # 新しい高さを計算
+            top = (height - new_height) // 2  # 上端の座標
+            bottom = top + new_height  # 下端の座標
+            left, right = 0, width  # 左端と右端はそのまま
+    elif crop_type == "4:3":
+        # 4:3 比率でクロップ
+        target_ratio = 4 / 3  # 4:3 の比率
+        if width / height > target_ratio:
+            # 幅の方が比率的に大きい場合
+            new_width = int(height * target_ratio)  # 新しい幅を計算
+            left = (width - new_width) // 2  # 左端の座標
+            right = left + new_width  # 右端の座標
+            top, bottom = 0, height  # 上端と下端はそのまま
+        else:
+            # 高さの方が比率的に大きい場合
+            new_height = int(width / target_ratio)  # 新しい高さを計算
+            top = (height - new_height) // 2  # 上端の座標
+            bottom = top + new_height  # 下端の座標
+            left, right = 0, width  # 左端と右端はそのまま
+    else:
+        # クロップタイプが不正な場合はクロップしない
+        return None
+
+    # クロップ範囲を返す
+    return left, top, right, bottom
+
+
+# 画像をクロップする関数
+def crop_image(img, crop_type, aspect_ratio=None):
+    # 画像の幅と高さからクロップ範囲を計算
+    box = get_crop_box(img.size[0], img.size[1], crop_type, aspect_ratio)
+    if box is None:
+        # クロップしない場合はそのまま返す
+        return img
+    # 指定された範囲で画像をクロップ
+    return img.crop(box)
+
+
+# 幅か高さの指定から、出力の (幅, 高さ) とサイズ比率を返す関数
+# 指定した方の寸法は目標と一致させ、もう一方は縦横比を保って丸める
+# （目標の寸法に合わせるため、拡大・縮小モードには関係なく同じ大きさになる）
+def pixel_target_size(width, height, size_type, target_size):
+    target = int(target_size)
+    if size_type == "width":
+        scale = target / width
+        return (target, max(int(round(height * scale)), 1)), scale
+    scale = target / height
+    return (max(int(round(width * scale)), 1), target), scale
+
+
+# 拡張子から保存フォーマットを取得する関数
+def get_save_format(ext):
+    # Pillowに登録されている拡張子とフォーマットの対応表から取得
+    return Image.registered_extensions().get(ext.lower())
+
+
+# 候補バッファを作成する関数
+def create_candidate_buffer(memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+    # 上限までメモリ上に保持し、超えた場合は一時ファイルに退避するバッファ
+    if memory_limit_mb is None:
+        max_size = 0  # 0は無制限（常にメモリ上に保持）
+    else:
+        max_size = max(int(memory_limit_mb * 1024 * 1024), 1)
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+# 画像をバッファにエンコードする関数
+def encode_image(img, buffer, image_format, **save_options):
+    # 前回の候補を破棄してバッファを再利用する
+    if image_format == "GIF" and img.mode == "RGBA":
+        # 透明な部分があるGIFは、アニメーションのフレームと同じく透明色を割り当てて減色する
+        # （imagesizer_animation は imagesizer_core を使うため、ここで読み込む）
+        from imagesizer_animation import quantize_frame
+
+        img = quantize_frame(img, 256)
+    buffer.seek(0)
+    buffer.truncate()
+    img.save(buffer, format=image_format, **save_options)
+    # 書き込んだバイト数を返す
+    return buffer.tell()
+
+
+# 補正係数の推定値（プロセスごとに、処理したファイルの実測値から更新する）
+_correction_estimates = dict(DEFAULT_CORRECTION)
+
+
+# 保存フォーマットごとのエンコード設定を返す関数（fast の場合は探索用の高速な設定）
+def get_encode_options(image_format, quality, fast=False):
+    if image_format == "JPEG":
+        if fast:
+            return dict(quality=quality)  # ハフマン符号の最適化を省く
+        return dict(quality=quality, optimize=True)
+    if image_format == "PNG" and fast:
+        return dict(compress_level=FAST_PNG_COMPRESS_LEVEL)
+    if image_format == "WEBP":
+        return dict(quality=quality)
+    return dict(optimize=True)
+
+
+# バッファの内容を出力先にアトミックに書き込む関数
+def write_atomic(buffer, output_path):
+    # 出力先と同じフォルダに一時ファイルを作成し、書き込み後に置き換える
+    output_dir = os.path.dirname(output_path) or "."
+    fd, temp_path = tempfile.mkstemp(
+        dir=output_dir, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX
+    )
+    try:
+        # mkstemp は0600で作るため、通常のファイルと同じパーミッションにする
+        os.chmod(temp_path, new_file_mode())
+        with os.fdopen(fd, "wb") as temp_file:
+            buffer.seek(0)
+            shutil.copyfileobj(buffer, temp_file)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        # 途中で失敗した場合は書きかけのファイルを残さない
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# MB指定の目標サイズを (サイズ比率, 品質) の組で探索するクラス
+class SizeSearch:
+    # 観測したバイト数から挟み込み（ブラケット）を作り、割線法と二分法で次の候補を決める
+    def __init__(
+        self,
+        target_bytes,
+        operation,
+        base_size,
+        initial_scale,
+        quality,
+        tolerance=DEFAULT_TOLERANCE,
+        lossy=True,
+        max_encodes=MAX_ITERATIONS,
+        scale_slope=2.0,
+        max_scale=MAX_UPSCALE_RATIO,
+        fixed_size=None,
+    ):
+        self.target_bytes = target_bytes  # 目標バイト数
+        self.operation = operation  # "compress" または "upscale"
+        self.base_size = base_size  # クロップ後の幅と高さ
+        self.tolerance = tolerance  # 許容誤差
+        self.lossy = lossy  # 品質を調整できるフォーマットかどうか
+        self.max_encodes = max_encodes  # 最大エンコード回数
+        # 観測が1つの場合に外挿に使う、サイズ比率の対数に対する対数バイト数の傾き
+        self.scale_slope = scale_slope
+        # fixed_size を指定した場合は、その幅と高さ（サイズ比率は initial_scale）のまま
+        # 品質のみを探索する
+        self.fixed_size = fixed_size
+        # サイズ比率の範囲（1px未満にならないように、拡大しすぎないように）
+        self.min_scale = 1 / min(base_size)
+        self.max_scale = max_scale
+        if fixed_size is not None:
+            self.min_scale = self.max_scale = initial_scale
+        # 狙うバイト数（許容範囲の中央）の対数
+        if operation == "compress":
+            aim = target_bytes * (1 - tolerance / 2)
+        else:
+            aim = target_bytes * (1 + tolerance / 2)
+        self.log_aim = math.log(aim)
+        self.phase = "scale"  # 最初はサイズ比率を探索し、限界に達したら品質を探索する
+        self.history = []  # 観測結果 (サイズ比率, 品質, バイト数) のリスト
+        self.tried = set()  # 試した (幅, 高さ, 品質) の組
+        self.best = None  # 条件を満たした最良の候補
+        self.done = False
+        self._next = (self._clamp_scale(initial_scale), quality)
+
+    @property
+    def encodes(self):
+        # これまでのエンコード回数
+        return len(self.history)
+
+    def dimensions(self, scale):
+        # サイズ比率から出力する幅と高さを計算
+        if self.fixed_size is not None:
+            return self.fixed_size
+        width, height = self.base_size
+        return max(int(width * scale), 1), max(int(height * scale), 1)
+
+    def is_feasible(self, size):
+        # 目標サイズの条件を満たしているかどうか
+        if self.operation == "compress":
+            return size <= self.target_bytes
+        return size >= self.target_bytes
+
+    def is_within_tolerance(self, size):
+        # 目標サイズの許容誤差内に収まっているかどうか
+        if self.operation == "compress":
+            return size >= self.target_bytes * (1 - self.tolerance)
+        return size <= self.target_bytes * (1 + self.tolerance)
+
+    def next_candidate(self):
+        # 次にエンコードする (サイズ比率, 品質) を返す。探索終了ならNone
+        if self.done or self.encodes >= self.max_encodes:
+            return None
+        return self._next
+
+    def observe(self, scale, quality, size):
+        # エンコード結果を記録し、最良の候補が更新された場合はTrueを返す
+        self.history.append((scale, quality, size))
+        self.tried.add(self.dimensions(scale) + (quality,))
+        improved = False
+        if self.is_feasible(size):
+            if self.best is None or (
+                size > self.best[2]
+                if self.operation == "compress"
+                else size < self.best[2]
+            ):
+                self.best = (scale, quality, size)
+                improved = True
+            if self.is_within_tolerance(size):
+                # 許容誤差内に到達したら探索終了
+                self.done = True
+                return improved
+        self._next = self._propose()
+        if self._next is None:
+            self.done = True
+        elif self.dimensions(self._next[0]) + (self._next[1],) in self.tried:
+            # 同じ候補を再度試しても結果は変わらないので探索終了
+            self.done = True
+        return improved
+
+    def _propose(self):
+        # 観測結果から次の候補を決める
+        if self.phase == "scale":
+            quality = self._next[1]
+            points = [
+                (math.log(s), math.log(b)) for s, q, b in self.history if q == quality
+            ]
+            x = self._solve(points, self.scale_slope, slope_range=(0.5, 4.0))
+            scale = self._clamp_scale(math.exp(x))
+            if self._at_exhausted_bound(scale, quality):
+                # サイズ比率が限界に達した場合、品質の探索に切り替える
+                if not self.lossy:
+                    return None
+                self.phase = "quality"
+                self._bound_scale = scale
+            else:
+                return scale, quality
+        # 品質の探索（サイズ比率は限界値で固定）
+        points = [
+            (q, math.log(b)) for s, q, b in self.history if s == self._bound_scale
+        ]
+        x = self._solve(points, prior_slope=0.03, slope_range=(0.005, 0.2))
+        quality = min(max(int(round(x)), MIN_QUALITY), MAX_QUALITY)
+        return self._bound_scale, quality
+
+    def _at_exhausted_bound(self, scale, quality):
+        # 限界のサイズ比率を既に試して、それでも条件を満たさなかったかどうか
+        if scale not in (self.min_scale, self.max_scale):
+            return False
+        return any(
+            s == scale and q == quality and not self.is_feasible(b)
+            for s, q, b in self.history
+        )
+
+    def _solve(self, points, prior_slope, slope_range):
+        # 対数バイト数が狙いの値になる変数の値を推定する
+        below = [p for p in points if p[1] < self.log_aim]
+        above = [p for p in points if p[1] >= self.log_aim]
+        if below and above:
+            # 挟み込みができている場合は割線法、外れた場合は二分法
+            lo = max(below)
+            hi = min(above)
+            if lo[0] < hi[0] and hi[1] > lo[1]:
+                x = lo[0] + (self.log_aim - lo[1]) * (hi[0] - lo[0]) / (hi[1] - lo[1])
+                if lo[0] < x < hi[0]:
+                    return x
+            return (lo[0] + hi[0]) / 2
+        # 片側しか観測がない場合は、これまでの候補から当てはめた傾きで外挿する
+        slope = prior_slope
+        xs = {p[0] for p in points}
+        if len(xs) >= 2:
+            mean_x = sum(p[0] for p in points) / len(points)
+            mean_y = sum(p[1] for p in points) / len(points)
+            sxx = sum((p[0] - mean_x) ** 2 for p in points)
+            sxy = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points)
+            slope = min(max(sxy / sxx, slope_range[0]), slope_range[1])
+        nearest = min(points, key=lambda p: abs(p[1] - self.log_aim))
+        return nearest[0] + (self.log_aim - nearest[1]) / slope
+
+    def _clamp_scale(self, scale):
+        # サイズ比率を範囲内に収める
+        return min(max(scale, self.min_scale), self.max_scale)
+
+
+# 非圧縮の画像を帯状に読み込みながらクロップして 1/factor に縮小する関数
+# フル解像度の画像を一度に持たずに済む。対応していない形式の場合はNoneを返す
+def read_reduced(source, crop_box, factor):
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    with img:
+        # 全体が1つの非圧縮のデータ（非圧縮のTIFFやBMP）の場合のみ対応する
+        if len(img.tile) != 1 or img.mode not in STRIP_MODES:
+            return None
+        codec, extents, offset, args = img.tile[0]
+        if codec != "raw" or tuple(extents) != (0, 0) + img.size:
+            return None
+        if not isinstance(args, tuple) or len(args) != 3:
+            return None
+        rawmode, stride, orientation = args
+        width, height = img.size
+        if not stride:
+            stride = len(Image.new(img.mode, (width, 1)).tobytes("raw", rawmode))
+        left, top, right, bottom = crop_box
+        output = Image.new(
+            img.mode, (-(-(right - left) // factor), -(-(bottom - top) // factor))
+        )
+        # 帯の行数は factor の倍数にする（帯の境目で縮小の区切りがずれないように）
+        band = STRIP_BAND_MB * 1024 * 1024 // (stride * factor)
+        band = max(band, 1) * factor
+        for y in range(top, bottom, band):
+            rows = min(band, bottom - y)
+            # 下から上に並んでいる場合（BMP）はファイル内の位置が逆になる
+            first = y if orientation > 0 else height - y - rows
+            img.fp.seek(offset + first * stride)
+            data = img.fp.read(rows * stride)
+            strip = Image.frombytes(
+                img.mode, (width, rows), data, "raw", rawmode, stride, orientation
+            )
+            strip = strip.crop((left, 0, right, rows)).reduce(factor)
+            output.paste(strip, (0, (y - top) // factor))
+        return output
+
+
+# スマートクロップの位置の評価に使う、元画像全体の縮小画像を返す関数
+# 通常は ResizeSource がリサイズのためにデコードした画像から作るため、これを使うのは
+# 共有のデコード済み画像（decode）、アニメーションの最初のフレーム、low_memory で
+# 非圧縮の画像を帯状に読み込みながら縮小する場合のみ
+def load_smart_proxy(img, image_source, decode=None, low_memory=False):
+    size = proxy_size(*img.size)
+    image = None
+    if decode is not None:
+        image = decode()
+    elif low_memory:
+        factor = min(img.size[0] // size[0], img.size[1] // size[1])
+        if factor >= 2:
+            image = read_reduced(image_source, (0, 0) + img.size, factor)
+    if image is None:
+        img.load()
+        image = img
+    return reduce_for_proxy(image)
+
+
+# デコード済みの元画像全体（縮小率は問わない）から、スマートクロップの評価に使う
+# 縮小画像を作る関数
+def reduce_for_proxy(image):
+    size = proxy_size(*image.size)
+    sample = (size[0] * SMART_SAMPLE_RATIO, size[1] * SMART_SAMPLE_RATIO)
+    if image.width >= sample[0] * 2 and image.height >= sample[1] * 2:
+        # 評価用の大きさより十分に大きい場合は、間引いてから縮小する
+        return image.resize(sample, Image.NEAREST).resize(size, Image.BOX)
+    # reduce() が使えないモード（16ビットのグレースケールなど）はそのまま縮小する
+    reducing_gap = 2.0 if image.mode in STRIP_MODES + ("P", "1", "I", "F") else None
+    return image.resize(size, Image.BOX, reducing_gap=reducing_gap)
+
+
+# 画像を LANCZOS と reduce() で縮小できるモードに変換する関数
+# パレットと2値の画像はそのままでは最近傍でしか縮小できないため、RGB（透明色があれば
+# RGBA）とグレースケールに変換する（保存時はPillowが保存フォーマットに合わせて戻す）
+def resizable_image(image):
+    if image.mode in ("P", "PA"):
+        has_alpha = image.mode == "PA" or "transparency" in image.info
+        return image.convert("RGBA" if has_alpha else "RGB")
+    if image.mode == "1":
+        return image.convert("L")
+    return image
+
+
+# クロップ後の画像を、縮小済みの中間画像を経由してリサイズするクラス
+class ResizeSource:
+    # 大きく縮小する場合は、JPEGのドラフトモード（DCTスケーリング）や reduce() で
+    # 中間画像を作ってキャッシュし、最後の LANCZOS はその中間画像から行う
+    # 中間画像は縮小率ごとに保持し、より小さい中間画像は既存の中間画像から段階的に作る
+    # （複数のスレッドから同時に使える）
+    # smart_crop を指定した場合、crop_box は大きさだけが決まった仮の範囲で、位置は最初に
+    # デコードした元画像全体から決める（評価用の縮小画像のために別にデコードしない）
+    def __init__(
+        self,
+        img,
+        input_path,
+        crop_box=None,
+        fast_decode=True,
+        metrics=None,
+        decode=None,
+        low_memory=False,
+        smart_crop=False,
+    ):
+        self.img = img  # 開いただけでデコードしていない画像
+        # 再デコードが必要な場合に開き直すパス（読み込み済みの場合はバイト列）
+        self.input_path = input_path
+        self.crop_box = crop_box or (0, 0) + img.size  # フル解像度でのクロップ範囲
+        left, top, right, bottom = self.crop_box
+        self.size = (right - left, bottom - top)  # フル解像度でのクロップ後の幅と高さ
+        # デコード済みのフル解像度の画像を返す関数（複数の出力でデコードを共有する場合）
+        self.decode = decode
+        # low_memory の場合は、フル解像度の画像を使わずに済むよう必ず中間画像を使い、
+        # 非圧縮の画像は帯状に読み込みながら縮小する
+        self.low_memory = low_memory and decode is None
+        # ドラフトモードはJPEGでのみ使える（デコードを共有する場合は使わない）
+        self.fast_decode = fast_decode or self.low_memory
+        self.use_draft = self.fast_decode and img.format == "JPEG" and decode is None
+        # 工程ごとの時間の記録先
+        self.metrics = metrics or FileMetrics(input_path)
+        self._smart_pending = smart_crop  # スマートクロップの位置がまだ決まっていないか
+        self._img_used = False  # self.img をデコードに使ったかどうか
+        self._full = None  # フル解像度のクロップ画像
+        self._intermediates = {}  # 縮小率 -> 中間画像
+        self._lock = threading.Lock()
+        self._local = threading.local()  # スレッドごとの直前の LANCZOS の時間
+
+    @property
+    def last_resize_seconds(self):
+        # このスレッドでの直前の LANCZOS の時間（デコードは含まない）
+        return getattr(self._local, "resize_seconds", 0.0)
+
+    def resize(self, size):
+        # 指定した幅と高さにリサイズした画像を返す
+        if self.needs_full(size):
+            image = self.full()
+        else:
+            image = self._intermediate(size, self._max_factor(size))
+        start = time.perf_counter()
+        resized = resizable_image(image).resize(size, Image.LANCZOS)
+        self._local.resize_seconds = time.perf_counter() - start
+        return resized
+
+    def needs_full(self, size):
+        # 指定した幅と高さへのリサイズにフル解像度の画像を使うかどうか
+        return not self.fast_decode or self._max_factor(size) < 2
+
+    def full(self):
+        # フル解像度のクロップ画像を返す
+        with self._lock:
+            return self._load_full()
+
+    def _intermediate(self, size, factor):
+        # 縮小率 factor 以下の中間画像を返す（なければ作る）
+        with self._lock:
+            build_factor = max(self._max_factor(size, INTERMEDIATE_HEADROOM), 2)
+            usable = [f for f in self._intermediates if f <= factor]
+            if usable and build_factor // max(usable) < 2:
+                # 既存の中間画像からさらに半分以下に縮小できない場合はそれを使う
+                return self._intermediates[max(usable)]
+            built_factor, image = self._build(build_factor)
+            self._intermediates[built_factor] = image
+            return image
+
+    def _max_factor(self, size, headroom=1.0):
+        # 中間画像が出力の MIN_INTERMEDIATE_RATIO 倍未満にならない最大の縮小率
+        ratio = MIN_INTERMEDIATE_RATIO * headroom
+        return int(
+            min(self.size[0] / (ratio * size[0]), self.size[1] / (ratio * size[1]))
+        )
+
+    def _open(self):
+        # まだ使っていなければ開いた画像を、使った後ならファイルを開き直して返す
+        if not self._img_used:
+            self._img_used = True
+            return self.img
+        if isinstance(self.input_path, bytes):
+            return Image.open(io.BytesIO(self.input_path))
+        return Image.open(self.input_path)
+
+    def _place_crop(self, image=None):
+        # スマートクロップの位置を決める（ロックを取得してから、クロップする前に呼ぶ）
+        # image はデコード済みの元画像全体。None の場合は評価用の縮小画像を別に読み込む
+        if not self._smart_pending:
+            return
+        self._smart_pending = False
+        with self.metrics.stage("smart_crop"):
+            if image is None:
+                proxy = load_smart_proxy(
+                    self.img, self.input_path, low_memory=self.low_memory
+                )
+            else:
+                proxy = reduce_for_proxy(image)
+            self.crop_box = find_crop_box(proxy, *self.img.size, self.crop_box)
+
+    def _load_full(self):
+        # フル解像度のクロップ画像を返す（ロックを取得してから呼ぶ）
+        if self._full is None and self.decode is not None:
+            # 共有のデコード済み画像からクロップする
+            decoded = self.decode()
+            self._place_crop(decoded)
+            with self.metrics.stage("crop"):
+                self._full = decoded.crop(self.crop_box)
+        elif self._full is None:
+            img = self._open()
+            try:
+                with self.metrics.stage("decode"):
+                    img.load()
+                self._place_crop(img)
+                with self.metrics.stage("crop"):
+                    self._full = img.crop(self.crop_box)
+            finally:
+                if img is not self.img:
+                    img.close()
+        return self._full
+
+    def _build(self, factor):
+        # 縮小率 factor 以下の中間画像を作り、(実際の縮小率, 画像) を返す
+        if factor < 2:
+            return 1, self._load_full()
+        usable = [f for f in self._intermediates if factor // f >= 2]
+        draft_factor = 1
+        if usable:
+            # 既存の中間画像のうち最も小さいものから縮小する
+            draft_factor = max(usable)
+            image = self._intermediates[draft_factor]
+        elif self._full is None and self.low_memory and not self.use_draft:
+            # 非圧縮の画像は帯状に読み込みながら縮小する（対応していない形式はNone）
+            # クロップ範囲だけを読み込むため、スマートクロップの位置は先に決める
+            self._place_crop()
+            with self.metrics.stage("decode"):
+                image = read_reduced(self.input_path, self.crop_box, factor)
+            if image is not None:
+                return factor, image
+            image = self._load_full()
+        elif self._full is not None or not self.use_draft:
+            # フル解像度の画像から縮小する
+            image = self._load_full()
+        else:
+            # ドラフトモードで 1/2, 1/4, 1/8 のいずれかに縮小しながらデコードする
+            img = self._open()
+            try:
+                width, height = img.size
+                with self.metrics.stage("decode"):
+                    img.draft(img.mode, (-(-width // factor), -(-height // factor)))
+                    img.load()
+                self._place_crop(img)
+                scale = img.size[0] / width
+                box = tuple(
+                    min(int(round(v * scale)), limit)
+                    for v, limit in zip(self.crop_box, img.size * 2)
+                )
+                with self.metrics.stage("crop"):
+                    image = img.crop(box)
+                draft_factor = max(int(round(1 / scale)), 1)
+            finally:
+                if img is not self.img:
+                    img.close()
+        # 残りの縮小率を reduce() で適用する
+        remaining = factor // draft_factor
+        if remaining >= 2:
+            with self.metrics.stage("reduce"):
+                image = resizable_image(image).reduce(remaining)
+            return draft_factor * remaining, image
+        return draft_factor, image
+
+
+class ImageResult:
+    # 1枚の画像（またはバリアント）の処理結果
+    # 従来どおり (出力パス, サイズ比率, メッセージ) のタプルとしても展開できる
+    __slots__ = (
+        "input_path",
+        "output_path",
+        "size_ratio",
+        "message",
+        "input_bytes",
+        "input_size",
+        "output_bytes",
+        "output_size",
+        "scale",
+        "quality",
+        "iterations",
+        "timings",
+        "total_seconds",
+        "cache",
+        "prediction_error",
+        "data",
+    )
+
+    def __init__(
+        self, input_path, output_path=None, size_ratio=0, message=None, **info
+    ):
+        self.input_path = input_path  # 元画像のパス
+        self.output_path = output_path  # 出力画像のパス（失敗した場合はNone）
+        self.size_ratio = size_ratio  # サイズ比率
+        self.message = message  # メッセージ（スキップや失敗の理由）
+        self.input_bytes = info.get("input_bytes")  # 元画像のバイト数
+        self.input_size = info.get("input_size")  # 元画像の (幅, 高さ)
+        self.output_bytes = info.get("output_bytes")  # 出力画像のバイト数
+        self.output_size = info.get("output_size")  # 出力画像の (幅, 高さ)
+        self.scale = info.get("scale")  # 採用したサイズ比率
+        self.quality = info.get("quality")  # 採用した品質
+        self.iterations = info.get("iterations", 0)  # エンコード回数
+        self.timings = info.get("timings", {})  # 工程名 -> 時間（秒）
+        self.total_seconds = info.get("total_seconds")  # 処理全体の時間（秒）
+        self.cache = info.get("cache")  # キャッシュの利用（"hit"、"hint"、None）
+        # サイズの予測の誤差（最初の候補のバイト数 / 予測したバイト数 - 1、予測しない場合はNone）
+        self.prediction_error = info.get("prediction_error")
+        # 出力画像のバイト列（return_data を指定し、memory_limit_mb に収まる場合のみ。
+        # 書き込み後はNone）
+        self.data = info.get("data")
+
+    def __iter__(self):
+        return iter((self.output_path, self.size_ratio, self.message))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return (
+            f"ImageResult({self.input_path!r}, {self.output_path!r}, "
+            f"{self.size_ratio!r}, {self.message!r})"
+        )
+
+    def as_dict(self):
+        # 辞書に変換する（JSONへの書き出し用のため、出力画像のバイト列は除く）
+        return {name: getattr(self, name) for name in self.__slots__ if name != "data"}
+
+
+# 処理結果のタプルと記録から ImageResult を作る関数
+def _make_result(input_path, result, written, metrics, stats):
+    output_path, size_ratio, message = result
+    summary = metrics.finish(
+        stats,
+        output_path,
+        scale=written.get("scale"),
+        quality=written.get("quality"),
+        nbytes=written.get("output_bytes"),
+    )
+    if output_path is None:
+        # 出力がない場合は出力画像の情報を残さない
+        for key in ("scale", "quality", "output_bytes", "output_size", "data"):
+            written.pop(key, None)
+    return ImageResult(
+        input_path,
+        output_path,
+        size_ratio,
+        message,
+        iterations=summary["encodes"],
+        timings=summary["timings"],
+        total_seconds=summary["total_seconds"],
+        prediction_error=summary.get("prediction_error"),
+        **written,
+    )
+
+
+# 画像を処理する関数
+# 戻り値は ImageResult（(出力パス, サイズ比率, メッセージ) として展開できる）
+def process_image(
+    input_path,
+    output_folder,
+    target_size,
+    operation,
+    size_type,
+    crop_type,
+    aspect_ratio=None,
+    quality=85,
+    progress_callback=None,
+    memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB,
+    tolerance=DEFAULT_TOLERANCE,
+    stats=None,
+    fast_decode=True,
+    cache=None,
+    event_callback=None,
+    source_bytes=None,
+    return_data=False,
+    fast_search=False,
+    low_memory=False,
+    cancel_event=None,
+    max_mb=None,
+):
+    # 工程ごとの時間とイテレーションごとの結果を記録する
+    # （stats に集計を書き込み、event_callback にはイベントを順次渡す）
+    # source_bytes を指定すると、ファイルを読み込まずにそのバイト列を元画像として使う
+    # return_data を指定すると、出力画像を書き込まずに ImageResult.data として返す
+    # （memory_limit_mb を超えてディスクに退避した出力画像は、メモリに読み込まずに書き込む）
+    # fast_search の場合、MB指定の探索中は高速な設定でエンコードし、最終出力のみ最適化する
+    # low_memory の場合、フル解像度の画像を持たずに済むよう縮小済みの中間画像を使う
+    # cancel_event がセットされると、エンコードの1回ごとの確認で ProcessingCancelled を送出する
+    # max_mb を指定すると、幅か高さの指定の出力がそのMB数を超えないようにする
+    # （超える場合は幅と高さを保ったまま品質を下げ、それでも超える場合は縮小する）
+    metrics = FileMetrics(input_path, event_callback, cancel_event=cancel_event)
+    written = {}  # 元画像と書き込んだ出力の情報（ImageResult の属性名 -> 値）
+    try:
+        metrics.check_cancelled()  # 開始前にキャンセルされていれば読み込まない
+        result = _process_image(
+            input_path,
+            output_folder,
+            target_size,
+            operation,
+            size_type,
+            crop_type,
+            aspect_ratio,
+            quality,
+            progress_callback,
+            memory_limit_mb,
+            tolerance,
+            stats,
+            fast_decode,
+            cache,
+            metrics,
+            written,
+            source_bytes,
+            return_data,
+            fast_search=fast_search,
+            low_memory=low_memory,
+            max_mb=max_mb,
+        )
+    except ProcessingCancelled:
+        raise  # キャンセルのイベントは送信済み
+    except Exception as e:
+        metrics.emit("error", error=f"{type(e).__name__}: {e}")
+        raise
+    return _make_result(input_path, result, written, metrics, stats)
+
+
+# 画像を処理する関数の本体
+def _process_image(
+    input_path,
+    output_folder,
+    target_size,
+    operation,
+    size_type,
+    crop_type,
+    aspect_ratio,
+    quality,
+    progress_callback,
+    memory_limit_mb,
+    tolerance,
+    stats,
+    fast_decode,
+    cache,
+    metrics,
+    written,
+    source_bytes=None,
+    return_data=False,
+    shared=None,
+    fast_search=False,
+    low_memory=False,
+    max_mb=None,
+):
+    # shared を指定した場合は、開いた画像とデコード結果を他のバリアントと共有する
+    # ファイル名と拡張子を取得
+    base_name = os.path.basename(input_path)  # ファイル名
+    stem, ext = os.path.splitext(base_name)  # ファイル名と拡張子
+    if crop_type == "smart" and not smart_crop_available():
+        # 中央でのクロップを "_smart" の名前で出力しないように、処理せずに失敗にする
+        return None, 0, "スマートクロップには NumPy が必要です"
+
+    # 出力画像を書き込まずに返すかどうかを返す関数（nbytes は出力画像のバイト数）
+    # memory_limit_mb を超えてディスクに退避した出力画像は、メモリに読み込まずにここで書き込む
+    def returns_data(nbytes):
+        if not return_data:
+            return False
+        return memory_limit_mb is None or nbytes <= memory_limit_mb * 1024 * 1024
+
+    # キャッシュを使う場合は元画像を一度だけ読み込み、内容のハッシュからキーを作る
+    image_source = input_path if source_bytes is None else source_bytes
+    cache_entry = None
+    if cache is not None:
+        if shared is not None:
+            image_source, source_digest = shared.data, shared.digest
+        else:
+            if source_bytes is None:
+                with metrics.stage("read"), open(input_path, "rb") as f:
+                    image_source = f.read()
+            source_digest = content_digest(image_source)
+        cache_key = cache.make_key(
+            source_digest,
+            dict(
+                ext=ext.lower(),
+                crop_type=crop_type,
+                aspect_ratio=list(aspect_ratio) if aspect_ratio else None,
+                size_type=size_type,
+                target_size=target_size,
+                operation=operation,
+                quality=quality,
+                tolerance=tolerance,
+                fast_decode=fast_decode,
+                fast_search=fast_search,
+                # 上限を指定しない場合は以前のキーと同じにする
+                **(dict(max_mb=max_mb) if max_mb is not None else {}),
+            ),
+        )
+        cache_entry = cache.lookup(cache_key)
+        if cache_entry is not None and cache_entry["blob"] is not None:
+            # 処理済みの出力画像がある場合はそれをコピーして終了
+            output_path = os.path.join(output_folder, stem + cache_entry["output_tail"])
+            if returns_data(cache_entry["bytes"]):
+                with open(cache_entry["blob"], "rb") as f:
+                    written["data"] = f.read()
+            else:
+                with metrics.stage("write"):
+                    cache.copy_to(cache_entry, output_path)
+            # 元画像と出力画像の幅と高さはヘッダーから取得する（どちらもローカルのデータ）
+            with Image.open(io.BytesIO(image_source)) as img:
+                input_size = img.size
+            with Image.open(cache_entry["blob"]) as img:
+                output_size = img.size
+            written.update(
+                scale=cache_entry["scale"],
+                quality=cache_entry["quality"],
+                input_bytes=len(image_source),
+                input_size=input_size,
+                output_bytes=cache_entry["bytes"],
+                output_size=output_size,
+                cache="hit",
+            )
+            if stats is not None:
+                stats["cache"] = "hit"
+            if progress_callback:
+                progress_callback(1.0)  # プログレスバーを100%にする
+            return output_path, cache_entry["scale"], None
+
+    # 出力画像を書き込み、キャッシュを使う場合はキャッシュにも保存する関数
+    def save_output(buffer, output_path, scale, quality, size):
+        if returns_data(buffer.tell()):
+            # 書き込みは呼び出し元に任せる
+            buffer.seek(0)
+            written["data"] = buffer.read()
+        else:
+            with metrics.stage("write"):
+                write_atomic(buffer, output_path)
+        written.update(
+            scale=scale, quality=quality, output_bytes=buffer.tell(), output_size=size
+        )
+        if cache is not None:
+            output_tail = os.path.basename(output_path)[len(stem) :]
+            with metrics.stage("cache_store"):
+                cache.store(
+                    cache_key, source_digest, buffer, output_tail, scale, quality
+                )
+
+    # 画像を開く（ヘッダーのみ読み込む）
+    if shared is not None:
+        img = shared.img
+        opened = contextlib.nullcontext(img)  # 共有の画像は閉じない
+    else:
+        with metrics.stage("open"):
+            img = Image.open(
+                io.BytesIO(image_source)
+                if isinstance(image_source, bytes)
+                else image_source
+            )
+        opened = img
+    with opened:
+        # 元の画像のサイズを取得
+        if shared is not None:
+            input_bytes = shared.input_bytes
+        elif isinstance(image_source, bytes):
+            input_bytes = len(image_source)
+        else:
+            input_bytes = os.path.getsize(input_path)
+        original_size = input_bytes / (1024 * 1024)  # MB単位に変換
+        original_width, original_height = img.size  # 幅と高さ
+        written.update(input_bytes=input_bytes, input_size=img.size)
+        name = stem  # 出力ファイル名
+
+        # クロップ範囲を計算（この時点ではまだデコードしない）
+        crop_box = get_crop_box(
+            original_width, original_height, crop_type, aspect_ratio
+        )
+        # アニメーション画像（GIF、アニメーションWebP）はフレームごとに処理する
+        # （imagesizer_animation は imagesizer_core を使うため、ここで読み込む）
+        from imagesizer_animation import is_animation, process_animation
+
+        animation = is_animation(img)
+        smart_crop = crop_type == "smart"
+        if smart_crop and (shared is not None or animation):
+            # スマートクロップは縮小画像で評価して、被写体を含む位置に移す
+            # （共有のデコード済み画像か、アニメーションの最初のフレームを縮小する）
+            with metrics.stage("smart_crop"):
+                proxy = load_smart_proxy(
+                    img,
+                    image_source,
+                    decode=shared.decode if shared is not None else None,
+                    low_memory=low_memory,
+                )
+                crop_box = find_crop_box(
+                    proxy, original_width, original_height, crop_box
+                )
+            smart_crop = False
+        if shared is not None:
+            source = shared.source_for(crop_box)
+        else:
+            # それ以外の場合は、リサイズのためにデコードした画像で位置を決める
+            source = ResizeSource(
+                img,
+                image_source,
+                crop_box,
+                fast_decode=fast_decode,
+                metrics=metrics,
+                low_memory=low_memory,
+                smart_crop=smart_crop,
+            )
+        cropped_width, cropped_height = source.size  # クロップ後の幅と高さ
+
+        # クロップが適用された場合、ファイル名に"_cropped_クロップタイプ"を追加
+        if crop_type != "none":
+            if crop_type in ("custom", "smart") and aspect_ratio is not None:
+                # カスタム比率の場合、入力値をファイル名に反映
+                aspect_width = (
+                    int(aspect_ratio[0])
+                    if aspect_ratio[0].is_integer()
+                    else aspect_ratio[0]
+                )
+                aspect_height = (
+                    int(aspect_ratio[1])
+                    if aspect_ratio[1].is_integer()
+                    else aspect_ratio[1]
+                )
+                crop_type_safe = f"{aspect_width}×{aspect_height}"
+                if crop_type == "smart":
+                    # スマートクロップの場合は比率の前に "smart" を付ける
+                    crop_type_safe = f"smart_{crop_type_safe}"
+            else:
+                # クロップタイプが16:9などの場合、ファイル名にバグが発生しないように変換
+                crop_type_safe = crop_type.replace(":", "×")
+            name += f"_{crop_type_safe}"
+
+        # 保存フォーマットを取得
+        image_format = get_save_format(ext)
+
+        # アニメーション画像はフレームごとに処理する
+        if animation:
+            return process_animation(
+                image_source,
+                img.size,
+                crop_box,
+                output_folder,
+                name,
+                ext,
+                image_format,
+                original_size,
+                target_size,
+                operation,
+                size_type,
+                quality,
+                tolerance,
+                memory_limit_mb,
+                progress_callback,
+                metrics,
+                save_output,
+                max_mb,
+            )
+
+        # サイズ変更なしの場合
+        if size_type == "none":
+            # クロップ後の画像を保存
+            output_path = os.path.join(output_folder, f"{name}{ext}")
+            cropped_img = source.full()  # クロップ後の画像
+            with create_candidate_buffer(memory_limit_mb) as buffer:
+                start = time.perf_counter()
+                new_bytes = encode_image(
+                    cropped_img, buffer, image_format, quality=quality, optimize=True
+                )
+                metrics.iteration(
+                    1.0,
+                    quality,
+                    cropped_img.size,
+                    0.0,
+                    time.perf_counter() - start,
+                    new_bytes,
+                )
+                save_output(buffer, output_path, 1.0, quality, cropped_img.size)
+            if progress_callback:
+                progress_callback(1.0)  # プログレスバーを100%にする
+            return output_path, 1.0, None  # 出力パス、サイズ比率、メッセージ
+
+        # キャッシュに以前の (サイズ比率, 品質) が記録されている場合は1回だけエンコードする
+        if cache_entry is not None:
+            size_ratio, quality = cache_entry["scale"], cache_entry["quality"]
+            new_width = max(int(cropped_width * size_ratio), 1)
+            new_height = max(int(cropped_height * size_ratio), 1)
+            if size_type in ("width", "height"):
+                # 幅か高さの指定の大きさのままの出力は、同じ幅と高さにする
+                pixel_size, pixel_scale = pixel_target_size(
+                    cropped_width, cropped_height, size_type, target_size
+                )
+                if size_ratio == pixel_scale:
+                    new_width, new_height = pixel_size
+            resized_img = source.resize((new_width, new_height))
+            output_path = os.path.join(output_folder, stem + cache_entry["output_tail"])
+            with create_candidate_buffer(memory_limit_mb) as buffer:
+                start = time.perf_counter()
+                new_bytes = encode_image(
+                    resized_img,
+                    buffer,
+                    image_format,
+                    **get_encode_options(image_format, quality),
+                )
+                metrics.iteration(
+                    size_ratio,
+                    quality,
+                    (new_width, new_height),
+                    source.last_resize_seconds,
+                    time.perf_counter() - start,
+                    new_bytes,
+                )
+                save_output(
+                    buffer, output_path, size_ratio, quality, (new_width, new_height)
+                )
+            written["cache"] = "hint"
+            if stats is not None:
+                stats["cache"] = "hint"
+            if progress_callback:
+                progress_callback(1.0)  # プログレスバーを100%にする
+            return output_path, size_ratio, None
+
+        # サイズ変更ありの場合
+        if size_type == "mb":
+            # 目標サイズをMB単位で取得
+            target_size_mb = float(target_size)
+            # 自動調整モードの場合
+            if operation == "auto":
+                # 元のサイズが目標サイズより大きければ圧縮、小さければ拡大
+                operation = "compress" if original_size > target_size_mb else "upscale"
+            # サイズ比率を計算（クロップで減った面積の分を考慮する）
+            cropped_size = original_size * (
+                (cropped_width * cropped_height) / (original_width * original_height)
+            )
+            size_ratio = (target_size_mb / cropped_size) ** 0.5
+            return _search_mb_target(
+                source,
+                output_folder,
+                name,
+                ext,
+                image_format,
+                target_size_mb,
+                operation,
+                size_ratio,
+                quality,
+                tolerance,
+                memory_limit_mb,
+                progress_callback,
+                metrics,
+                save_output,
+                fast_search,
+            )
+
+        # 幅か高さの指定の場合は、出力の幅と高さが決まるため1回だけリサイズしてエンコードする
+        new_size, size_ratio = pixel_target_size(
+            cropped_width, cropped_height, size_type, target_size
+        )
+        resized_img = source.resize(new_size)
+        with create_candidate_buffer(memory_limit_mb) as buffer:
+            start = time.perf_counter()
+            new_bytes = encode_image(
+                resized_img,
+                buffer,
+                image_format,
+                **get_encode_options(image_format, quality),
+            )
+            metrics.iteration(
+                size_ratio,
+                quality,
+                new_size,
+                source.last_resize_seconds,
+                time.perf_counter() - start,
+                new_bytes,
+            )
+            if max_mb is None or new_bytes <= max_mb * 1024 * 1024:
+                # リサイズ後のサイズ比率（面積の比）をファイル名に付ける
+                current_ratio = int(
+                    (new_size[0] * new_size[1]) / (cropped_width * cropped_height) * 100
+                )
+                output_path = os.path.join(
+                    output_folder, f"{name}_{current_ratio}%{ext}"
+                )
+                save_output(buffer, output_path, size_ratio, quality, new_size)
+                if progress_callback:
+                    progress_callback(1.0)  # プログレスバーを100%にする
+                return output_path, size_ratio, None  # 出力パス、サイズ比率、メッセージ
+
+        # 上限を超えた場合は、まず幅と高さを保ったまま品質を下げて探索する
+        if ext.lower() in LOSSY_EXTENSIONS:
+            output = _search_mb_target(
+                source,
+                output_folder,
+                name,
+                ext,
+                image_format,
+                max_mb,
+                "compress",
+                size_ratio,
+                quality,
+                tolerance,
+                memory_limit_mb,
+                progress_callback,
+                metrics,
+                save_output,
+                fast_search,
+                fixed_size=new_size,
+                observed=[(size_ratio, quality, new_bytes)],
+            )
+            if output[0] is not None:
+                return output
+            quality = MIN_QUALITY
+        # 最低の品質でも超える場合（品質を指定できない形式を含む）は、指定の大きさを
+        # 上限として縮小しながら探索する
+        return _search_mb_target(
+            source,
+            output_folder,
+            name,
+            ext,
+            image_format,
+            max_mb,
+            "compress",
+            size_ratio,
+            quality,
+            tolerance,
+            memory_limit_mb,
+            progress_callback,
+            metrics,
+            save_output,
+            fast_search,
+            max_scale=size_ratio,
+        )
+
+
+# 縮小画像（プロキシ）のエンコード結果から、目標のバイト数になるサイズ比率と品質を予測する関数
+# 2つの大きさのプロキシのバイト数からサイズ比率に対するバイト数の傾きを求めて元の大きさまで
+# 外挿する。サイズ比率が範囲の限界に達する場合は、品質を変えたプロキシから品質も予測する
+# (サイズ比率, 品質, 予測したバイト数, 傾き) を返す（小さい画像と拡大する場合はNone）
+def predict_start(source, search, image_format, quality, metrics):
+    width, height = source.size
+    if width * height < PROXY_PIXELS * 2:
+        return None
+    with metrics.stage("predict"):
+        if source.needs_full(search.dimensions(search.next_candidate()[0])):
+            # 探索でフル解像度の画像を使う場合は先にデコードし、プロキシもそこから作る
+            # （ドラフトモードでの別のデコードを省く）
+            source.full()
+        proxy_scale = (PROXY_PIXELS / (width * height)) ** 0.5
+        proxy = source.resize(search.dimensions(proxy_scale))
+        small = proxy.resize(
+            (max(proxy.width // 2, 1), max(proxy.height // 2, 1)), Image.LANCZOS
+        )
+        buffer = io.BytesIO()
+        options = get_encode_options(image_format, quality)
+        # (サイズ比率の対数, バイト数の対数)
+        x0 = math.log(proxy_scale)
+        y0 = math.log(encode_image(proxy, buffer, image_format, **options))
+        x1 = math.log(proxy_scale * small.width / proxy.width)
+        y1 = math.log(encode_image(small, buffer, image_format, **options))
+        slope = (y0 - y1) / (x0 - x1) if x0 != x1 else search.scale_slope
+        slope = min(max(slope, 0.5), 4.0)
+        scale = search._clamp_scale(math.exp(x0 + (search.log_aim - y0) / slope))
+        if scale >= 1:
+            # 元の解像度より大きくする場合は、縮小画像からは外挿できないため予測しない
+            return None
+        log_bytes = y0 + slope * (math.log(scale) - x0)
+        predicted = math.exp(log_bytes)
+        if search.lossy and not (
+            search.is_feasible(predicted) and search.is_within_tolerance(predicted)
+        ):
+            # サイズ比率が限界に達した場合は、品質を変えてプロキシをエンコードし、
+            # 品質に対するバイト数の傾きから品質を予測する
+            if search.operation == "compress":
+                other = max(quality - PROXY_QUALITY_STEP, MIN_QUALITY)
+            else:
+                other = min(quality + PROXY_QUALITY_STEP, MAX_QUALITY)
+            if other != quality:
+                y2 = math.log(
+                    encode_image(
+                        proxy,
+                        buffer,
+                        image_format,
+                        **get_encode_options(image_format, other),
+                    )
+                )
+                quality_slope = min(max((y2 - y0) / (other - quality), 0.005), 0.2)
+                new_quality = quality + (search.log_aim - log_bytes) / quality_slope
+                new_quality = min(
+                    max(int(round(new_quality)), MIN_QUALITY), MAX_QUALITY
+                )
+                log_bytes += quality_slope * (new_quality - quality)
+                quality = new_quality
+    return scale, quality, math.exp(log_bytes), slope
+
+
+# MB指定の目標サイズを探索して保存する関数
+def _search_mb_target(
+    source,
+    output_folder,
+    name,
+    ext,
+    image_format,
+    target_size_mb,
+    operation,
+    size_ratio,
+    quality,
+    tolerance,
+    memory_limit_mb,
+    progress_callback,
+    metrics,
+    save_output,
+    fast_search=False,
+    max_scale=MAX_UPSCALE_RATIO,
+    fixed_size=None,
+    observed=(),
+):
+    # max_scale と fixed_size は SizeSearch と同じ（サイズ比率の上限と、品質のみを探索する
+    # 場合の幅と高さ）。observed はエンコード済みの (サイズ比率, 品質, バイト数) で、
+    # 探索の最初の観測として使う（その場合は開始点を予測しない）
+    cropped_width, cropped_height = source.size  # クロップ後の幅と高さ
+    lossy = ext.lower() in LOSSY_EXTENSIONS  # 品質を指定できるかどうか
+    target_bytes = target_size_mb * 1024 * 1024
+    search_options = dict(
+        tolerance=tolerance, lossy=lossy, max_scale=max_scale, fixed_size=fixed_size
+    )
+    search = SizeSearch(
+        target_bytes, operation, source.size, size_ratio, quality, **search_options
+    )
+    # 縮小画像で目標に近いサイズ比率と品質を予測し、探索の開始点にする
+    scale_slope = search.scale_slope
+    predicted_bytes = (
+        None  # 予測したバイト数（最初の候補をエンコードしたら誤差を記録する）
+    )
+    prediction = None
+    if not observed:
+        prediction = predict_start(source, search, image_format, quality, metrics)
+    if prediction is not None:
+        size_ratio, quality, predicted_bytes, scale_slope = prediction
+    # 現在の候補と最良の候補を書き込むバッファを作成（交互に再利用する）
+    with create_candidate_buffer(memory_limit_mb) as buffer, create_candidate_buffer(
+        memory_limit_mb
+    ) as best_buffer:
+        fast_sizes = {}  # (幅, 高さ, 品質) -> 高速な設定でのバイト数
+        if fast_search and image_format in FAST_SEARCH_FORMATS:
+            # 高速な設定でエンコードして、補正係数で最終出力のバイト数を予測しながら
+            # 目標に近いサイズ比率と品質を見つけ、最終出力の探索の開始点にする
+            correction = _correction_estimates[image_format]
+            search = SizeSearch(
+                target_bytes,
+                operation,
+                source.size,
+                size_ratio,
+                quality,
+                scale_slope=scale_slope,
+                **search_options,
+            )
+            for observation in observed:
+                search.observe(*observation)
+            while True:
+                candidate = search.next_candidate()
+                if candidate is None:
+                    break
+                scale, candidate_quality = candidate
+                new_width, new_height = search.dimensions(scale)
+                resized_img = source.resize((new_width, new_height))
+                start = time.perf_counter()
+                new_bytes = encode_image(
+                    resized_img,
+                    buffer,
+                    image_format,
+                    **get_encode_options(image_format, candidate_quality, fast=True),
+                )
+                metrics.iteration(
+                    scale,
+                    candidate_quality,
+                    (new_width, new_height),
+                    source.last_resize_seconds,
+                    time.perf_counter() - start,
+                    new_bytes,
+                    kind="fast",
+                )
+                fast_sizes[(new_width, new_height, candidate_quality)] = new_bytes
+                if predicted_bytes is not None:
+                    metrics.prediction(
+                        scale,
+                        candidate_quality,
+                        predicted_bytes,
+                        new_bytes * correction,
+                    )
+                    predicted_bytes = None
+                search.observe(scale, candidate_quality, new_bytes * correction)
+            if search.best is not None:
+                size_ratio, quality = search.best[:2]
+
+        # 最終出力の設定でエンコードして探索する（開始点が目標に近ければ1回で終わる）
+        search = SizeSearch(
+            target_bytes,
+            operation,
+            source.size,
+            size_ratio,
+            quality,
+            scale_slope=scale_slope,
+            **search_options,
+        )
+        for observation in observed:
+            search.observe(*observation)
+        resized_img = None
+        while True:
+            candidate = search.next_candidate()
+            if candidate is None:
+                break
+            scale, quality = candidate
+            # 新しい幅と高さを計算して画像をリサイズ（品質のみを変える場合は前回の画像を使う）
+            new_width, new_height = search.dimensions(scale)
+            resize_seconds = 0.0
+            if resized_img is None or resized_img.size != (new_width, new_height):
+                resized_img = source.resize((new_width, new_height))
+                resize_seconds = source.last_resize_seconds
+
+            # 画像をバッファにエンコード
+            start = time.perf_counter()
+            new_bytes = encode_image(
+                resized_img,
+                buffer,
+                image_format,
+                **get_encode_options(image_format, quality),
+            )
+            # リサイズとエンコードの結果を記録
+            metrics.iteration(
+                scale,
+                quality,
+                (new_width, new_height),
+                resize_seconds,
+                time.perf_counter() - start,
+                new_bytes,
+                kind="final" if fast_sizes else None,
+            )
+            if predicted_bytes is not None:
+                metrics.prediction(scale, quality, predicted_bytes, new_bytes)
+                predicted_bytes = None
+            # 高速な設定でのバイト数が分かっている場合、補正係数の推定値を更新する
+            fast_bytes = fast_sizes.get((new_width, new_height, quality))
+            if fast_bytes:
+                _correction_estimates[image_format] += CORRECTION_SMOOTHING * (
+                    new_bytes / fast_bytes - _correction_estimates[image_format]
+                )
+
+            # プログレスバーを更新
+            if progress_callback:
+                progress_callback(search.encodes / search.max_encodes)
+
+            # 結果を記録し、最良の候補が更新された場合はバッファを入れ替える
+            if search.observe(scale, quality, new_bytes):
+                buffer, best_buffer = best_buffer, buffer
+
+        if progress_callback:
+            progress_callback(1.0)  # プログレスバーを100%にする
+
+        # 条件を満たす候補が見つからなかった場合
+        if search.best is None:
+            return None, 0, "目標サイズに到達できませんでした"
+
+        # 最良の候補をディスクに書き込む
+        scale = search.best[0]
+        new_width, new_height = search.dimensions(scale)
+        current_ratio = int(
+            (new_width * new_height) / (cropped_width * cropped_height) * 100
+        )
+        output_path = os.path.join(output_folder, f"{name}_{current_ratio}%{ext}")
+        save_output(
+            best_buffer, output_path, scale, search.best[1], (new_width, new_height)
+        )
+        return output_path, scale, None  # 出力パス、サイズ比率、メッセージ
+
+
+class SharedSource:
+    # 1つの元画像から複数の出力（バリアント）を作る場合に、読み込みとデコードを共有するクラス
+    # デコードは最初に必要になったときに一度だけ行い、クロップはクロップ範囲ごとに共有する
+    def __init__(
+        self, input_path, read_bytes=False, fast_decode=True, metrics=None, data=None
+    ):
+        self.input_path = input_path
+        self.fast_decode = fast_decode
+        self.metrics = metrics or FileMetrics(input_path)
+        # 元画像のバイト列（キャッシュを使う場合か、読み込み済みのものを渡された場合）
+        self.data = data
+        self.digest = None  # 元画像の内容のハッシュ（キャッシュを使う場合）
+        if read_bytes and data is None:
+            with self.metrics.stage("read"), open(input_path, "rb") as f:
+                self.data = f.read()
+        if self.data is not None:
+            if read_bytes:
+                self.digest = content_digest(self.data)
+            self.input_bytes = len(self.data)  # 元画像のバイト数
+        else:
+            self.input_bytes = os.path.getsize(input_path)
+        with self.metrics.stage("open"):
+            self.img = Image.open(
+                io.BytesIO(self.data) if self.data is not None else input_path
+            )
+        self._sources = {}  # クロップ範囲 -> ResizeSource
+        self._decoded = False  # デコード済みかどうか
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.img.close()
+
+    def decode(self):
+        # フル解像度でデコードした画像を返す（最初の呼び出しでのみデコードする）
+        with self._lock:
+            if not self._decoded:
+                with self.metrics.stage("decode"):
+                    self.img.load()
+                self._decoded = True
+            return self.img
+
+    def source_for(self, crop_box):
+        # クロップ範囲ごとのリサイズ元を返す（中間画像も同じクロップ範囲の出力で共有する）
+        key = crop_box or (0, 0) + self.img.size
+        with self._lock:
+            if key not in self._sources:
+                self._sources[key] = ResizeSource(
+                    self.img,
+                    self.data if self.data is not None else self.input_path,
+                    key,
+                    fast_decode=self.fast_decode,
+                    metrics=self.metrics,
+                    decode=self.decode,
+                )
+            return self._sources[key]
+
+
+# "クロップ:サイズ" 形式のバリアントの指定を解析する関数
+# 例: "square:width=640", "16:9:mb=1.5", "custom=3:2:height=720", "none:none",
+# "smart:width=640", "smart=3:2:mb=1"
+def parse_variant(text):
+    crop_type, _, size = text.rpartition(":")
+    crop_type = crop_type or "none"
+    aspect_ratio = None
+    name, _, ratio = crop_type.partition("=")
+    if ratio and name in ("custom", "smart"):
+        # カスタム比率は "custom=幅:高さ"、スマートクロップの比率は "smart=幅:高さ" で指定する
+        try:
+            aspect_ratio = tuple(float(v) for v in ratio.split(":"))
+        except ValueError:
+            aspect_ratio = ()
+        if len(aspect_ratio) != 2 or min(aspect_ratio) <= 0:
+            raise ValueError(f"カスタム比率の指定が正しくありません: {text}")
+        crop_type = name
+    if crop_type not in CROP_TYPES or crop_type == "custom" and not aspect_ratio:
+        raise ValueError(f"クロップ設定が正しくありません: {text}")
+    size_type, _, target = size.partition("=")
+    if size_type == "none" and not target:
+        target_size = None
+    elif size_type in SIZE_TYPES and size_type != "none":
+        try:
+            target_size = float(target)
+        except ValueError:
+            raise ValueError(f"目標サイズが正しくありません: {text}")
+        if target_size <= 0:
+            raise ValueError(f"目標サイズには正の数を指定してください: {text}")
+    else:
+        raise ValueError(f"サイズの指定が正しくありません: {text}")
+    return dict(
+        crop_type=crop_type,
+        aspect_ratio=aspect_ratio,
+        size_type=size_type,
+        target_size=target_size,
+    )
+
+
+# バリアントの出力画像のおおよその画素数を見積もる関数（大きい順に処理するため）
+def _estimate_pixels(variant, width, height, file_size_mb):
+    crop_box = get_crop_box(
+        width, height, variant["crop_type"], variant.get("aspect_ratio")
+    )
+    if crop_box is not None:
+        width, height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+    pixels = width * height
+    size_type, target = variant["size_type"], variant.get("target_size")
+    if size_type == "width":
+        return pixels * (target / width) ** 2
+    if size_type == "height":
+        return pixels * (target / height) ** 2
+    if size_type == "mb" and file_size_mb > 0:
+        return pixels * target / file_size_mb
+    return pixels
+
+
+# 1枚の画像から複数の出力（バリアント）を作る関数
+# 元画像の読み込みとデコードは一度だけ行い、同じクロップのバリアントはクロップと
+# 中間画像を共有する。バリアントは出力が大きい順に並列に処理する
+# variants は crop_type、aspect_ratio、size_type、target_size（と任意で operation）の辞書のリスト
+# 戻り値はバリアントの順の ImageResult のリスト
+def process_variants(
+    input_path,
+    output_folder,
+    variants,
+    operation="auto",
+    quality=85,
+    progress_callback=None,
+    memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB,
+    tolerance=DEFAULT_TOLERANCE,
+    stats=None,
+    fast_decode=True,
+    cache=None,
+    event_callback=None,
+    max_threads=None,
+    source_bytes=None,
+    return_data=False,
+    fast_search=False,
+    cancel_event=None,
+    max_mb=None,
+):
+    # max_mb は幅か高さの指定のバリアントに適用する（process_image と同じ）
+    # 共有部分（読み込み、デコード）の記録
+    metrics = FileMetrics(input_path, event_callback, cancel_event=cancel_event)
+    variant_stats = [{} for _ in variants]
+    progress = [0.0] * len(variants)
+
+    # バリアントごとの進捗の平均を全体の進捗とする関数
+    def report(index, p):
+        progress[index] = p
+        if progress_callback:
+            progress_callback(sum(progress) / len(progress))
+
+    # 1つのバリアントを処理する関数（スレッドで実行される）
+    def run_variant(index, shared):
+        variant = variants[index]
+        variant_metrics = FileMetrics(
+            input_path,
+            event_callback,
+            fields=dict(variant=index),
+            cancel_event=cancel_event,
+        )
+        written = {}
+        try:
+            result = _process_image(
+                input_path,
+                output_folder,
+                variant.get("target_size"),
+                variant.get("operation", operation),
+                variant["size_type"],
+                variant["crop_type"],
+                variant.get("aspect_ratio"),
+                quality,
+                lambda p: report(index, p),
+                memory_limit_mb,
+                tolerance,
+                variant_stats[index],
+                fast_decode,
+                cache,
+                variant_metrics,
+                written,
+                return_data=return_data,
+                shared=shared,
+                fast_search=fast_search,
+                max_mb=max_mb,
+            )
+        except ProcessingCancelled:
+            raise
+        except Exception as e:
+            variant_metrics.emit("error", error=f"{type(e).__name__}: {e}")
+            raise
+        return _make_result(
+            input_path, result, written, variant_metrics, variant_stats[index]
+        )
+
+    try:
+        metrics.check_cancelled()
+        with SharedSource(
+            input_path, cache is not None, fast_decode, metrics, source_bytes
+        ) as shared:
+            width, height = shared.img.size
+            file_size_mb = shared.input_bytes / (1024 * 1024)
+            # 出力が大きい順に投入し、小さい出力は大きい出力の中間画像から縮小できるようにする
+            order = sorted(
+                range(len(variants)),
+                key=lambda i: -_estimate_pixels(
+                    variants[i], width, height, file_size_mb
+                ),
+            )
+            with ThreadPoolExecutor(
+                max_workers=max_threads or min(len(variants), DEFAULT_WORKERS)
+            ) as executor:
+                futures = {i: executor.submit(run_variant, i, shared) for i in order}
+                results = [futures[i].result() for i in range(len(variants))]
+    except ProcessingCancelled:
+        raise
+    except Exception as e:
+        metrics.emit("error", error=f"{type(e).__name__}: {e}")
+        raise
+    if stats is not None:
+        stats["variants"] = variant_stats
+        stats["encodes"] = sum(s.get("encodes", 0) for s in variant_stats)
+    metrics.finish(stats, [result[0] for result in results])
+    return results
+
+
+# 画像のモードごとの1ピクセルあたりのメモリ上のバイト数を返す関数
+# （Pillowは3チャンネルの画像も4バイトで持つ）
+def pixel_bytes(mode):
+    if mode in ("1", "L", "P"):
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+
+# ジョブのピークメモリ使用量（バイト数）を、デコードせずにヘッダーの幅、高さ、モードから
+# 推定する関数（開けない画像は処理時にエラーになるため0を返す）
+def estimate_job_memory(job):
+    source = job.get("source_bytes")
+    try:
+        with Image.open(
+            io.BytesIO(source) if source is not None else job["input_path"]
+        ) as img:
+            width, height = img.size
+            mode = img.mode
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return 0
+    decoded = width * height * pixel_bytes(mode)
+    if "variants" in job:
+        # バリアントの場合はデコード結果を共有し、クロップごとにクロップ結果を持つ
+        crops = {variant.get("crop_type", "none") for variant in job["variants"]}
+        return decoded * (JOB_MEMORY_COPIES - 1 + len(crops))
+    estimate = decoded * JOB_MEMORY_COPIES
+    # 幅や高さの指定で拡大する場合は、拡大した画像の分を加える
+    if job.get("size_type") in ("width", "height"):
+        dimension = width if job["size_type"] == "width" else height
+        ratio = float(job.get("target_size") or 0) / dimension
+        if ratio > 1:
+            estimate += int(decoded * ratio * ratio)
+    return estimate
+
+
+# ジョブのメモリの予算の既定値（MB）を返す関数（物理メモリが分からない場合はNone）
+def default_job_memory_budget_mb():
+    try:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None  # Windows など
+    return total / (1024 * 1024) * DEFAULT_JOB_MEMORY_FRACTION
+
+
+# メモリの予算に合わせてジョブを調整し、(ジョブ, 予算から確保するバイト数) を返す関数
+# 単独でも予算に収まらないジョブは、予算のすべてを確保して（他と並べずに）実行し、
+# 1枚の画像の場合は縮小済みの中間画像を使う低メモリの処理にする
+def plan_job(job, budget_bytes):
+    if budget_bytes is None:
+        return job, 0
+    estimate = estimate_job_memory(job)
+    if estimate <= budget_bytes:
+        return job, estimate
+    if "variants" not in job:
+        job = dict(job, low_memory=True)
+    return job, budget_bytes
+
+
+# ワーカープロセスで使うキャンセルのイベント（init_worker で設定する）
+_worker_cancel_event = None
+
+
+# ワーカープロセスを初期化する関数（ProcessPoolExecutor の initializer）
+def init_worker(cancel_event):
+    # イベントはプロセスの生成時にしか渡せないため、ジョブごとではなくここで受け取る
+    global _worker_cancel_event
+    _worker_cancel_event = cancel_event
+    # キャンセルはイベントで伝えるため、Ctrl+C はワーカーでは無視する
+    # （ワーカーが処理の途中で終了してプールが壊れないようにする）
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# ワーカープロセスのプールを作成する関数
+# cancel_event は multiprocessing.Event（セットすると処理中のジョブも中止する）
+def create_worker_pool(max_workers, cancel_event=None):
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_worker, initargs=(cancel_event,)
+    )
+
+
+# 1枚の画像を処理して (結果, 統計情報, 例外) を返す関数（ワーカープロセスで実行される）
+def run_job(
+    job,
+    progress_callback=None,
+    event_callback=None,
+    collect_events=False,
+    profile_dir=None,
+    cancel_event=None,
+):
+    # 例外はファイルごとに閉じ込めて呼び出し元に返す
+    # job に variants がある場合は process_variants の、ない場合は process_image の引数
+    # collect_events を指定すると、イベントを stats["events"] に集めて返す（プロセス間用）
+    # profile_dir を指定すると、cProfile と tracemalloc の結果をそのフォルダに書き出す
+    # cancel_event を省略した場合は、ワーカープロセスの初期化で渡されたものを使う
+    stats = {}
+    if collect_events:
+        stats["events"] = []
+        event_callback = stats["events"].append
+    kwargs = dict(
+        job,
+        progress_callback=progress_callback,
+        stats=stats,
+        event_callback=event_callback,
+        cancel_event=cancel_event or _worker_cancel_event,
+    )
+    # バリアントの指定がある場合は1回のデコードで複数の出力を作る
+    func = process_variants if "variants" in job else process_image
+    try:
+        if profile_dir:
+            result = run_profiled(
+                func, profile_dir, profile_label(job["input_path"]), **kwargs
+            )
+        else:
+            result = func(**kwargs)
+    except Exception as e:
+        return None, stats, e
+    return result, stats, None
+
+
+# プロファイルの結果のファイル名を作る関数（同じ名前の別フォルダのファイルと区別する）
+def profile_label(input_path):
+    checksum = zlib.crc32(os.path.abspath(input_path).encode("utf-8"))
+    return f"{os.path.basename(input_path)}-{checksum:08x}"
+
+
+# ファイルがプロファイル対象のパターンに一致するかどうかを判定する関数
+def matches_patterns(input_path, patterns):
+    return any(
+        fnmatch.fnmatch(os.path.basename(input_path), pattern)
+        or fnmatch.fnmatch(input_path, pattern)
+        for pattern in patterns or ()
+    )
+
+
+# 複数の画像を並列に処理する関数
+def process_batch(
+    jobs,
+    max_workers=DEFAULT_WORKERS,
+    max_inflight=None,
+    progress_callback=None,
+    event_callback=None,
+    profile_patterns=None,
+    profile_dir="profiles",
+    job_memory_budget_mb=None,
+    cancel_event=None,
+    start_callback=None,
+):
+    # jobs は process_image のキーワード引数の辞書の列
+    # 入力順に (番号, ジョブ, 結果, 統計情報, 例外) を返すジェネレータ
+    # 各ワーカーは同時に1枚しかデコードしないため、フル解像度の画像は最大でワーカー数まで
+    # job_memory_budget_mb を指定すると、ヘッダーから推定したピークメモリの合計が
+    # 予算に収まる分だけ同時に実行する（単独でも収まらない画像は低メモリの処理にする）
+    # progress_callback(番号, 進捗) はワーカー数が1の場合のみ呼ばれる
+    # event_callback にはファイルごとのイベントを入力順に渡す
+    # profile_patterns に一致するファイルは profile_dir にプロファイルを書き出す
+    # cancel_event（multiprocessing.Event）がセットされると、新しいジョブを投入せず、
+    # 処理中のジョブもエンコードの1回以内に中止する（中止したジョブは例外
+    # ProcessingCancelled を返す。投入していないジョブは返さない）
+    # start_callback(番号, ジョブ) はジョブを処理に渡す直前に呼ばれる（ジャーナルの記録用）
+
+    # ファイルごとのプロファイルの書き出し先（対象外の場合はNone）
+    def profile_for(job):
+        if matches_patterns(job["input_path"], profile_patterns):
+            return profile_dir
+        return None
+
+    budget_bytes = (
+        None
+        if job_memory_budget_mb is None
+        else int(job_memory_budget_mb * 1024 * 1024)
+    )
+    if max_workers <= 1:
+        # ワーカー数が1の場合はプロセスを起動せずにその場で処理する
+        for index, job in enumerate(jobs):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            job = plan_job(job, budget_bytes)[0]
+            if start_callback:
+                start_callback(index, job)
+            callback = None
+            if progress_callback:
+                callback = lambda p, index=index: progress_callback(index, p)
+            yield (index, job) + run_job(
+                job,
+                callback,
+                event_callback,
+                profile_dir=profile_for(job),
+                cancel_event=cancel_event,
+            )
+        return
+
+    # ワーカープロセスでイベントを集めて返し、こちらで event_callback に渡す
+    def submit(job):
+        return executor.submit(
+            run_job,
+            job,
+            collect_events=event_callback is not None,
+            profile_dir=profile_for(job),
+        )
+
+    # 投入済みで結果を受け取っていないジョブ数の上限
+    if max_inflight is None:
+        max_inflight = max_workers * 2
+    jobs = enumerate(jobs)
+    pending = deque()  # (番号, ジョブ, 確保したバイト数, Future) を投入順に保持
+    waiting = None  # メモリの予算に収まらず投入を待っている (番号, ジョブ, バイト数)
+    executor = create_worker_pool(max_workers, cancel_event)
+    finished = False  # 最後まで結果を返したかどうか（途中で中断されていないか）
+    try:
+        while True:
+            # 上限までジョブを投入する（メモリの予算に収まらない場合は実行中のものを待つ）
+            while len(pending) < max_inflight:
+                if cancel_event is not None and cancel_event.is_set():
+                    break  # キャンセルされた場合は投入済みのものだけを返す
+                if waiting is None:
+                    try:
+                        index, job = next(jobs)
+                    except StopIteration:
+                        break
+                    waiting = (index,) + plan_job(job, budget_bytes)
+                index, job, nbytes = waiting
+                if budget_bytes is not None:
+                    running = sum(n for _, _, n, f in pending if not f.done())
+                    if running and running + nbytes > budget_bytes:
+                        break
+                if start_callback:
+                    start_callback(index, job)
+                pending.append((index, job, nbytes, submit(job)))
+                waiting = None
+            if not pending:
+                break
+
+            # 先頭のジョブの完了を待って入力順に返す
+            index, job, nbytes, future = pending.popleft()
+            try:
+                result, stats, error = future.result()
+            except BrokenProcessPool as e:
+                # ワーカーが異常終了した場合、このファイルを失敗として扱い、
+                # プールを作り直して残りのジョブを再投入する
+                result, stats, error = None, {}, e
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = create_worker_pool(max_workers, cancel_event)
+                pending = deque((i, j, n, submit(j)) for i, j, n, _ in pending)
+            for event in stats.pop("events", ()):
+                event_callback(event)
+            yield index, job, result, stats, error
+        finished = True
+    finally:
+        if finished:
+            # 最後まで返した場合（キャンセルで打ち切った場合を含む）はワーカーの終了を待つ
+            # （待たないと、終了時に閉じたパイプへの書き込みでエラーが表示される。
+            # キャンセルされた処理中のジョブはエンコードの1回以内に中止する）
+            executor.shutdown(
+                wait=True,
+                cancel_futures=cancel_event is not None and cancel_event.is_set(),
+            )
+        else:
+            # 途中で中断された場合は、残りのジョブを取り消して待たずに戻る
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,763 @@
+import os
+import json
+import hmac
+import time
+import queue
+import signal
+import socket
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures.process import BrokenProcessPool
+from imagesizer_core import (
+    DEFAULT_WORKERS,
+    ImageResult,
+    create_worker_pool,
+    plan_job,
+    run_job,
+)
+from imagesizer_metrics import ProcessingCancelled
+
+# 複数のホストで一括処理を分散する機能（コーディネーターとワーカー）
+# コーディネーターがジョブ（process_image の引数）をソケットで配り、各ホストのワーカーが
+# 共有ストレージ上の画像を処理して結果を返す。通信は1行に1つのJSON（JSON Lines）。
+# ワーカーは受け取れるジョブ数（クレジット）をコーディネーターに伝え、コーディネーターは
+# その数までジョブを渡す。配るジョブがなくなると、他のワーカーが受け取ったまま開始して
+# いないジョブを取り上げて空いているワーカーに配り直す（ワークスティーリング）。
+# ハートビートが途絶えたワーカーや接続が切れたワーカーのジョブは、他のワーカーに配り直す
+#
+# メッセージ（type の値）
+#   ワーカー -> コーディネーター
+#     hello     接続時の名前、並列数、トークン
+#     request   追加で受け取れるジョブ数（count）
+#     started   ジョブ（id）の処理を開始した
+#     result    ジョブの結果、統計情報、例外
+#     released  取り上げ（steal）やキャンセルで返すジョブ（ids）
+#     lost      ワーカープロセスの異常終了で処理できなかったジョブ（ids）
+#     heartbeat 生存の通知
+#   コーディネーター -> ワーカー
+#     job       ジョブ（id、job、collect_events）
+#     steal     開始していなければ返してほしいジョブ（ids）
+#     cancel    処理中のジョブを中止し、開始していないジョブを返す
+#     shutdown  終了する
+#     error     接続を拒否した理由（message）
+
+# 通信の形式のバージョン
+PROTOCOL_VERSION = 1
+# ワーカーがハートビートを送る間隔（秒）
+DEFAULT_HEARTBEAT_INTERVAL = 2.0
+# ハートビートがこの時間（秒）届かないワーカーは停止したとみなす
+DEFAULT_HEARTBEAT_TIMEOUT = 15.0
+# 処理中にワーカーが停止したジョブを配り直す回数の上限（超えたらエラーとして返す）
+# （ワーカーを異常終了させる画像を、すべてのワーカーに配り続けないため）
+DEFAULT_MAX_ATTEMPTS = 3
+# ワーカーが並列数とは別に受け取っておくジョブ数（次のジョブを待たずに始めるため）
+DEFAULT_PREFETCH_JOBS = 2
+# ワーカーがコーディネーターに接続できない場合に再試行する時間（秒）
+DEFAULT_RECONNECT_SECONDS = 30.0
+# コーディネーターがメッセージを待つ時間（秒）。この間隔でハートビートとキャンセルを確認する
+POLL_SECONDS = 0.5
+# ワーカーから受け取るメッセージの種類ごとの、必須の項目とその値の型
+WORKER_MESSAGE_FIELDS = {
+    "hello": dict(worker=str, slots=int, count=int),
+    "request": dict(count=int),
+    "started": dict(id=int),
+    "result": dict(id=int),
+    "released": dict(ids=list),
+    "lost": dict(ids=list),
+    "heartbeat": {},
+}
+
+
+class RemoteJobError(Exception):
+    # ワーカーでの処理で発生した例外（元の例外の型名をメッセージに含む）
+    # ワーカーが停止してジョブを処理できなかった場合にも使う
+    pass
+
+
+class WorkerRejected(Exception):
+    # コーディネーターがワーカーの接続を拒否したことを示す例外（トークンの誤りなど）
+    pass
+
+
+# "ホスト:ポート" か "unix:パス" 形式のアドレスを (アドレスファミリー, アドレス) に変換する関数
+def parse_address(address):
+    if address.startswith("unix:"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("この環境ではUnixソケットを使えません")
+        return socket.AF_UNIX, address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    try:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    except ValueError:
+        raise ValueError(
+            f"アドレスは ホスト:ポート か unix:パス の形式で指定してください: {address}"
+        )
+
+
+# メッセージを1行のJSONとして送る関数（送れない場合は OSError）
+def send_message(conn, message):
+    conn.sendall((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+# 接続を閉じる関数
+# （読み込み中の makefile が残っていると close() だけではソケットが閉じないため、
+# 先に shutdown して相手と読み込み側のスレッドに切断を伝える）
+def close_connection(conn):
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # 既に切れている場合
+    conn.close()
+
+
+# 接続からメッセージを順に読み込むジェネレータ（接続が切れると終わる）
+def read_messages(conn):
+    with conn.makefile("r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue  # 壊れた行は無視する
+            if isinstance(message, dict):
+                yield message
+
+
+# ワーカーから受け取ったメッセージの種類と項目が正しいかどうかを返す関数
+# job_count はジョブ数（ジョブの番号は 0 以上 job_count 未満）
+def is_valid_worker_message(message, job_count):
+    fields = WORKER_MESSAGE_FIELDS.get(message.get("type"))
+    if fields is None:
+        return False
+    for key, kind in fields.items():
+        value = message.get(key)
+        # JSONの true/false は bool（int のサブクラス）になるため除く
+        if not isinstance(value, kind) or isinstance(value, bool):
+            return False
+    ids = message.get("ids", [message["id"]] if "id" in fields else [])
+    if not all(
+        isinstance(i, int) and not isinstance(i, bool) and 0 <= i < job_count
+        for i in ids
+    ):
+        return False
+    if message.get("slots", 1) < 1 or message.get("count", 0) < 0:
+        return False
+    if message["type"] == "result":
+        error = message.get("error")
+        if not isinstance(message.get("stats") or {}, dict):
+            return False
+        if error is not None and not (
+            isinstance(error, dict)
+            and isinstance(error.get("type"), str)
+            and isinstance(error.get("message"), str)
+        ):
+            return False
+        return isinstance(message.get("result"), (dict, list, type(None)))
+    return True
+
+
+# ジョブを送れる形（JSONで表せる値のみ）に変換する関数
+# キャッシュは各ワーカーのものを使うため送らない
+def encode_job(job):
+    return json.loads(
+        json.dumps({key: value for key, value in job.items() if key != "cache"})
+    )
+
+
+# 受け取ったジョブを process_image の引数に戻す関数（JSONで配列になった縦横比を戻す）
+def decode_job(job, cache=None):
+    for target in [job] + job.get("variants", []):
+        if target.get("aspect_ratio") is not None:
+            target["aspect_ratio"] = tuple(target["aspect_ratio"])
+    if cache is not None:
+        job["cache"] = cache
+    return job
+
+
+# 処理結果（ImageResult かバリアントのリスト）を送れる形に変換する関数
+def encode_result(result):
+    if result is None:
+        return None
+    if isinstance(result, list):
+        return [r.as_dict() for r in result]
+    return result.as_dict()
+
+
+# 受け取った処理結果を ImageResult に戻す関数
+def decode_result(data):
+    if data is None:
+        return None
+    if isinstance(data, list):
+        return [decode_result(item) for item in data]
+    for key in ("input_size", "output_size"):
+        if data.get(key) is not None:
+            data[key] = tuple(data[key])
+    return ImageResult(**data)
+
+
+# 例外を送れる形に変換する関数
+def encode_error(error):
+    if error is None:
+        return None
+    return dict(type=type(error).__name__, message=str(error))
+
+
+# 受け取った例外を戻す関数（キャンセル以外は RemoteJobError にする）
+def decode_error(data):
+    if data is None:
+        return None
+    if data["type"] == ProcessingCancelled.__name__:
+        return ProcessingCancelled(data["message"])
+    return RemoteJobError(f"{data['type']}: {data['message']}")
+
+
+class WorkerState:
+    # コーディネーターから見た、接続中のワーカーの状態
+    def __init__(self, conn, name, slots):
+        self.conn = conn
+        self.name = name
+        self.slots = slots
+        self.credits = 0  # 追加で渡せるジョブ数
+        # 渡して開始していないジョブの番号（順序つきの集合）
+        self.queued = OrderedDict()
+        self.running = set()  # 処理中のジョブの番号
+        self.last_seen = time.monotonic()  # 最後にメッセージを受け取った時刻
+
+
+class Coordinator:
+    # ジョブをワーカーに配り、結果を集めるクラス
+    # start() で待ち受けを始め、process() で一括処理を行い、close() でワーカーを終了させる
+    def __init__(
+        self,
+        address,
+        token=None,
+        heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        event_callback=None,
+    ):
+        self.address = address
+        self.token = token  # 指定した場合は同じトークンのワーカーのみ受け付ける
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        # ファイルごとのイベントを受け取る関数（ワーカーで集めて結果とともに送られる）
+        self.event_callback = event_callback
+        self.worker_metrics = {}  # ワーカー名 -> 集計（切断したワーカーのものも残す）
+        # (接続, メッセージ) のキュー。接続が切れるとメッセージはNone
+        self._messages = queue.Queue()
+        self._workers = {}  # 接続 -> WorkerState（hello を受け取ったもの）
+        self._listener = None
+        self._closed = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        # 待ち受けを始める
+        family, target = parse_address(self.address)
+        if family == getattr(socket, "AF_UNIX", None) and os.path.exists(target):
+            os.remove(target)  # 前回のソケットファイルが残っている場合
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(target)
+        listener.listen()
+        self._listener = listener
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def close(self):
+        # ワーカーに終了を伝えて接続を閉じ、待ち受けをやめる
+        self._closed.set()
+        for worker in list(self._workers.values()):
+            self._send(worker, dict(type="shutdown"))
+            close_connection(worker.conn)
+        self._workers.clear()
+        if self._listener is not None:
+            self._listener.close()
+            family, target = parse_address(self.address)
+            if family == getattr(socket, "AF_UNIX", None) and os.path.exists(target):
+                os.remove(target)
+
+    def _accept_loop(self):
+        # 接続を受け付け、接続ごとにメッセージを読み込むスレッドを起動する
+        while not self._closed.is_set():
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return  # 待ち受けを閉じた場合
+            threading.Thread(target=self._read_loop, args=(conn,), daemon=True).start()
+
+    def _read_loop(self, conn):
+        # 受け取ったメッセージをキューに入れる（状態の更新は process() のスレッドで行う）
+        try:
+            for message in read_messages(conn):
+                self._messages.put((conn, message))
+        except OSError:
+            pass
+        self._messages.put((conn, None))
+
+    def _send(self, worker, message):
+        # ワーカーにメッセージを送る（送れない場合は切断として読み込み側で扱う）
+        try:
+            send_message(worker.conn, message)
+        except OSError:
+            pass
+
+    def process(self, jobs, cancel_event=None, start_callback=None):
+        # jobs は process_image か process_variants のキーワード引数の辞書の列
+        # 完了した順に (番号, ジョブ, 結果, 統計情報, 例外) を返すジェネレータ
+        # （process_batch と異なり入力順ではない）
+        # cancel_event がセットされると、新しいジョブを配らず、処理中のジョブも中止する
+        # （中止したジョブは例外 ProcessingCancelled を返す。開始していないジョブは返さない）
+        # start_callback(番号, ジョブ) はワーカーが処理を開始したときに呼ばれる
+        # （ワーカーが停止して配り直した場合は、同じジョブで再度呼ばれる）
+        self._jobs = list(jobs)
+        self._waiting = deque(range(len(self._jobs)))  # 配っていないジョブの番号
+        self._attempts = [0] * len(self._jobs)  # 処理中にワーカーが停止した回数
+        self._finished = set()  # 結果を返したジョブの番号
+        self._stealing = set()  # 取り上げを依頼して返事を待っているジョブの番号
+        self._start_callback = start_callback
+        self._cancelling = False
+        while len(self._finished) < len(self._jobs):
+            if cancel_event is not None and cancel_event.is_set():
+                if not self._cancelling:
+                    # 配っていないジョブを捨て、ワーカーに中止を伝える
+                    self._cancelling = True
+                    self._waiting.clear()
+                    for worker in list(self._workers.values()):
+                        self._send(worker, dict(type="cancel"))
+                if not any(w.queued or w.running for w in self._workers.values()):
+                    return  # 処理中のジョブの結果をすべて受け取った
+            try:
+                conn, message = self._messages.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+            else:
+                yield from self._handle(conn, message)
+            yield from self._check_heartbeats()
+            if not self._cancelling:
+                self._assign()
+
+    def _handle(self, conn, message):
+        # 1つのメッセージを処理し、返す結果を (番号, ジョブ, 結果, 統計情報, 例外) で返す
+        worker = self._workers.get(conn)
+        if message is None:
+            if worker is None:
+                return []
+            return self._remove_worker(worker, "接続が切れました")
+        if not is_valid_worker_message(message, len(self._jobs)):
+            # 不正なメッセージを送った接続のみを切る（登録済みならジョブを配り直す）
+            if worker is None:
+                close_connection(conn)
+                return []
+            return self._remove_worker(worker, "不正なメッセージを受け取りました")
+        if worker is None:
+            if message["type"] == "hello":
+                self._register(conn, message)
+            else:
+                close_connection(conn)
+            return []
+        worker.last_seen = time.monotonic()
+        kind = message["type"]
+        if kind == "request":
+            worker.credits += message["count"]
+        elif kind == "started":
+            job_id = message["id"]
+            worker.queued.pop(job_id, None)
+            self._stealing.discard(job_id)
+            if job_id not in self._finished:
+                worker.running.add(job_id)
+                if self._start_callback:
+                    self._start_callback(job_id, self._jobs[job_id])
+        elif kind == "released":
+            # 取り上げたジョブは、他のワーカーに先に配るよう待ちの先頭に戻す
+            released = [i for i in message["ids"] if i in worker.queued]
+            for job_id in released:
+                del worker.queued[job_id]
+            self._stealing.difference_update(message["ids"])
+            if not self._cancelling:
+                self.worker_metrics[worker.name]["stolen"] += len(released)
+                self._waiting.extendleft(reversed(released))
+        elif kind == "lost":
+            ids = [i for i in message["ids"] if i in worker.running]
+            worker.running.difference_update(ids)
+            return self._retry(worker, ids, "ワーカープロセスが異常終了しました")
+        elif kind == "result":
+            job_id = message["id"]
+            worker.running.discard(job_id)
+            worker.queued.pop(job_id, None)
+            if job_id in self._finished:
+                return []  # 配り直した後に、停止したとみなしたワーカーから届いた結果
+            try:
+                result = decode_result(message.get("result"))
+            except (AttributeError, TypeError, ValueError):
+                # 結果の項目が ImageResult と合わない場合
+                return self._remove_worker(worker, "不正な結果を受け取りました")
+            self._finished.add(job_id)
+            stats = message.get("stats") or {}
+            error = decode_error(message.get("error"))
+            self._record(worker, stats, error)
+            for event in stats.pop("events", ()):
+                self.event_callback(event)
+            return [
+                (
+                    job_id,
+                    self._jobs[job_id],
+                    result,
+                    stats,
+                    error,
+                )
+            ]
+        return []
+
+    def _register(self, conn, message):
+        # 接続したワーカーを登録する（トークンかバージョンが異なる場合は拒否する）
+        reason = None
+        if message.get("version") != PROTOCOL_VERSION:
+            reason = f"通信の形式のバージョンが異なります: {message.get('version')}"
+        elif self.token and not hmac.compare_digest(
+            str(message.get("token") or ""), self.token
+        ):
+            reason = "トークンが正しくありません"
+        if reason is not None:
+            try:
+                send_message(conn, dict(type="error", message=reason))
+            except OSError:
+                pass
+            close_connection(conn)
+            return
+        worker = WorkerState(conn, message["worker"], message["slots"])
+        worker.credits = message["count"]
+        self._workers[conn] = worker
+        metrics = self.worker_metrics.setdefault(
+            worker.name,
+            dict(
+                slots=worker.slots,
+                jobs=0,  # 結果を返したジョブ数
+                errors=0,
+                cancelled=0,
+                lost=0,  # 処理中に停止したジョブ数
+                stolen=0,  # 他のワーカーに配り直すために取り上げたジョブ数
+                encodes=0,
+                busy_seconds=0.0,  # ジョブの処理時間の合計
+                bytes_written=0,
+                timings={},  # 工程名 -> 合計時間（秒）
+                connections=0,
+            ),
+        )
+        metrics["connections"] += 1
+
+    def _record(self, worker, stats, error):
+        # ワーカーごとの集計に結果を加える
+        metrics = self.worker_metrics[worker.name]
+        metrics["jobs"] += 1
+        if isinstance(error, ProcessingCancelled):
+            metrics["cancelled"] += 1
+        elif error is not None:
+            metrics["errors"] += 1
+        metrics["encodes"] += stats.get("encodes") or 0
+        metrics["busy_seconds"] += stats.get("total_seconds") or 0.0
+        metrics["bytes_written"] += stats.get("bytes_written") or 0
+        for name, seconds in (stats.get("timings") or {}).items():
+            metrics["timings"][name] = metrics["timings"].get(name, 0.0) + seconds
+
+    def _remove_worker(self, worker, reason):
+        # 停止したワーカーを外し、そのワーカーのジョブを配り直す
+        del self._workers[worker.conn]
+        close_connection(worker.conn)
+        # 開始していないジョブはそのまま、処理中のジョブは停止の回数を数えて配り直す
+        queued = [i for i in worker.queued if i not in self._finished]
+        self._stealing.difference_update(queued)
+        if not self._cancelling:
+            self._waiting.extendleft(reversed(queued))
+        return self._retry(worker, list(worker.running), reason)
+
+    def _retry(self, worker, ids, reason):
+        # 処理中に停止したジョブを配り直す（上限を超えたものはエラーとして返す）
+        results = []
+        self.worker_metrics[worker.name]["lost"] += len(ids)
+        for job_id in ids:
+            if job_id in self._finished or self._cancelling:
+                continue
+            self._attempts[job_id] += 1
+            if self._attempts[job_id] < self.max_attempts:
+                self._waiting.appendleft(job_id)
+                continue
+            self._finished.add(job_id)
+            error = RemoteJobError(
+                f"{reason}（{worker.name}、{self._attempts[job_id]} 回目）"
+            )
+            results.append((job_id, self._jobs[job_id], None, {}, error))
+        return results
+
+    def _check_heartbeats(self):
+        # ハートビートが途絶えたワーカーを外す
+        now = time.monotonic()
+        results = []
+        for worker in list(self._workers.values()):
+            if now - worker.last_seen > self.heartbeat_timeout:
+                results += self._remove_worker(worker, "ワーカーが応答しません")
+        return results
+
+    def _assign(self):
+        # 待っているジョブを、受け取れるワーカーに1つずつ順に配る
+        # 並列数に空きがあるワーカーを先にする（取り上げたジョブを元のワーカーに戻さない）
+        ready = sorted(
+            (w for w in self._workers.values() if w.credits > 0),
+            key=lambda w: (len(w.queued) + len(w.running)) / w.slots,
+        )
+        while self._waiting and ready:
+            for worker in list(ready):
+                if not self._waiting:
+                    break
+                job_id = self._waiting.popleft()
+                self._send(
+                    worker,
+                    dict(
+                        type="job",
+                        id=job_id,
+                        job=encode_job(self._jobs[job_id]),
+                        collect_events=self.event_callback is not None,
+                    ),
+                )
+                worker.queued[job_id] = None
+                worker.credits -= 1
+                if worker.credits == 0:
+                    ready.remove(worker)
+        if not self._waiting and not self._stealing:
+            # 受け取ったジョブがなく、並列数に空きがあるワーカーのために取り上げる
+            self._steal([w for w in ready if not w.queued and len(w.running) < w.slots])
+
+    def _steal(self, idle):
+        # 配るジョブがなく、空いているワーカーがある場合、開始していないジョブを
+        # 最も多く持つワーカーから半分を取り上げる（返ってきたら空いているワーカーに配る）
+        if not idle:
+            return
+        victims = [w for w in self._workers.values() if w not in idle and w.queued]
+        if not victims:
+            return
+        victim = max(victims, key=lambda w: len(w.queued))
+        ids = list(victim.queued)[-((len(victim.queued) + 1) // 2) :]  # 後に渡した分
+        self._stealing.update(ids)
+        self._send(victim, dict(type="steal", ids=ids))
+
+
+class DistributedWorker:
+    # コーディネーターからジョブを受け取り、プロセスプールで処理して結果を返すクラス
+    # 接続が切れた場合は再接続を試み、shutdown を受け取るか再接続できなければ終了する
+    # （接続を拒否された場合は WorkerRejected を送出する）
+    def __init__(
+        self,
+        address,
+        slots=DEFAULT_WORKERS,
+        name=None,
+        token=None,
+        cache=None,
+        job_memory_budget_mb=None,
+        prefetch=DEFAULT_PREFETCH_JOBS,
+        heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+        reconnect_seconds=DEFAULT_RECONNECT_SECONDS,
+    ):
+        self.address = address
+        self.slots = max(slots, 1)
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.token = token
+        self.cache = cache  # このワーカーで使う処理結果のキャッシュ
+        # 同時に処理する画像のメモリの予算（process_batch と同じく推定したピークメモリで判定）
+        self.budget_bytes = (
+            None
+            if job_memory_budget_mb is None
+            else int(job_memory_budget_mb * 1024 * 1024)
+        )
+        self.prefetch = prefetch
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_seconds = reconnect_seconds
+
+    def run(self):
+        # 終了するまでジョブを処理する
+        family, target = parse_address(self.address)
+        deadline = time.monotonic() + self.reconnect_seconds
+        while True:
+            conn = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                conn.connect(target)
+            except OSError:
+                conn.close()
+                if time.monotonic() >= deadline:
+                    return
+                time.sleep(1)
+                continue
+            if self._serve(conn):
+                return
+            deadline = time.monotonic() + self.reconnect_seconds
+
+    def _serve(self, conn):
+        # 1つの接続でジョブを処理する（終了する場合はTrue、接続が切れた場合はFalseを返す）
+        send_lock = threading.Lock()
+        # backlog、running、executor の保護（完了済みの Future のコールバックは
+        # 登録したスレッドでそのまま呼ばれるため、同じスレッドから再度取得できるもの）
+        lock = threading.RLock()
+        stop = threading.Event()
+        cancel_event = multiprocessing.Event()
+        backlog = deque()  # (番号, ジョブ, 確保するバイト数, イベントを集めるかどうか)
+        running = {}  # 番号 -> 確保したバイト数
+        executor = create_worker_pool(self.slots, cancel_event)
+        # 異常終了して作り直したプール（コールバックのスレッドからは終了を待てないため、
+        # 接続を終えるときにまとめて待つ）
+        broken_pools = []
+
+        # メッセージを送る関数（接続が切れていれば何もしない）
+        def send(**message):
+            with send_lock:
+                try:
+                    send_message(conn, message)
+                except OSError:
+                    pass
+
+        # 空いている並列数とメモリの予算の分だけジョブを開始する関数（lock の中で呼ぶ）
+        # キャンセルで中止しているジョブがある間は、新しいジョブを開始しない
+        def dispatch():
+            while backlog and len(running) < self.slots and not cancel_event.is_set():
+                job_id, job, nbytes, collect_events = backlog[0]
+                if self.budget_bytes is not None and running:
+                    if sum(running.values()) + nbytes > self.budget_bytes:
+                        break
+                backlog.popleft()
+                running[job_id] = nbytes
+                send(type="started", id=job_id)
+                pool = executor
+                future = pool.submit(run_job, job, collect_events=collect_events)
+                future.add_done_callback(
+                    lambda f, job_id=job_id, pool=pool: finished(job_id, f, pool)
+                )
+
+        # 処理中のジョブから外す関数（lock の中で呼ぶ）
+        # キャンセルで中止したジョブがすべて終わったら、以降のジョブのためにイベントを戻す
+        # （プールのワーカーにはイベントを作成時にしか渡せないため、作り直さずに戻す）
+        def job_done(job_id):
+            running.pop(job_id, None)
+            if not running and not stop.is_set():
+                cancel_event.clear()
+
+        # ジョブの処理が終わったときに呼ばれる関数（pool はジョブを投入したプール）
+        def finished(job_id, future, pool):
+            nonlocal executor
+            if stop.is_set():
+                return  # 終了中に中止したジョブは、結果を返さずに配り直してもらう
+            try:
+                result, stats, error = future.result()
+            except BrokenProcessPool:
+                # プロセスが異常終了した場合はプールを作り直し、配り直しを依頼する
+                # （同じプールの他のジョブも失敗するため、作り直すのは最初の1回のみ）
+                with lock:
+                    job_done(job_id)
+                    if pool is executor:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        broken_pools.append(executor)
+                        executor = create_worker_pool(self.slots, cancel_event)
+                    send(type="lost", ids=[job_id])
+                    send(type="request", count=1)
+                    dispatch()
+                return
+            except Exception as e:
+                result, stats, error = None, {}, e
+            with lock:
+                job_done(job_id)
+                send(
+                    type="result",
+                    id=job_id,
+                    result=encode_result(result),
+                    stats=stats,
+                    error=encode_error(error),
+                )
+                send(type="request", count=1)
+                dispatch()
+
+        # 開始していないジョブを返す関数（lock の中で呼ぶ）
+        def release(ids=None):
+            released = [item[0] for item in backlog if ids is None or item[0] in ids]
+            kept = [item for item in backlog if ids is not None and item[0] not in ids]
+            backlog.clear()
+            backlog.extend(kept)
+            send(type="released", ids=released)
+            if released:
+                send(type="request", count=len(released))
+
+        # 一定の間隔でハートビートを送る関数
+        def heartbeat():
+            while not stop.wait(self.heartbeat_interval):
+                with lock:
+                    status = dict(running=len(running), queued=len(backlog))
+                send(type="heartbeat", **status)
+
+        send(
+            type="hello",
+            version=PROTOCOL_VERSION,
+            worker=self.name,
+            slots=self.slots,
+            count=self.slots + self.prefetch,
+            token=self.token,
+        )
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            for message in read_messages(conn):
+                kind = message.get("type")
+                if kind == "job":
+                    job = decode_job(message["job"], self.cache)
+                    # 単独でも予算に収まらない画像は低メモリの処理にする
+                    job, nbytes = plan_job(job, self.budget_bytes)
+                    with lock:
+                        backlog.append(
+                            (message["id"], job, nbytes, message["collect_events"])
+                        )
+                        dispatch()
+                elif kind == "steal":
+                    with lock:
+                        release(set(message["ids"]))
+                elif kind == "cancel":
+                    with lock:
+                        if running:
+                            # 処理中のジョブはエンコードの1回以内に中止する
+                            cancel_event.set()
+                        release()
+                elif kind == "shutdown":
+                    return True
+                elif kind == "error":
+                    raise WorkerRejected(message.get("message"))
+            return False
+        except OSError:
+            return False
+        finally:
+            # 結果を返せなくなったジョブは中止する（コーディネーターが配り直す）
+            stop.set()
+            cancel_event.set()
+            with lock:
+                backlog.clear()
+            executor.shutdown(wait=True)
+            for pool in broken_pools:
+                pool.shutdown(wait=True)
+            conn.close()
+
+
+# ローカルのワーカープロセスで実行する関数（start_local_workers から起動される）
+def _run_local_worker(address, slots, name, options):
+    # Ctrl+C はコーディネーターがキャンセルとして伝えるため、ワーカーでは無視する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    DistributedWorker(address, slots, name=name, **options).run()
+
+
+# 同じマシンでワーカーのプロセスを起動する関数（動作確認や1台での分散処理用）
+# 起動したプロセスのリストを返す（コーディネーターの close() で終了する）
+def start_local_workers(address, count, slots=1, **options):
+    processes = []
+    for index in range(count):
+        process = multiprocessing.Process(
+            target=_run_local_worker,
+            args=(address, slots, f"local-{index + 1}", options),
+        )
+        process.start()
+        processes.append(process)
+    return processes
@@ -0,0 +1,89 @@
+import os
+from imagesizer_core import SUPPORTED_EXTENSIONS
+
+# 入力ファイルの受け付け（フォルダの探索、画像ファイルの判定、重複の除去）
+
+# 画像形式ごとのファイル先頭のバイト列
+IMAGE_SIGNATURES = (
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+    b"BM",  # BMP
+    b"II*\x00",  # TIFF（リトルエンディアン）
+    b"MM\x00*",  # TIFF（ビッグエンディアン）
+    b"GIF87a",  # GIF
+    b"GIF89a",  # GIF
+)
+# WebPはRIFF形式で、先頭の "RIFF" とサイズの後に "WEBP" が続く
+WEBP_SIGNATURE = (b"RIFF", b"WEBP")
+# 判定に読み込むバイト数
+SIGNATURE_LENGTH = max(max(len(signature) for signature in IMAGE_SIGNATURES), 12)
+
+
+# 重複を判定するためのパスのキーを作成する関数（大文字小文字や相対パスの違いを吸収する）
+def path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+# ファイルの先頭が対応する画像形式のものかどうかを判定する関数
+def has_image_signature(path):
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SIGNATURE_LENGTH)
+    except OSError:
+        return False
+    if head[:4] == WEBP_SIGNATURE[0] and head[8:12] == WEBP_SIGNATURE[1]:
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+# 拡張子とファイルの先頭から画像ファイルかどうかを判定する関数
+def is_image_file(path, check_signature=True):
+    if os.path.splitext(path)[1].lower() not in SUPPORTED_EXTENSIONS:
+        return False
+    return not check_signature or has_image_signature(path)
+
+
+# フォルダ内の画像ファイルのパスを順に返すジェネレータ
+# 各フォルダのファイルを名前順に返してから、サブフォルダを名前順に探索する
+def scan_directory(directory, recursive=True, check_signature=True):
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue  # 読み込めないフォルダは飛ばす
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue  # 隠しファイルと隠しフォルダは除く
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                    continue
+            except OSError:
+                continue
+            if is_image_file(entry.path, check_signature):
+                yield entry.path
+        if recursive:
+            stack.extend(reversed(subdirs))
+
+
+# ファイルとフォルダのパスを画像ファイルのパスに展開するジェネレータ（重複は除く）
+def iter_image_files(paths, recursive=True, check_signature=True, seen=None):
+    # seen を渡すと、既に追加済みのパスのキーとして使い、新しいキーを追加する
+    if seen is None:
+        seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = scan_directory(path, recursive, check_signature)
+        elif is_image_file(path, check_signature):
+            candidates = (path,)
+        else:
+            continue
+        for candidate in candidates:
+            key = path_key(candidate)
+            if key not in seen:
+                seen.add(key)
+                yield candidate
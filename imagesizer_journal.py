@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import threading
+from imagesizer_cache import TEMP_PREFIX, TEMP_SUFFIX
+from imagesizer_metrics import ProcessingCancelled
+
+# 一括処理のジャーナル（処理対象の一覧とファイルごとの状態の記録）
+# 処理を始める前にすべてのファイルを pending として記録し、ワーカーに渡す前に running、
+# 出力画像を書き込んだ後に done か failed を追記する。異常終了した場合も、再開時には
+# done と failed 以外のファイルだけを処理し直せる。出力画像は一時ファイルに書き込んでから
+# 置き換えるため、書きかけのファイルが完成した出力として残ることはない
+
+# ジャーナルの形式のバージョン
+JOURNAL_VERSION = 1
+# ファイルの状態
+PENDING = "pending"  # 未処理
+RUNNING = "running"  # 処理中（再開時は未処理として扱う）
+DONE = "done"  # 出力画像の書き込みまで完了
+FAILED = "failed"  # 処理に失敗（再開時は処理し直さない）
+FINISHED_STATES = (DONE, FAILED)
+
+
+# GUIで使うジャーナルのパスの既定値を取得する関数
+def default_journal_path():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "ImageSizer", "journal.jsonl")
+    base = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(base, "imagesizer", "journal.jsonl")
+
+
+# 処理内容をジャーナルに記録できる形（JSONで表せる値のみ）に変換する関数
+# （キャッシュなど、実行ごとに指定するオブジェクトは含めない）
+def journal_options(options):
+    return json.loads(
+        json.dumps(
+            {key: value for key, value in options.items() if key != "cache"},
+            sort_keys=True,
+        )
+    )
+
+
+class BatchJournal:
+    # 一括処理の対象とファイルごとの状態を JSON Lines 形式で記録するクラス
+    # 1行目は処理内容（マニフェスト）、以降はファイルごとの状態の変化で、同じファイルは
+    # 後の記録が優先される。複数のスレッドから記録できる
+    def __init__(self, path):
+        self.path = path
+        self.options = None  # マニフェストの処理内容（ジャーナルがなければNone）
+        self.jobs = {}  # 入力パス -> 状態の記録（辞書）。マニフェストの順に並ぶ
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        # ジャーナルを読み込む（書きかけの最後の行は無視する）
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("type") == "manifest":
+                    if record.get("version") != JOURNAL_VERSION:
+                        return  # 形式が異なるジャーナルは使わない
+                    self.options = record["options"]
+                elif record.get("type") == "job" and self.options is not None:
+                    self.jobs.setdefault(record["input"], {}).update(record)
+
+    def _append(self, records, sync):
+        # 記録を追記する（sync の場合はディスクへの書き込みを待つ）
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+
+    def start(self, options, jobs):
+        # 新しい一括処理を始める（以前の記録は消す）
+        # jobs は入力パスと出力フォルダを含むジョブの辞書の列
+        options = journal_options(options)
+        manifest = dict(
+            type="manifest",
+            version=JOURNAL_VERSION,
+            created=time.time(),
+            options=options,
+        )
+        records = [
+            dict(
+                type="job",
+                input=job["input_path"],
+                output_folder=job["output_folder"],
+                status=PENDING,
+            )
+            for job in jobs
+        ]
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # 一時ファイルに書き込んでから置き換え、途中で終了しても以前の記録を壊さない
+            temp_path = self.path + TEMP_SUFFIX
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for record in [manifest] + records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.options = options
+            self.jobs = {record["input"]: record for record in records}
+
+    def matches(self, options):
+        # ジャーナルの処理内容が指定の処理内容と同じかどうかを返す
+        return self.options is not None and self.options == journal_options(options)
+
+    def unfinished(self):
+        # 完了していない（pending か running の）ファイルのジョブをマニフェストの順に返す
+        return [
+            dict(input_path=record["input"], output_folder=record["output_folder"])
+            for record in self.jobs.values()
+            if record["status"] not in FINISHED_STATES
+        ]
+
+    def counts(self):
+        # 状態ごとのファイル数を返す
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for record in self.jobs.values():
+            counts[record["status"]] += 1
+        return counts
+
+    def mark(self, input_path, status, **fields):
+        # ファイルの状態を記録する
+        # running は処理を始める前の記録で、失われても再開時の扱いは同じため同期しない
+        record = dict(type="job", input=input_path, status=status, **fields)
+        with self._lock:
+            self._append([record], sync=status in FINISHED_STATES)
+            self.jobs.setdefault(input_path, {}).update(record)
+
+    def mark_running(self, index, job):
+        # ジョブをワーカーに渡す前に呼ばれる（process_batch の start_callback）
+        self.mark(job["input_path"], RUNNING)
+
+    def record_result(self, job, result, error):
+        # 処理結果から完了か失敗を記録する（キャンセルされたファイルは未処理のまま残す）
+        if isinstance(error, ProcessingCancelled):
+            return
+        if error is not None:
+            self.mark(
+                job["input_path"], FAILED, error=f"{type(error).__name__}: {error}"
+            )
+            return
+        results = result if isinstance(result, list) else [result]
+        outputs = [r.output_path for r in results]
+        status = DONE if None not in outputs else FAILED
+        self.mark(job["input_path"], status, outputs=outputs)
+
+    def discard(self):
+        # ジャーナルを削除する
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.options = None
+            self.jobs = {}
+
+
+# 書き込み途中で終了した出力の一時ファイルを、出力フォルダから削除する関数
+# （削除したファイル数を返す）
+def remove_stale_temp_files(output_folders):
+    removed = 0
+    for folder in set(output_folders):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith(TEMP_PREFIX) and entry.name.endswith(TEMP_SUFFIX):
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
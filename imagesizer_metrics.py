@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# 処理時間などの計測と、プロファイリングの機能
+
+
+class ProcessingCancelled(Exception):
+    # 処理がキャンセルされたことを示す例外（ワーカープロセスから結果として返せる）
+    pass
+
+
+class FileMetrics:
+    # 1枚の画像の処理について、工程ごとの時間とイテレーションごとの結果を記録するクラス
+    # event_callback を指定すると、記録するたびにイベント（辞書）を渡す
+    # fields を指定すると、すべてのイベントに追加する（バリアントの番号など）
+    # cancel_event を指定すると、セットされた後のイテレーションの記録で処理を中止する
+    def __init__(self, input_path, event_callback=None, fields=None, cancel_event=None):
+        self.input_path = input_path
+        self.event_callback = event_callback
+        self.fields = fields or {}
+        self.cancel_event = cancel_event
+        self.stages = {}  # 工程名 -> 合計時間（秒）
+        self.iterations = 0  # エンコード回数
+        self.prediction_error = None  # サイズの予測の誤差（予測した場合のみ）
+        self._lock = threading.Lock()  # 複数のスレッドから記録する場合のため
+        self._start = time.perf_counter()
+
+    def emit(self, event, **fields):
+        # イベントを送る
+        if self.event_callback:
+            self.event_callback(
+                dict(event=event, input=self.input_path, **self.fields, **fields)
+            )
+
+    def check_cancelled(self):
+        # キャンセルされていれば ProcessingCancelled を送出する
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self.emit("cancelled")
+            raise ProcessingCancelled(f"キャンセルされました: {self.input_path}")
+
+    def add(self, name, seconds):
+        # 工程の時間を加算する
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        # with ブロックの処理時間を工程の時間として記録する
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(name, seconds)
+            self.emit("stage", stage=name, seconds=round(seconds, 6))
+
+    def iteration(
+        self,
+        scale,
+        quality,
+        size,
+        resize_seconds,
+        encode_seconds,
+        nbytes,
+        **fields,
+    ):
+        # 探索の1回分（リサイズとエンコード）の結果を記録する
+        # fields はイベントに加える値（Noneは除く）。kind は高速な設定での探索（"fast"）か
+        # 最終出力の設定（"final"）かの区別、アニメーションでは色数とフレームの間引きなど
+        with self._lock:
+            self.iterations += 1
+            iteration = self.iterations
+        self.add("resize", resize_seconds)
+        self.add("encode", encode_seconds)
+        self.emit(
+            "iteration",
+            iteration=iteration,
+            scale=scale,
+            quality=quality,
+            width=size[0],
+            height=size[1],
+            resize_seconds=round(resize_seconds, 6),
+            encode_seconds=round(encode_seconds, 6),
+            bytes=nbytes,
+            **{key: value for key, value in fields.items() if value is not None},
+        )
+        # エンコードの1回ごとにキャンセルを確認する（処理中のファイルもここで止まる）
+        self.check_cancelled()
+
+    def prediction(self, scale, quality, predicted_bytes, nbytes):
+        # 予測した開始点を実際にエンコードした結果と、予測の誤差を記録する
+        self.prediction_error = nbytes / predicted_bytes - 1
+        self.emit(
+            "prediction",
+            scale=scale,
+            quality=quality,
+            predicted_bytes=int(predicted_bytes),
+            bytes=nbytes,
+            error=round(self.prediction_error, 4),
+        )
+
+    def finish(self, stats, output_path, scale=None, quality=None, nbytes=None):
+        # 処理全体の結果を stats に書き込み、完了のイベントを送る（集計の辞書を返す）
+        total = time.perf_counter() - self._start
+        summary = dict(
+            encodes=self.iterations,
+            scale=scale,
+            quality=quality,
+            bytes_written=nbytes,
+            timings={name: round(s, 6) for name, s in self.stages.items()},
+            total_seconds=round(total, 6),
+        )
+        if self.prediction_error is not None:
+            summary["prediction_error"] = round(self.prediction_error, 4)
+        if stats is not None:
+            # キャッシュの有無などは呼び出し元で設定済みのものを優先する
+            for key, value in summary.items():
+                stats.setdefault(key, value)
+        self.emit("file", output=output_path, **summary)
+        return summary
+
+
+class JsonLinesLogger:
+    # イベントをJSON Lines形式でファイルに追記するクラス（複数のスレッドから呼べる）
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# 関数を cProfile と tracemalloc を有効にして実行し、結果をフォルダに書き出す関数
+def run_profiled(func, profile_dir, label, *args, **kwargs):
+    os.makedirs(profile_dir, exist_ok=True)
+    base = os.path.join(profile_dir, label)
+    profiler = cProfile.Profile()
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        # CPU時間のプロファイル（snakeviz や pstats で読める）
+        profiler.dump_stats(base + ".prof")
+        # メモリ確保の多い箇所と、ピークのメモリ使用量
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        with open(base + ".tracemalloc.txt", "w", encoding="utf-8") as f:
+            f.write(f"current: {current / 1024 / 1024:.2f} MB\n")
+            f.write(f"peak: {peak / 1024 / 1024:.2f} MB\n\n")
+            for stat in snapshot.statistics("lineno")[:30]:
+                f.write(f"{stat}\n")
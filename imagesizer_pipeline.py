@@ -0,0 +1,323 @@
+import io
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from imagesizer_core import (
+    DEFAULT_WORKERS,
+    create_worker_pool,
+    matches_patterns,
+    plan_job,
+    run_job,
+    write_atomic,
+)
+
+# 読み込み → 処理（デコード、クロップ、リサイズ、エンコード）→ 書き込み のパイプライン
+# 読み込みと書き込みはスレッドで、処理はワーカープロセスで行い、段の間は長さの上限がある
+# キューでつなぐ。次のファイルの読み込みと前のファイルの書き込みが処理と重なるため、
+# ネットワーク上のフォルダなど入出力が遅い場合でもCPUを遊ばせずに済む
+
+# 先読みするファイル数の既定値
+DEFAULT_PREFETCH = 4
+# 先読みした元画像と書き込み待ちの出力画像に使うメモリの上限の既定値（MB）
+DEFAULT_PREFETCH_MEMORY_MB = 256
+# 停止の確認間隔（秒）
+_POLL_SECONDS = 0.1
+
+
+class MemoryBudget:
+    # 先読みと書き込み待ちのバイト数の合計を上限以下に保つクラス
+    # 上限より大きいファイルでも、他に使用中のものがなければ受け付ける
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.used = 0
+        self.output_used = 0  # used のうち書き込み待ちの出力画像のバイト数
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes, stop_event=None):
+        # 空きができるまで待って確保する（停止された場合はFalseを返す）
+        with self._condition:
+            while self.used and self.used + nbytes > self.limit_bytes:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self._condition.wait(_POLL_SECONDS)
+            self.used += nbytes
+            return True
+
+    def acquire_output(self, nbytes):
+        # 書き込み待ちの出力画像の分を確保する
+        # 待つのは書き込み待ちのものがある間のみ（先読みした元画像は処理結果を受け取った
+        # 後にしか解放されないため、その解放を待つと止まってしまう）
+        with self._condition:
+            while self.output_used and self.used + nbytes > self.limit_bytes:
+                self._condition.wait(_POLL_SECONDS)
+            self.used += nbytes
+            self.output_used += nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+    def release_output(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self.output_used -= nbytes
+            self._condition.notify_all()
+
+
+# キューに入れる関数（停止された場合はFalseを返す）
+def _put(q, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# パイプラインで画像を一括処理するジェネレータ（process_batch と同じ形式で入力順に返す）
+# prefetch は先読みするファイル数、memory_budget_mb は先読みと書き込み待ちに使うメモリの上限
+def process_pipeline(
+    jobs,
+    max_workers=DEFAULT_WORKERS,
+    prefetch=DEFAULT_PREFETCH,
+    memory_budget_mb=DEFAULT_PREFETCH_MEMORY_MB,
+    max_inflight=None,
+    progress_callback=None,
+    event_callback=None,
+    profile_patterns=None,
+    profile_dir="profiles",
+    job_memory_budget_mb=None,
+    cancel_event=None,
+    start_callback=None,
+):
+    # job_memory_budget_mb は process_batch と同じく、同時に実行するジョブのピークメモリの予算
+    # cancel_event と start_callback も process_batch と同じ
+    # （キャンセルされると、先読みと投入を止め、処理中のジョブも中止する）
+    budget = MemoryBudget(int(memory_budget_mb * 1024 * 1024))
+    job_budget_bytes = (
+        None
+        if job_memory_budget_mb is None
+        else int(job_memory_budget_mb * 1024 * 1024)
+    )
+    stop_event = threading.Event()
+    read_queue = queue.Queue(maxsize=max(prefetch, 1))  # 読み込み済みの元画像
+    write_queue = queue.Queue(maxsize=max(prefetch, 1))  # 書き込み待ちの処理結果
+    done_queue = queue.Queue()  # 書き込みが終わった処理結果
+    finished = object()  # 各段の終わりを示す目印
+
+    # キャンセルされたかどうかを返す関数
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    # 元画像を順に読み込む関数（読み込みスレッド）
+    def read_stage():
+        try:
+            for index, job in enumerate(jobs):
+                if cancelled():
+                    return
+                try:
+                    nbytes = os.path.getsize(job["input_path"])
+                    if not budget.acquire(nbytes, stop_event):
+                        return
+                    with open(job["input_path"], "rb") as f:
+                        data = f.read()
+                    error = None
+                except OSError as e:
+                    # 読み込めないファイルは処理せずにエラーとして返す
+                    nbytes, data, error = 0, None, e
+                # 処理に使うメモリの推定は、読み込んだバイト列のヘッダーから行う
+                reserve = 0
+                if data is not None:
+                    job, reserve = plan_job(
+                        dict(job, source_bytes=data), job_budget_bytes
+                    )
+                    job.pop("source_bytes")
+                item = (index, job, data, nbytes, reserve, error)
+                if not _put(read_queue, item, stop_event):
+                    budget.release(nbytes)
+                    return
+        finally:
+            _put(read_queue, finished, stop_event)
+
+    # 処理結果の出力画像を順に書き込む関数（書き込みスレッド）
+    def write_stage():
+        while True:
+            try:
+                item = write_queue.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                if stop_event.is_set():
+                    return
+                continue
+            if item is finished:
+                done_queue.put(finished)
+                return
+            index, job, result, stats, error = item
+            results = result if isinstance(result, list) else [result]
+            for r in results:
+                if r is None or r.data is None:
+                    continue
+                nbytes = len(r.data)
+                start = time.perf_counter()
+                try:
+                    write_atomic(io.BytesIO(r.data), r.output_path)
+                except OSError as e:
+                    if error is None:
+                        error = e
+                finally:
+                    r.data = None
+                    budget.release_output(nbytes)
+                # 書き込みの時間を処理結果と統計情報に加える
+                seconds = round(time.perf_counter() - start, 6)
+                r.timings["write"] = r.timings.get("write", 0.0) + seconds
+                timings = stats.setdefault("timings", {})
+                timings["write"] = timings.get("write", 0.0) + seconds
+            done_queue.put((index, job, result, stats, error))
+
+    # 処理をワーカーに投入する関数
+    # （memory_limit_mb に収まる出力画像のみ書き込みスレッドに返され、
+    # それより大きいものはワーカーがディスクに退避したバッファから直接書き込む）
+    def submit(index, job, data):
+        job = dict(job, source_bytes=data, return_data=True)
+        profile_dir_for_job = (
+            profile_dir
+            if matches_patterns(job["input_path"], profile_patterns)
+            else None
+        )
+        if executor_is_process:
+            return executor.submit(
+                run_job,
+                job,
+                collect_events=event_callback is not None,
+                profile_dir=profile_dir_for_job,
+            )
+        return executor.submit(
+            run_job,
+            job,
+            progress_callback=(
+                (lambda p, index=index: progress_callback(index, p))
+                if progress_callback
+                else None
+            ),
+            event_callback=event_callback,
+            profile_dir=profile_dir_for_job,
+            cancel_event=cancel_event,
+        )
+
+    # ワーカー数が1の場合はスレッドで処理する（progress_callback はこの場合のみ呼ばれる）
+    executor_is_process = max_workers > 1
+    if max_inflight is None:
+        max_inflight = max_workers * 2
+    executor = (
+        create_worker_pool(max_workers, cancel_event)
+        if executor_is_process
+        else ThreadPoolExecutor(max_workers=1)
+    )
+    reader = threading.Thread(target=read_stage, daemon=True)
+    writer = threading.Thread(target=write_stage, daemon=True)
+    reader.start()
+    writer.start()
+    # (番号, ジョブ, 元画像, 元画像のバイト数, 処理に確保したバイト数, Future) を投入順に保持
+    pending = deque()
+    waiting = None  # メモリの予算に収まらず投入を待っている読み込み済みの元画像
+    reading = True
+    completed = False  # すべての結果を返し終わったかどうか
+    try:
+        while True:
+            # 読み込み済みの元画像を上限まで投入する（処理中のものがなければ読み込みを待つ。
+            # 処理に使うメモリの予算に収まらない場合は実行中のものを待つ）
+            while (reading or waiting is not None) and len(pending) < max_inflight:
+                if cancelled():
+                    # キャンセルされた場合は、読み込み済みで投入していないものを捨てる
+                    # （投入済みのジョブは中止されて返ってくる）
+                    if waiting is not None:
+                        budget.release(waiting[3])
+                        waiting = None
+                    reading = False
+                    break
+                if waiting is None:
+                    try:
+                        item = read_queue.get(block=not pending, timeout=None)
+                    except queue.Empty:
+                        break
+                    if item is finished:
+                        reading = False
+                        break
+                    waiting = item
+                index, job, data, nbytes, reserve, error = waiting
+                if job_budget_bytes is not None:
+                    running = sum(p[4] for p in pending if not p[5].done())
+                    if running and running + reserve > job_budget_bytes:
+                        break
+                waiting = None
+                if error is not None:
+                    # 読み込みに失敗したファイルは処理せず、順番を保つため完了済みとして並べる
+                    future = Future()
+                    future.set_result((None, {}, error))
+                else:
+                    if start_callback:
+                        start_callback(index, job)
+                    future = submit(index, job, data)
+                pending.append((index, job, data, nbytes, reserve, future))
+
+            # 書き込みが終わったものを入力順に返す
+            while True:
+                try:
+                    item = done_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is finished:
+                    completed = True
+                    return
+                yield item
+
+            if not pending:
+                if not reading and waiting is None:
+                    # すべて投入し終わったら書き込み段を終わらせ、残りを返す
+                    _put(write_queue, finished, stop_event)
+                    while True:
+                        item = done_queue.get()
+                        if item is finished:
+                            completed = True
+                            return
+                        yield item
+                continue
+
+            # 先頭のジョブの完了を待ち、書き込み段に渡す
+            index, job, data, nbytes, reserve, future = pending.popleft()
+            try:
+                result, stats, error = future.result()
+            except BrokenProcessPool as e:
+                # ワーカーが異常終了した場合、このファイルを失敗として扱い、
+                # プールを作り直して残りのジョブを再投入する
+                result, stats, error = None, {}, e
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = create_worker_pool(max_workers, cancel_event)
+                pending = deque(
+                    (i, j, d, n, r, submit(i, j, d) if d is not None else f)
+                    for i, j, d, n, r, f in pending
+                )
+            budget.release(nbytes)  # 元画像の処理が終わった
+            # 書き込み待ちの出力画像が予算を超える場合は、書き込みが進むまで受け取りを待つ
+            # （その間は次のジョブの投入も止まる）
+            for r in result if isinstance(result, list) else [result]:
+                if r is not None and r.data is not None:
+                    budget.acquire_output(len(r.data))
+            for event in stats.pop("events", ()):
+                event_callback(event)
+            _put(write_queue, (index, job, result, stats, error), stop_event)
+    finally:
+        stop_event.set()
+        if completed:
+            # 最後まで返した場合（キャンセルで打ち切った場合を含む）はワーカーの終了を待つ
+            # （待たないと、終了時に閉じたパイプへの書き込みでエラーが表示される。
+            # キャンセルされた処理中のジョブはエンコードの1回以内に中止する）
+            executor.shutdown(wait=True, cancel_futures=cancelled())
+        else:
+            # 途中で中断された場合は、残りのジョブを取り消して待たずに戻る
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,247 @@
+import io
+import os
+import math
+import threading
+from collections import OrderedDict
+from PIL import Image, JpegImagePlugin
+from imagesizer_core import (
+    MAX_UPSCALE_RATIO,
+    PROXY_PIXELS,
+    ResizeSource,
+    encode_image,
+    get_crop_box,
+    get_encode_options,
+    get_save_format,
+    pixel_bytes,
+    pixel_target_size,
+)
+from imagesizer_smartcrop import find_crop_box
+
+# GUIのプレビュー（クロップ範囲と、出力の幅、高さ、ファイルサイズの見積もり）
+# 元画像は見積もりに使える大きさ（プロキシ）に縮小してデコードし、クロップごとの
+# エンコード結果とともにメモリの上限つきのキャッシュに保持する。設定の変更や
+# ファイルの切り替えでは、キャッシュにあるものはデコードもエンコードもしない
+
+# プレビューのキャッシュの容量の既定値（MB）
+DEFAULT_PREVIEW_CACHE_MB = 64
+# 画面に表示する画像の大きさの上限（幅, 高さ）
+PREVIEW_SIZE = (320, 200)
+# 見積もりのエンコードに使う品質（GUIの処理と同じ既定値）
+PREVIEW_QUALITY = 85
+
+
+class ProxyCache:
+    # 最後に使われたのが古い順に削除する、メモリの上限つきのキャッシュ（LRU）
+    # 値ごとにおおよそのバイト数を指定し、合計が上限を超えた分を削除する
+    # （複数のスレッドから使える）
+    def __init__(self, max_size_mb=DEFAULT_PREVIEW_CACHE_MB):
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.used = 0
+        self._entries = OrderedDict()  # キー -> (値, バイト数)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # 値を返し、最近使われたものとして記録する（なければNone）
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        # 値を追加し、上限を超えた分を古い順に削除する
+        # （上限より大きい値も、直前に使われたものとして1つは残す）
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.used -= previous[1]
+            self._entries[key] = (value, nbytes)
+            self.used += nbytes
+            while self.used > self.max_bytes and len(self._entries) > 1:
+                _, (_, removed) = self._entries.popitem(last=False)
+                self.used -= removed
+
+
+# 画像のおおよそのメモリ上のバイト数を返す関数
+def image_bytes(img):
+    return img.width * img.height * pixel_bytes(img.mode)
+
+
+# ファイルのキャッシュのキーを返す関数（更新されたファイルは別のキーになる）
+def file_key(path):
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+# 元画像と同じ設定でエンコードするための保存オプションを返す関数
+# JPEGは元の量子化テーブルとサブサンプリングを使う（品質が分からないため）
+# カメラなどのJPEGはハフマン符号を最適化していないことが多いため、最適化しない
+def source_encode_options(img):
+    if img.format != "JPEG":
+        return {}
+    options = dict(qtables=img.quantization, optimize=False)
+    sampling = JpegImagePlugin.get_sampling(img)
+    if sampling != -1:
+        options["subsampling"] = sampling
+    return options
+
+
+# 元画像のプロキシを返す関数（キャッシュになければデコードして追加する）
+# 戻り値は (プロキシ, 表示用の画像, 元の幅と高さ, 元のバイト数, アニメーションかどうか,
+# 元画像と同じ設定でエンコードするための保存オプション)
+def load_proxy(path, key, cache):
+    entry = cache.get(("proxy",) + key)
+    if entry is not None:
+        return entry
+    with Image.open(path) as img:
+        width, height = img.size
+        animated = getattr(img, "n_frames", 1) > 1 or img.format == "GIF"
+        source_options = source_encode_options(img)
+        # クロップしてもサイズの予測と同じ程度のピクセル数が残るよう、その2倍に縮小する
+        # （JPEGはドラフトモード、非圧縮のTIFFとBMPは帯状に読み込みながら縮小する）
+        scale = min((PROXY_PIXELS * 2 / (width * height)) ** 0.5, 1.0)
+        size = (max(int(width * scale), 1), max(int(height * scale), 1))
+        source = ResizeSource(img, path, low_memory=True)
+        proxy = source.full() if size == img.size else source.resize(size)
+    display = proxy.convert("RGBA" if "A" in proxy.getbands() else "RGB")
+    display.thumbnail(PREVIEW_SIZE, Image.LANCZOS)
+    entry = (proxy, display, (width, height), key[1], animated, source_options)
+    cache.put(("proxy",) + key, entry, image_bytes(proxy) + image_bytes(display))
+    return entry
+
+
+# クロップ範囲のプロキシをエンコードして、サイズ比率に対するバイト数の見積もりに使う
+# (プロキシのサイズ比率の対数, バイト数の対数, プロキシでの傾き, 元の大きさでのバイト数の
+# 対数) を返す関数（キャッシュにあれば使う）
+# 元の大きさでのバイト数は元のファイルサイズから求める（プロキシからの外挿は、縮小で
+# 細部が失われる分だけ大きく外れるため）。JPEGは元の品質が出力と異なるため、プロキシを
+# 元と同じ設定と出力の設定でエンコードした比で補正する。ただし細部の少ないプロキシでは
+# 品質による差が元の大きさより大きく出るため、対数で半分だけ補正する
+def measure_crop(key, entry, crop_box, image_format, cache):
+    proxy, _, input_size, input_bytes, _, source_options = entry
+    key = ("crop",) + key + (crop_box, image_format)
+    measure = cache.get(key)
+    if measure is not None:
+        return measure
+    ratio = proxy.width / input_size[0]
+    left, top, right, bottom = crop_box or (0, 0) + input_size
+    cropped = proxy.crop(
+        (
+            int(left * ratio),
+            int(top * ratio),
+            max(int(right * ratio), int(left * ratio) + 1),
+            max(int(bottom * ratio), int(top * ratio) + 1),
+        )
+    )
+    if image_format == "JPEG" and cropped.mode not in ("L", "RGB", "CMYK"):
+        cropped = cropped.convert("RGB")
+    small = cropped.resize(
+        (max(cropped.width // 2, 1), max(cropped.height // 2, 1)), Image.LANCZOS
+    )
+    buffer = io.BytesIO()
+    options = get_encode_options(image_format, PREVIEW_QUALITY)
+    x0 = math.log(cropped.width / (right - left))
+    y0 = math.log(encode_image(cropped, buffer, image_format, **options))
+    x1 = math.log(small.width / (right - left))
+    y1 = math.log(encode_image(small, buffer, image_format, **options))
+    # 傾きの範囲は予測（predict_start）と同じ
+    slope = min(max((y0 - y1) / (x0 - x1), 0.5), 4.0) if x0 != x1 else 2.0
+    full = math.log(input_bytes * (right - left) * (bottom - top))
+    full -= math.log(input_size[0] * input_size[1])
+    if source_options:
+        source_bytes = encode_image(
+            cropped, buffer, image_format, **dict(options, **source_options)
+        )
+        full += (y0 - math.log(source_bytes)) / 2
+    measure = (x0, y0, slope, full)
+    cache.put(key, measure, 64)  # 数値のみのため小さい
+    return measure
+
+
+# サイズ比率の対数からバイト数の対数を見積もる関数
+# プロキシと元の大きさの間は2点を結ぶ直線、それより小さい場合はプロキシでの傾き、
+# 拡大する場合は2点の傾き（ただし拡大しても細部は増えないため2以下）を使う
+def estimate_log_bytes(measure, x):
+    x0, y0, slope, full = measure
+    if x0 >= 0 or x <= x0:
+        return y0 + slope * (x - x0)
+    middle = max((full - y0) / -x0, 0.05)
+    if x <= 0:
+        return y0 + middle * (x - x0)
+    return full + min(middle, 2.0) * x
+
+
+# バイト数の対数からサイズ比率の対数を見積もる関数（estimate_log_bytes の逆関数）
+def estimate_log_scale(measure, y):
+    x0, y0, slope, full = measure
+    if x0 >= 0 or y <= y0:
+        return x0 + (y - y0) / slope
+    middle = max((full - y0) / -x0, 0.05)
+    if y <= y0 - middle * x0:
+        return x0 + (y - y0) / middle
+    return (y - y0 + middle * x0) / min(middle, 2.0)
+
+
+# プレビューを作成する関数（GUIのスレッドとは別のスレッドで呼ばれる）
+# settings は process_image と同じ crop_type、aspect_ratio、size_type、target_size、
+# operation の辞書（target_size が正しくない場合はNone）
+# 戻り値は表示用の画像、クロップ範囲、元と出力の幅と高さ、ファイルサイズの見積もりの辞書
+def make_preview(path, settings, cache):
+    key = file_key(path)
+    entry = load_proxy(path, key, cache)
+    display, input_size, input_bytes, animated = entry[1:5]
+    crop_box = get_crop_box(
+        input_size[0], input_size[1], settings["crop_type"], settings["aspect_ratio"]
+    )
+    if settings["crop_type"] == "smart":
+        # スマートクロップの位置はキャッシュのプロキシから選ぶ
+        crop_box = find_crop_box(entry[0], input_size[0], input_size[1], crop_box)
+    left, top, right, bottom = crop_box or (0, 0) + input_size
+    cropped_width, cropped_height = right - left, bottom - top
+    preview = dict(
+        image=display,
+        display_scale=display.width / input_size[0],
+        crop_box=crop_box,
+        input_size=input_size,
+        input_bytes=input_bytes,
+        output_size=None,
+        output_bytes=None,
+    )
+    size_type, target = settings["size_type"], settings["target_size"]
+    if size_type != "none" and not target:
+        return preview  # 目標サイズが入力されていない場合はクロップ範囲のみ
+    image_format = get_save_format(os.path.splitext(path)[1])
+    # アニメーションは1フレームから見積もれないため、幅と高さのみ
+    measure = None
+    if not animated:
+        measure = measure_crop(key, entry, crop_box, image_format, cache)
+
+    output_size = None  # 幅か高さの指定の場合は処理と同じ方法で求める
+    if size_type in ("width", "height"):
+        output_size, scale = pixel_target_size(
+            cropped_width, cropped_height, size_type, target
+        )
+    elif size_type == "mb":
+        if measure is None:
+            return preview
+        scale = math.exp(estimate_log_scale(measure, math.log(target * 1024 * 1024)))
+        operation = settings["operation"]
+        if operation == "auto":
+            operation = "compress" if input_bytes > target * 1024 * 1024 else "upscale"
+        # 探索と同じく、縮小では元の大きさまで、拡大では上限までに収める
+        if operation == "compress":
+            scale = min(scale, 1.0)
+        else:
+            scale = min(max(scale, 1.0), MAX_UPSCALE_RATIO)
+    else:
+        scale = 1.0
+    preview["output_size"] = output_size or (
+        max(int(round(cropped_width * scale)), 1),
+        max(int(round(cropped_height * scale)), 1),
+    )
+    if measure is not None:
+        preview["output_bytes"] = int(
+            math.exp(estimate_log_bytes(measure, math.log(scale)))
+        )
+    return preview
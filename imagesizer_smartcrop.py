@@ -0,0 +1,99 @@
+from PIL import Image
+
+# スマートクロップ（被写体を含む位置を選ぶクロップ）
+# 縮小した画像で、輝度の勾配（細部）と平均の色からの離れ具合（背景と異なる色）を
+# 足し合わせた顕著性マップを作り、その累積和（積分画像）でクロップ範囲の候補ごとの
+# 合計を一度に求める。クロップの大きさは中央でのクロップと同じで、位置だけを選ぶ
+
+# 評価に使う縮小画像の長辺（ピクセル）
+SMART_PROXY_SIZE = 256
+# 中央からの距離に対するペナルティ（顕著性の合計に対する割合）
+# 差がない場合（平坦な画像など）は中央を選ぶ
+CENTER_BIAS = 0.02
+
+
+# スマートクロップの評価に使う numpy を読み込んで返す関数（ない場合はNone）
+# 読み込みに時間がかかるため、スマートクロップを使う場合にだけ読み込む
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+# スマートクロップを使えるかどうかを返す関数
+def smart_crop_available():
+    return load_numpy() is not None
+
+
+# 評価用の縮小画像の大きさを返す関数
+def proxy_size(width, height):
+    scale = min(SMART_PROXY_SIZE / max(width, height), 1.0)
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+# 縮小画像から顕著性マップ（ピクセルごとの重み）を作る関数
+def saliency_map(proxy):
+    np = load_numpy()
+    # チャンネルごとの連続した配列にする（輝度, 青の色差, 赤の色差）
+    planes = [
+        np.asarray(band, dtype=np.float32) for band in proxy.convert("YCbCr").split()
+    ]
+    luma = planes[0]
+    # 輝度の勾配の大きさ（細部や輪郭）
+    edges = np.zeros_like(luma)
+    edges[:, 1:] += np.abs(np.diff(luma, axis=1))
+    edges[1:, :] += np.abs(np.diff(luma, axis=0))
+    # 画像全体の平均の色からの距離（背景と異なる色の被写体）
+    distinct = np.sqrt(sum((plane - plane.mean()) ** 2 for plane in planes))
+    # それぞれ平均が1になるよう正規化して足す（どちらかが全体の評価を支配しないため）
+    return edges / (edges.mean() + 1e-6) + distinct / (distinct.mean() + 1e-6)
+
+
+# 積分画像から、指定の大きさのすべての位置の窓の合計を返す関数
+# 戻り値の [y, x] は左上が (x, y) の窓の合計
+def window_sums(integral, window_width, window_height):
+    return (
+        integral[window_height:, window_width:]
+        - integral[:-window_height, window_width:]
+        - integral[window_height:, :-window_width]
+        + integral[:-window_height, :-window_width]
+    )
+
+
+# 中央でのクロップ範囲と同じ大きさで、顕著性の合計が最も大きい位置のクロップ範囲を返す関数
+# proxy は元画像（幅 width、高さ height）全体を縮小した画像（大きさは問わない）
+def find_crop_box(proxy, width, height, crop_box):
+    left, top, right, bottom = crop_box
+    crop_width, crop_height = right - left, bottom - top
+    np = load_numpy()
+    if np is None or (crop_width, crop_height) == (width, height):
+        return crop_box
+    # 評価用の大きさより大きい縮小画像は縮小する（小さいものはそのまま使う）
+    size = proxy_size(*proxy.size)
+    if proxy.size != size:
+        proxy = proxy.resize(size, Image.BOX)
+    saliency = saliency_map(proxy)
+    integral = np.zeros((size[1] + 1, size[0] + 1), dtype=np.float64)
+    integral[1:, 1:] = saliency.cumsum(axis=0).cumsum(axis=1)
+
+    # 縮小画像での窓の大きさ（元の大きさのクロップ範囲に対応する）
+    window_width = min(max(int(round(crop_width * size[0] / width)), 1), size[0])
+    window_height = min(max(int(round(crop_height * size[1] / height)), 1), size[1])
+    total = integral[-1, -1]
+    if total <= 0:
+        return crop_box  # 一色だけの画像は中央でクロップする
+    scores = window_sums(integral, window_width, window_height) / total
+    # 中央から離れるほど少し下げる（離れ具合は移動できる範囲に対する割合）
+    for axis, count in enumerate(scores.shape):
+        if count > 1:
+            center = (count - 1) / 2
+            penalty = CENTER_BIAS * np.abs(np.arange(count) - center) / center
+            scores -= penalty[:, None] if axis == 0 else penalty[None, :]
+    y, x = np.unravel_index(np.argmax(scores), scores.shape)
+
+    # 元の大きさの座標に戻す（範囲は画像の内側に収める）
+    new_left = min(max(int(round(x * width / size[0])), 0), width - crop_width)
+    new_top = min(max(int(round(y * height / size[1])), 0), height - crop_height)
+    return new_left, new_top, new_left + crop_width, new_top + crop_height
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import queue
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from imagesizer_core import (
+    DEFAULT_WORKERS,
+    SUPPORTED_EXTENSIONS,
+    create_worker_pool,
+    run_job,
+)
+from imagesizer_metrics import ProcessingCancelled
+
+# 監視フォルダ（ホットフォルダ）に追加された画像を順次処理する機能
+
+# 処理待ちキューの長さの既定値（超えるとフォルダの走査を待たせる）
+DEFAULT_QUEUE_SIZE = 64
+# フォルダを走査する間隔（秒）
+DEFAULT_POLL_INTERVAL = 1.0
+# サイズと更新日時が変わらなければ書き込み完了とみなすまでの時間（秒）
+DEFAULT_SETTLE_SECONDS = 2.0
+# 処理状態を記録するファイルの既定の名前（出力フォルダに作成する）
+STATE_FILE_NAME = ".imagesizer_watch.jsonl"
+
+
+class HotFolderWatcher:
+    # 監視フォルダを定期的に走査し、書き込みが完了したファイルをキューに入れて処理するクラス
+    # 処理済みのファイルは状態ファイルに記録し、再起動後も再処理しない
+    def __init__(
+        self,
+        input_dirs,
+        output_folder,
+        job_options,
+        state_path=None,
+        recursive=False,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        settle_seconds=DEFAULT_SETTLE_SECONDS,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        max_workers=DEFAULT_WORKERS,
+        on_result=None,
+        event_callback=None,
+    ):
+        self.input_dirs = [os.path.abspath(d) for d in input_dirs]
+        self.output_folder = os.path.abspath(output_folder)
+        # input_path と output_folder 以外の process_image の引数
+        self.job_options = dict(job_options)
+        self.state_path = state_path or os.path.join(
+            self.output_folder, STATE_FILE_NAME
+        )
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.max_workers = max_workers
+        # 処理結果を受け取る関数 on_result(パス, 結果, 統計情報, 例外)
+        self.on_result = on_result
+        # ファイルごとのイベントを受け取る関数（ワーカーで集めて完了時にまとめて渡す）
+        self.event_callback = event_callback
+        self.queue = queue.Queue(maxsize=queue_size)  # 処理待ちのファイル
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._observed = {}  # パス -> (サイズと更新日時, 最初に観測した時刻)
+        self._active = set()  # キューに入れたか処理中のパス
+        self._finished = self._load_state()  # パス -> 処理済みのサイズと更新日時
+
+    def _load_state(self):
+        # 状態ファイルから処理済みのファイルを読み込む（同じパスは後の記録が優先）
+        finished = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 書きかけの行は無視する
+                    finished[record["path"]] = tuple(record["signature"])
+        return finished
+
+    def _record(self, path, signature, status, output_path=None):
+        # 処理結果を状態ファイルに追記し、ディスクに書き出す
+        record = dict(
+            path=path, signature=list(signature), status=status, output=output_path
+        )
+        with self._lock:
+            self._finished[path] = signature
+            with open(self.state_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _iter_files(self):
+        # 監視フォルダ内の画像ファイルのパスと (サイズ, 更新日時) を列挙する
+        # 出力フォルダは監視しない（出力を入力として処理し続けないように）
+        stack = [d for d in self.input_dirs if d != self.output_folder]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue  # 隠しファイルと書き込み途中の一時ファイルは除く
+                if entry.is_dir():
+                    if self.recursive and entry.path != self.output_folder:
+                        stack.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # 走査中に削除された場合
+                yield entry.path, (stat.st_size, stat.st_mtime_ns)
+
+    def scan_once(self):
+        # 一度だけ走査し、書き込みが完了した未処理のファイルのリストを返す
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for path, signature in self._iter_files():
+            seen.add(path)
+            with self._lock:
+                if path in self._active or self._finished.get(path) == signature:
+                    continue
+            previous = self._observed.get(path)
+            if previous is None or previous[0] != signature:
+                # 初めて見たか、まだ書き込み中の場合は観測し直す
+                self._observed[path] = (signature, now)
+            elif now - previous[1] >= self.settle_seconds:
+                # 一定時間サイズと更新日時が変わらなければ処理対象にする
+                del self._observed[path]
+                ready.append((path, signature))
+        # 消えたファイルの観測記録を削除
+        for path in list(self._observed):
+            if path not in seen:
+                del self._observed[path]
+        return ready
+
+    def _scan_loop(self):
+        # フォルダを定期的に走査してキューに入れる（キューが満杯の場合は空くまで待つ）
+        while not self._stop.is_set():
+            for path, signature in self.scan_once():
+                with self._lock:
+                    self._active.add(path)
+                while not self._stop.is_set():
+                    try:
+                        self.queue.put((path, signature), timeout=self.poll_interval)
+                        break
+                    except queue.Full:
+                        pass
+            self._stop.wait(self.poll_interval)
+
+    def _finish(self, path, signature, future, slots):
+        # ワーカーの処理が終わったときに呼ばれる
+        # 例外の種類によらず、処理中の記録と同時に投入できるジョブ数は必ず元に戻す
+        try:
+            try:
+                result, stats, error = future.result()
+            except (KeyboardInterrupt, CancelledError):
+                # 中断された場合は状態ファイルに記録せず、次回の起動時に処理し直す
+                result, stats, error = None, {}, ProcessingCancelled()
+            except BaseException as e:
+                result, stats, error = None, {}, e
+            for event in stats.pop("events", ()):
+                self.event_callback(event)
+            output_path = result[0] if result else None
+            if not isinstance(error, ProcessingCancelled):
+                status = "done" if error is None and output_path else "failed"
+                # 失敗した場合も記録し、ファイルが更新されるまでは再処理しない
+                self._record(path, signature, status, output_path)
+        finally:
+            with self._lock:
+                self._active.discard(path)
+            slots.release()
+        if self.on_result:
+            self.on_result(path, result, stats, error)
+
+    def run(self):
+        # stop() が呼ばれるまで監視と処理を続ける
+        os.makedirs(self.output_folder, exist_ok=True)
+        scanner = threading.Thread(target=self._scan_loop, daemon=True)
+        scanner.start()
+        if self.max_workers > 1:
+            # ワーカーは Ctrl+C を無視し、停止時は処理中のファイルの完了を待つ
+            executor = create_worker_pool(self.max_workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+        # 同時に投入するジョブ数を制限する（超えた分はキューに溜まり、走査が待たされる）
+        slots = threading.BoundedSemaphore(self.max_workers)
+        try:
+            while not self._stop.is_set():
+                try:
+                    path, signature = self.queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                slots.acquire()
+                job = dict(
+                    self.job_options, input_path=path, output_folder=self.output_folder
+                )
+                future = executor.submit(
+                    run_job, job, collect_events=self.event_callback is not None
+                )
+                future.add_done_callback(
+                    lambda f, path=path, signature=signature: self._finish(
+                        path, signature, f, slots
+                    )
+                )
+        finally:
+            self._stop.set()
+            executor.shutdown(wait=True)
+            scanner.join()
+
+    def stop(self):
+        # 監視を停止する（処理中のファイルは完了を待つ）
+        self._stop.set()
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+# テストからリポジトリ直下のモジュールを読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# テスト用の画像（グラデーションのJPEG）を作成して、そのパスを返すフィクスチャ
+@pytest.fixture
+def sample_jpeg(tmp_path):
+    path = tmp_path / "sample.jpg"
+    img = Image.linear_gradient("L").resize((640, 480)).convert("RGB")
+    img.save(path, quality=95)
+    return str(path)
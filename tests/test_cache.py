@@ -0,0 +1,105 @@
+import io
+import os
+
+from imagesizer_cache import ResultCache, content_digest
+from imagesizer_core import process_image
+
+
+# 出力画像をキャッシュに保存する関数（保存したキーを返す）
+def store(cache, source, data, params=None, tail="_50%.jpg"):
+    key = cache.make_key(content_digest(source), params or dict(target_size=200))
+    cache.store(key, content_digest(source), io.BytesIO(data), tail, 0.5, 80)
+    return key
+
+
+# 保存前は見つからず、保存後は出力画像と (サイズ比率, 品質) が見つかることを確認するテスト
+def test_miss_then_hit(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = cache.make_key(content_digest(b"source"), dict(target_size=200))
+    assert cache.lookup(key) is None
+
+    store(cache, b"source", b"output")
+    entry = cache.lookup(key)
+    assert entry["bytes"] == len(b"output")
+    assert (entry["output_tail"], entry["scale"], entry["quality"]) == (
+        "_50%.jpg",
+        0.5,
+        80,
+    )
+    with open(entry["blob"], "rb") as f:
+        assert f.read() == b"output"
+
+
+# 元画像の内容か処理パラメータが異なると、別のキーになることを確認するテスト
+def test_key_depends_on_source_and_params(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = store(cache, b"source", b"output")
+    assert cache.make_key(content_digest(b"other"), dict(target_size=200)) != key
+    assert cache.make_key(content_digest(b"source"), dict(target_size=300)) != key
+    assert cache.make_key(content_digest(b"source"), dict(target_size=200)) == key
+
+
+# 元画像を指定した無効化では、その元画像の記録と出力画像だけを削除することを確認するテスト
+def test_invalidate_source(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = store(cache, b"source", b"output")
+    other = store(cache, b"other", b"output2")
+    blob = cache.lookup(key)["blob"]
+
+    assert cache.invalidate(content_digest(b"source")) == 1
+    assert cache.lookup(key) is None
+    assert not os.path.exists(blob)
+    assert cache.lookup(other) is not None
+
+    assert cache.invalidate() == 1
+    assert cache.lookup(other) is None
+
+
+# 容量を超えた出力画像は古い順に削除し、(サイズ比率, 品質) の記録は残すことを確認するテスト
+def test_evict_keeps_hint(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_size_mb=1.5 / 1024)
+    old = store(cache, b"old", b"x" * 1000)
+    new = store(cache, b"new", b"y" * 1000)
+
+    entry = cache.lookup(old)
+    assert entry["blob"] is None and entry["bytes"] == 0
+    assert (entry["scale"], entry["quality"]) == (0.5, 80)
+    assert cache.lookup(new)["blob"] is not None
+
+
+# 出力画像が外部から削除されていた場合は、記録だけを返すことを確認するテスト
+def test_missing_blob_is_treated_as_hint(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = store(cache, b"source", b"output")
+    os.remove(cache.lookup(key)["blob"])
+
+    entry = cache.lookup(key)
+    assert entry["blob"] is None and entry["bytes"] == 0
+    assert entry["scale"] == 0.5
+
+
+# 同じ画像を同じ設定で処理し直すとキャッシュから出力し、無効化すると処理し直すことを確認するテスト
+def test_process_image_uses_cache(tmp_path, sample_jpeg):
+    cache = ResultCache(str(tmp_path / "cache"))
+    output_folder = tmp_path / "out"
+    output_folder.mkdir()
+    args = (sample_jpeg, str(output_folder), 200, "resize", "pixels", "center")
+
+    first = process_image(*args, cache=cache)
+    assert first.cache is None and first.output_path is not None
+    with open(first.output_path, "rb") as f:
+        output = f.read()
+    os.remove(first.output_path)
+
+    second = process_image(*args, cache=cache)
+    assert second.cache == "hit"
+    assert second.output_path == first.output_path
+    with open(second.output_path, "rb") as f:
+        assert f.read() == output
+
+    # 設定が異なる場合はキャッシュを使わない
+    assert process_image(*args, quality=70, cache=cache).cache != "hit"
+
+    with open(sample_jpeg, "rb") as f:
+        cache.invalidate(content_digest(f.read()))
+    assert process_image(*args, cache=cache).cache != "hit"
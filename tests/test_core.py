@@ -0,0 +1,71 @@
+from imagesizer_core import MAX_QUALITY, SizeSearch
+
+
+# 幅と高さと品質からバイト数を決める、単純なエンコードのモデル
+def model_bytes(size, quality):
+    width, height = size
+    return int(width * height * 0.4 * quality / 85)
+
+
+# エンコードのモデルで探索を最後まで進める関数
+def run_search(search, model=model_bytes):
+    while True:
+        candidate = search.next_candidate()
+        if candidate is None:
+            return search
+        scale, quality = candidate
+        search.observe(scale, quality, model(search.dimensions(scale), quality))
+
+
+# 許容誤差内に入った候補で探索を終えることを確認するテスト
+def test_stops_within_tolerance():
+    search = run_search(SizeSearch(100_000, "compress", (1000, 1000), 1.0, 85))
+    assert search.done
+    scale, quality, size = search.best
+    assert search.is_feasible(size) and search.is_within_tolerance(size)
+    assert search.history[-1] == search.best
+    assert search.encodes < 10
+
+
+# 最大エンコード回数に達したら、候補を返さずに終わることを確認するテスト
+def test_stops_at_max_encodes():
+    search = SizeSearch(
+        100_000, "compress", (1000, 1000), 1.0, 85, tolerance=1e-9, max_encodes=3
+    )
+    run_search(search)
+    assert search.encodes == 3
+    assert search.next_candidate() is None
+
+
+# サイズ比率が上限に達しても届かない場合、品質の探索に切り替えることを確認するテスト
+def test_switches_to_quality_at_exhausted_bound():
+    search = run_search(
+        SizeSearch(10**9, "upscale", (1000, 1000), 1.0, 85, max_scale=2.0)
+    )
+    assert search.phase == "quality"
+    assert search.best is None
+    assert {s for s, q, b in search.history if q != 85} == {2.0}
+    assert max(q for s, q, b in search.history) == MAX_QUALITY
+
+
+# 品質を調整できない形式では、限界に達した時点で探索を終えることを確認するテスト
+def test_lossless_gives_up_at_exhausted_bound():
+    search = run_search(
+        SizeSearch(10**9, "upscale", (1000, 1000), 1.0, 85, lossy=False, max_scale=2.0)
+    )
+    assert search.done and search.best is None
+    assert search.phase == "scale"
+    assert {q for s, q, b in search.history} == {85}
+    assert search.history[-1][0] == 2.0
+
+
+# fixed_size を指定した場合は、幅と高さを変えずに品質のみを探索することを確認するテスト
+def test_fixed_size_searches_quality_only():
+    search = run_search(
+        SizeSearch(50_000, "compress", (1000, 1000), 0.5, 85, fixed_size=(500, 400))
+    )
+    scale, quality, size = search.best
+    assert search.is_within_tolerance(size)
+    assert quality < 85
+    assert {s for s, q, b in search.history} == {0.5}
+    assert search.dimensions(scale) == (500, 400)
@@ -0,0 +1,150 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from imagesizer_distributed import (
+    PROTOCOL_VERSION,
+    Coordinator,
+    DistributedWorker,
+    is_valid_worker_message,
+)
+from imagesizer_metrics import ProcessingCancelled
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="Unixソケットを使えない環境"
+)
+
+
+# 画像を処理するジョブの一覧を作る関数
+def make_jobs(sample_jpeg, output_folder, count):
+    return [
+        dict(
+            input_path=sample_jpeg,
+            output_folder=str(output_folder),
+            target_size=100 + i,
+            operation="resize",
+            size_type="pixels",
+            crop_type="center",
+        )
+        for i in range(count)
+    ]
+
+
+# コーディネーターに接続してメッセージを送り、接続を返す関数
+def connect(address, *messages):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(address[len("unix:") :])
+    for message in messages:
+        conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+    return conn
+
+
+# 接続が相手から閉じられたかどうかを返す関数
+def is_closed(conn):
+    conn.settimeout(10)
+    try:
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                return True
+    except socket.timeout:
+        return False
+
+
+@pytest.fixture
+def address(tmp_path):
+    return f"unix:{tmp_path / 'coordinator.sock'}"
+
+
+# ワーカーを起動するフィクスチャ（テストの終わりにコーディネーターが終了させる）
+@pytest.fixture
+def start_worker(address):
+    def start():
+        worker = DistributedWorker(address, slots=1, reconnect_seconds=2)
+        thread = threading.Thread(target=worker.run, daemon=True)
+        thread.start()
+        return thread
+
+    return start
+
+
+HELLO = dict(
+    type="hello", version=PROTOCOL_VERSION, worker="w", slots=1, count=1, token=None
+)
+
+
+# 種類や項目が正しくないメッセージを不正と判定することを確認するテスト
+@pytest.mark.parametrize(
+    "message",
+    [
+        dict(type="unknown"),
+        dict(HELLO, worker=None),
+        dict(HELLO, slots=0),
+        dict(HELLO, count=True),
+        dict(type="request", count=-1),
+        dict(type="request", count="1"),
+        dict(type="started", id=3),
+        dict(type="released", ids=[0, "1"]),
+        dict(type="lost", ids=7),
+        dict(type="result", id=0, error="失敗"),
+        dict(type="result", id=0, stats="x"),
+    ],
+)
+def test_invalid_messages(message):
+    assert not is_valid_worker_message(message, 3)
+
+
+# 正しいメッセージを不正と判定しないことを確認するテスト
+def test_valid_messages():
+    for message in [
+        HELLO,
+        dict(type="request", count=0),
+        dict(type="started", id=2),
+        dict(type="released", ids=[0, 1]),
+        dict(type="result", id=1, result=None, stats={}, error=None),
+        dict(type="result", id=1, error=dict(type="OSError", message="x")),
+        dict(type="heartbeat"),
+    ]:
+        assert is_valid_worker_message(message, 3)
+
+
+# 不正なメッセージを送った接続だけを切り、一括処理は続けることを確認するテスト
+def test_bad_messages_drop_only_that_connection(
+    tmp_path, sample_jpeg, address, start_worker
+):
+    jobs = make_jobs(sample_jpeg, tmp_path, 4)
+    with Coordinator(address) as coordinator:
+        unregistered = connect(address, dict(type="hello"))
+        registered = connect(address, dict(HELLO, worker="bad"), dict(type="request"))
+        start_worker()
+        results = list(coordinator.process(jobs))
+        assert is_closed(unregistered)
+        assert is_closed(registered)
+    assert sorted(index for index, *_ in results) == list(range(len(jobs)))
+    assert all(error is None for *_, error in results)
+    assert all(result.output_path for _, _, result, _, _ in results)
+
+
+# キャンセルした後の一括処理が、同じワーカーで中止されずに処理されることを確認するテスト
+def test_cancel_does_not_affect_next_batch(
+    tmp_path, sample_jpeg, address, start_worker
+):
+    jobs = make_jobs(sample_jpeg, tmp_path, 6)
+    with Coordinator(address) as coordinator:
+        start_worker()
+        cancel_event = threading.Event()
+        cancelled = []
+        for item in coordinator.process(jobs, cancel_event=cancel_event):
+            cancelled.append(item)
+            cancel_event.set()
+        assert len(cancelled) < len(jobs)
+        assert all(
+            error is None or isinstance(error, ProcessingCancelled)
+            for *_, error in cancelled
+        )
+
+        results = list(coordinator.process(jobs))
+    assert len(results) == len(jobs)
+    assert all(error is None for *_, error in results)
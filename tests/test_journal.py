@@ -0,0 +1,107 @@
+import json
+
+from imagesizer_cli import journaled_jobs
+from imagesizer_core import ImageResult
+from imagesizer_journal import (
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    BatchJournal,
+)
+from imagesizer_metrics import ProcessingCancelled
+
+OPTIONS = dict(target_size=200, size_type="pixels", cache=object())
+
+
+# 入力パスの一覧からジョブの一覧を作る関数
+def make_jobs(tmp_path, names):
+    return [
+        dict(input_path=str(tmp_path / name), output_folder=str(tmp_path / "out"))
+        for name in names
+    ]
+
+
+# 再開時には完了と失敗以外（未処理と処理中）のファイルだけが残ることを確認するテスト
+def test_resume_skips_finished_files(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    jobs = make_jobs(tmp_path, ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+    journal = BatchJournal(path)
+    journal.start(OPTIONS, jobs)
+    journal.mark(jobs[0]["input_path"], DONE, outputs=["a_out.jpg"])
+    journal.mark(jobs[1]["input_path"], FAILED, error="OSError: x")
+    journal.mark_running(2, jobs[2])
+
+    resumed = BatchJournal(path)
+    assert resumed.matches(OPTIONS)
+    assert resumed.unfinished() == jobs[2:]
+    assert resumed.counts() == {PENDING: 1, RUNNING: 1, DONE: 1, FAILED: 1}
+
+
+# 書きかけの最後の行があっても、それまでの記録から再開できることを確認するテスト
+def test_resume_ignores_truncated_last_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    jobs = make_jobs(tmp_path, ["a.jpg", "b.jpg"])
+    journal = BatchJournal(str(path))
+    journal.start(OPTIONS, jobs)
+    journal.mark(jobs[0]["input_path"], DONE, outputs=["a_out.jpg"])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"type": "job", "input": "')
+
+    assert BatchJournal(str(path)).unfinished() == jobs[1:]
+
+
+# 形式のバージョンが異なるジャーナルは使わないことを確認するテスト
+def test_other_version_is_ignored(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = BatchJournal(str(path))
+    journal.start(OPTIONS, make_jobs(tmp_path, ["a.jpg"]))
+    lines = path.read_text(encoding="utf-8").splitlines()
+    manifest = json.loads(lines[0])
+    manifest["version"] += 1
+    path.write_text(
+        "\n".join([json.dumps(manifest)] + lines[1:]) + "\n", encoding="utf-8"
+    )
+
+    resumed = BatchJournal(str(path))
+    assert resumed.options is None and resumed.jobs == {}
+    assert not resumed.matches(OPTIONS)
+
+
+# キャンセルされたファイルは未処理のまま残し、出力がないものは失敗にすることを確認するテスト
+def test_record_result(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    jobs = make_jobs(tmp_path, ["a.jpg", "b.jpg"])
+    journal = BatchJournal(path)
+    journal.start(OPTIONS, jobs)
+    journal.mark_running(0, jobs[0])
+    journal.record_result(jobs[0], None, ProcessingCancelled())
+    journal.record_result(
+        jobs[1],
+        ImageResult(jobs[1]["input_path"], message="目標サイズに到達できませんでした"),
+        None,
+    )
+
+    resumed = BatchJournal(path)
+    assert resumed.jobs[jobs[0]["input_path"]]["status"] == RUNNING
+    assert resumed.jobs[jobs[1]["input_path"]]["status"] == FAILED
+    assert resumed.unfinished() == jobs[:1]
+
+
+# 処理内容が同じ場合は完了したファイルを除き、新しいファイルを追加することを確認するテスト
+def test_journaled_jobs_resumes_matching_options(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    jobs = make_jobs(tmp_path, ["a.jpg", "b.jpg"])
+    journal = BatchJournal(path)
+    assert journaled_jobs(journal, OPTIONS, jobs) == jobs
+    journal.mark(jobs[0]["input_path"], DONE, outputs=["a_out.jpg"])
+
+    more = jobs + make_jobs(tmp_path, ["c.jpg"])
+    resumed = BatchJournal(path)
+    assert journaled_jobs(resumed, OPTIONS, more) == more[1:]
+    assert BatchJournal(path).unfinished() == more[1:]
+
+    # 処理内容が異なる場合は記録をやり直す
+    other = dict(OPTIONS, target_size=300)
+    assert journaled_jobs(BatchJournal(path), other, more) == more
+    assert BatchJournal(path).counts()[PENDING] == 3